@@ -0,0 +1,13 @@
+-- apaquartoのpost-astのフィルター（Quartoの解析の後）
+-- _extensions/apaquarto/のフィルターを、_extensions/naist/naist-filterchain.luaで以下の順に1つずつ実行する
+-- （naist-apa-docx形式の場合のみ。apaquarto-docx形式ではQuartoがapaquartoのフィルターを直接実行する）
+-- （NAIST_TRACE=1で時間を記録、NAIST_LUA_FUSE=1でまとめられるフィルターを1回の走査にする）
+local dir = pandoc.path.directory((debug.getinfo(1, 'S').source:gsub('^@', '')))
+local chain = dofile(pandoc.path.join({ dir, '..', 'naist', 'naist-filterchain.lua' }))
+
+return chain.chain('post-ast', pandoc.path.join({ dir, '..', 'apaquarto' }), {
+  -- Finds citations to be masked and converts them to masked citations
+  'apamasked.lua',
+  -- Ensures that images have two-column attribute, when needed
+  'apatwocolumnlatex.lua',
+})
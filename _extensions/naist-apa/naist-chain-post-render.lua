@@ -0,0 +1,25 @@
+-- apaquartoのpost-renderのフィルター（出力形式への変換の直前）
+-- _extensions/apaquarto/のフィルターを、_extensions/naist/naist-filterchain.luaで以下の順に1つずつ実行する
+-- （naist-apa-docx形式の場合のみ。apaquarto-docx形式ではQuartoがapaquartoのフィルターを直接実行する）
+-- （NAIST_TRACE=1で時間を記録、NAIST_LUA_FUSE=1でまとめられるフィルターを1回の走査にする）
+local dir = pandoc.path.directory((debug.getinfo(1, 'S').source:gsub('^@', '')))
+local chain = dofile(pandoc.path.join({ dir, '..', 'naist', 'naist-filterchain.lua' }))
+
+return chain.chain('post-render', pandoc.path.join({ dir, '..', 'apaquarto' }), {
+  -- Removes surrounding table environment for docx figures and tables
+  'apaextractfigure.lua',
+  -- Formats notes below figures and tables (docx, html, typst)
+  'apanote.lua',
+  -- Adds styles to figures and tables
+  'apafloat.lua',
+  -- Formats captions for figures and tables
+  'apacaption.lua',
+  -- Puts proper spacing for paragraphs after figures and tables
+  'apaafternote.lua',
+  -- Process citations, adds asterisks for meta-analysis citations
+  'citeprocr.lua',
+  -- Process APA in-text citations (ampersand to and, possessive citation)
+  'apaandcite.lua',
+  -- Process appendices in latex
+  'apaappendixlatex.lua',
+})
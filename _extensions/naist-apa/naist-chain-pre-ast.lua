@@ -0,0 +1,27 @@
+-- apaquartoのpre-astのフィルター（Pandocの解析直後）
+-- _extensions/apaquarto/のフィルターを、_extensions/naist/naist-filterchain.luaで以下の順に1つずつ実行する
+-- （naist-apa-docx形式の場合のみ。apaquarto-docx形式ではQuartoがapaquartoのフィルターを直接実行する）
+-- （NAIST_TRACE=1で時間を記録、NAIST_LUA_FUSE=1でまとめられるフィルターを1回の走査にする）
+local dir = pandoc.path.directory((debug.getinfo(1, 'S').source:gsub('^@', '')))
+local chain = dofile(pandoc.path.join({ dir, '..', 'naist', 'naist-filterchain.lua' }))
+
+return chain.chain('pre-ast', pandoc.path.join({ dir, '..', 'apaquarto' }), {
+  -- Sets language defaults other than English
+  'apalanguage.lua',
+  -- Prepare plain markdown tables to be used by crossrefprefix.lua
+  'markdowntable.lua',
+  -- Give figures and tables appendix prefixes
+  'crossrefprefix.lua',
+  -- Move figures and tables to end of document
+  'apafloatstoend.lua',
+  -- Set latex document mode
+  'journalmode.lua',
+  -- Set latex images to column width by default
+  'apafigurewidthlatex.lua',
+  -- Make apa-note an attribute of figure in latex
+  'apanotelatex.lua',
+  -- Make appendices citable with apx prefix
+  'apaciteappendix.lua',
+  -- Add a refs div if it was omitted.
+  'apaomitrefsdiv.lua',
+})
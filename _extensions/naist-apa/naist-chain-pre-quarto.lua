@@ -0,0 +1,23 @@
+-- apaquartoのpre-quartoのフィルター（Quartoのフィルターの前）
+-- _extensions/apaquarto/のフィルターを、_extensions/naist/naist-filterchain.luaで以下の順に1つずつ実行する
+-- （naist-apa-docx形式の場合のみ。apaquarto-docx形式ではQuartoがapaquartoのフィルターを直接実行する）
+-- （NAIST_TRACE=1で時間を記録、NAIST_LUA_FUSE=1でまとめられるフィルターを1回の走査にする）
+local dir = pandoc.path.directory((debug.getinfo(1, 'S').source:gsub('^@', '')))
+local chain = dofile(pandoc.path.join({ dir, '..', 'naist', 'naist-filterchain.lua' }))
+
+return chain.chain('pre-quarto', pandoc.path.join({ dir, '..', 'apaquarto' }), {
+  -- Formats headers properly
+  'apaheader.lua',
+  -- Formats title and authors
+  'apastriptitle.lua',
+  -- Word count
+  'wordcount.lua',
+  -- Formats title page, abstract (all except latex)
+  'frontmatter.lua',
+  -- Formats multi-paragraph quotes
+  'apaquote.lua',
+  -- Indentation for latex, allow for no indenting command
+  'latexnoindent.lua',
+  -- Inserts appendix prefixes to tables and figures
+  'apafigtblappendix.lua',
+})
@@ -0,0 +1,274 @@
+-- NAIST Quarto Extension: 複数のLuaフィルターを順に実行するランナー
+-- naist-apa-docx形式（_extensions/naist-apa/naist-chain-*.lua）から、各エントリーポイント
+-- （pre-ast、post-renderなど）のapaquartoのフィルターをまとめて実行する（apaquarto-docx形式では
+-- 使われず、Quartoがapaquartoのフィルターを直接実行する）
+-- - 既定: Quartoと同じく、フィルターを1つずつ順に文書全体に適用する
+-- - NAIST_TRACE=1: フィルターごとのCPU時間をnaist-trace.jsonlに記録し、標準エラー出力に表示する
+--   （python3 -m naistbuild trace summaryで他の段階と一緒に集計できる）
+-- - NAIST_LUA_FUSE=1: 結果が変わらない組み合わせの連続したフィルターを1つにまとめ、
+--   文書全体の走査の回数を減らす
+--
+-- Pandocは1つのフィルターの関数を、インライン要素、Inlines、ブロック要素、Blocks、Meta、Pandocの
+-- 順に、それぞれ文書全体に適用する。そのため、前のフィルターの関数がすべて次のフィルターの関数より
+-- 前の順位の場合（例: StrだけのフィルターとDivだけのフィルター）は、1つのフィルターにまとめても
+-- 順に実行した場合と同じ結果になる。Pandocの関数どうしは順に呼び出す1つの関数にまとめる。
+-- topdownの走査、Quartoの独自の要素（FloatRefTargetなど）の関数を持つフィルターはまとめない。
+
+local M = {}
+
+-- 関数の順位（Pandocのtypewiseの走査順）
+local INLINE, INLINES, BLOCK, BLOCKS, META, PANDOC = 1, 2, 3, 4, 5, 6
+local ORDER = {
+  Inline = INLINE, Inlines = INLINES, Block = BLOCK, Blocks = BLOCKS, Meta = META, Pandoc = PANDOC,
+}
+for _, name in ipairs({
+  'Cite', 'Code', 'Emph', 'Image', 'LineBreak', 'Link', 'Math', 'Note', 'Quoted', 'RawInline',
+  'SmallCaps', 'SoftBreak', 'Space', 'Span', 'Str', 'Strikeout', 'Strong', 'Subscript',
+  'Superscript', 'Underline',
+}) do
+  ORDER[name] = INLINE
+end
+for _, name in ipairs({
+  'BlockQuote', 'BulletList', 'CodeBlock', 'DefinitionList', 'Div', 'Figure', 'Header',
+  'HorizontalRule', 'LineBlock', 'OrderedList', 'Para', 'Plain', 'RawBlock', 'Table',
+}) do
+  ORDER[name] = BLOCK
+end
+
+local function tracing()
+  return os.getenv('NAIST_TRACE') == '1'
+end
+
+local function fusing()
+  return os.getenv('NAIST_LUA_FUSE') == '1'
+end
+
+-- フィルターのファイルを読み込み、フィルター（関数の表）のリストを返す
+-- Quartoと同じく、ファイルごとの環境で実行し、returnしない場合は定義された関数を集める
+local function load_filters(path)
+  local env = setmetatable({ PANDOC_SCRIPT_FILE = path }, { __index = _G })
+  local chunk, err = loadfile(path, 'bt', env)
+  if not chunk then
+    error('naist-filterchain: cannot load ' .. path .. ': ' .. tostring(err))
+  end
+  -- require("utilsapa")などをフィルターと同じディレクトリから読み込む
+  local old_path = package.path
+  package.path = pandoc.path.directory(path) .. '/?.lua;' .. package.path
+  local ok, result = pcall(chunk)
+  package.path = old_path
+  if not ok then
+    error(result, 0)
+  end
+  if type(result) ~= 'table' then
+    result = {}
+    for key, value in pairs(env) do
+      if ORDER[key] and type(value) == 'function' then
+        result[key] = value
+      end
+    end
+    result.traverse = rawget(env, 'traverse')
+  end
+  -- 1つのフィルター（関数の表）か、フィルターのリストか
+  if result[1] == nil then
+    result = { result }
+  end
+  local filters = {}
+  for _, filter in ipairs(result) do
+    if next(filter) ~= nil then
+      table.insert(filters, filter)
+    end
+  end
+  return filters
+end
+
+-- フィルターの関数の順位の集合。まとめられない場合はnil
+local function orders(filter)
+  local result = {}
+  for key, _ in pairs(filter) do
+    if key == 'traverse' then
+      if filter.traverse ~= 'typewise' then
+        return nil
+      end
+    elseif ORDER[key] then
+      result[ORDER[key]] = true
+    else
+      return nil
+    end
+  end
+  return result
+end
+
+-- group（orders）の後にfilterをまとめても、順に実行した場合と同じ結果になるか
+local function can_fuse(group, filter)
+  if group == nil or filter == nil then
+    return false
+  end
+  local highest, lowest = 0, PANDOC + 1
+  for order, _ in pairs(group) do
+    if order ~= PANDOC and order > highest then
+      highest = order
+    end
+  end
+  for order, _ in pairs(filter) do
+    if order < lowest then
+      lowest = order
+    end
+  end
+  if group[PANDOC] and lowest ~= PANDOC then
+    return false
+  end
+  return highest < lowest
+end
+
+local function walk(doc, filter)
+  -- Quartoの独自の要素も扱えるように、Quartoの走査があれば使う
+  if quarto and quarto._quarto and quarto._quarto.ast and quarto._quarto.ast.walk then
+    return quarto._quarto.ast.walk(doc, filter)
+  end
+  return doc:walk(filter)
+end
+
+-- 1つのフィルターを文書に適用する（Pandocと同じく要素、Meta、Pandocの順）
+local function apply(doc, filter)
+  local elements = {}
+  local has_elements = false
+  for key, value in pairs(filter) do
+    if key ~= 'Meta' and key ~= 'Pandoc' then
+      elements[key] = value
+      has_elements = has_elements or key ~= 'traverse'
+    end
+  end
+  if has_elements then
+    doc = walk(doc, elements) or doc
+  end
+  if filter.Meta then
+    local meta = filter.Meta(doc.meta)
+    if meta ~= nil then
+      doc.meta = meta
+    end
+  end
+  if filter.Pandoc then
+    local result = filter.Pandoc(doc)
+    if result ~= nil then
+      doc = result
+    end
+  end
+  return doc
+end
+
+-- 連続したフィルターのうち、まとめられるものを1つにする
+local function fuse(steps)
+  local fused = {}
+  local current = nil
+  for _, step in ipairs(steps) do
+    local step_orders = orders(step.filter)
+    if current and can_fuse(current.orders, step_orders) then
+      for key, value in pairs(step.filter) do
+        if key == 'Pandoc' and current.filter.Pandoc then
+          local first, second = current.filter.Pandoc, value
+          current.filter.Pandoc = function(doc)
+            doc = first(doc) or doc
+            return second(doc) or doc
+          end
+        elseif key ~= 'traverse' then
+          current.filter[key] = value
+        end
+      end
+      for order, _ in pairs(step_orders) do
+        current.orders[order] = true
+      end
+      current.name = current.name .. '+' .. step.name
+    else
+      current = { name = step.name, orders = step_orders, filter = {} }
+      for key, value in pairs(step.filter) do
+        current.filter[key] = value
+      end
+      table.insert(fused, current)
+    end
+  end
+  return fused
+end
+
+local function json_string(text)
+  return '"' .. text:gsub('[%c"\\]', function(c)
+    return string.format('\\u%04x', c:byte())
+  end) .. '"'
+end
+
+local function write_trace(name, start, seconds, fields)
+  local parts = {
+    '"name":' .. json_string(name),
+    '"ts":' .. string.format('%d', start),
+    '"dur":' .. string.format('%.6f', seconds),
+    '"pid":0',
+  }
+  local run = os.getenv('NAIST_TRACE_RUN')
+  if run then
+    table.insert(parts, '"run":' .. json_string(run))
+  end
+  for key, value in pairs(fields) do
+    local encoded = type(value) == 'number' and tostring(value) or json_string(tostring(value))
+    table.insert(parts, json_string(key) .. ':' .. encoded)
+  end
+  local file = io.open(os.getenv('NAIST_TRACE_FILE') or 'naist-trace.jsonl', 'a')
+  if file then
+    file:write('{' .. table.concat(parts, ',') .. '}\n')
+    file:close()
+  end
+end
+
+-- stepsを順に文書に適用する（NAIST_TRACE=1の場合は時間を記録する）
+local function run(stage, steps, doc)
+  local total = 0
+  for _, step in ipairs(steps) do
+    local start, clock = os.time(), os.clock()
+    doc = apply(doc, step.filter)
+    if tracing() then
+      local seconds = os.clock() - clock
+      total = total + seconds
+      write_trace('lua:' .. stage .. ':' .. step.name, start, seconds, { format = FORMAT })
+      io.stderr:write(string.format('  [lua %s] %-45s %8.1f ms\n', stage, step.name, seconds * 1000))
+    end
+  end
+  if tracing() then
+    io.stderr:write(string.format('  [lua %s] %d filter pass(es), %.1f ms in total\n', stage, #steps, total * 1000))
+  end
+  return doc
+end
+
+-- dirのfilesのフィルターを順に実行する1つのフィルターを返す
+function M.chain(stage, dir, files)
+  local steps = {}
+  for _, file in ipairs(files) do
+    local filters = load_filters(pandoc.path.join({ dir, file }))
+    for i, filter in ipairs(filters) do
+      table.insert(steps, { name = #filters > 1 and (file .. '#' .. i) or file, filter = filter })
+    end
+  end
+  if fusing() then
+    steps = fuse(steps)
+  end
+  return {
+    Pandoc = function(doc)
+      return run(stage, steps, doc)
+    end,
+  }
+end
+
+-- 1つのファイルのフィルターのリストの時間を記録する（NAIST_TRACE=1の場合のみ。naist-vars.luaなど）
+function M.profile(name, filters)
+  if not tracing() then
+    return filters
+  end
+  local steps = {}
+  for i, filter in ipairs(filters) do
+    table.insert(steps, { name = name .. '#' .. i, filter = filter })
+  end
+  return {
+    Pandoc = function(doc)
+      return run('filters', steps, doc)
+    end,
+  }
+end
+
+return M
@@ -1,5 +1,8 @@
 -- NAIST Quarto Extension: YAML変数を展開するLuaフィルター
--- partials/header.tex内の$variable-name$を展開して、include-in-headerに設定
+-- PDF（naist-pdf）・HTML・Wordで共通の展開エンジン
+-- - 変数の表（変数名→値）を文書ごとに1回だけ作る
+-- - partials/header.tex内の$variable-name$を展開して、include-in-headerに設定（LaTeXのみ）
+-- - 本文中の$variable-name$（数式・文字列・LaTeXのコード）を、各ノードにつき1回の走査で展開
 
 local function read_file(path)
   local file = io.open(path, "r")
@@ -21,6 +24,56 @@ local function write_file(path, content)
   return true
 end
 
+-- 変数の形式（$variable-name$）
+local VAR_PATTERN = '%$([%w%-]+)%$'
+
+-- 数式（$...$）を含むため、\\Utilizingのようなコマンドの除去を行わない変数
+local KEEP_COMMANDS = { ['keywords-japanese'] = true, ['keywords-english'] = true }
+
+-- 変数として扱わないトップレベルのキー
+local SKIP_KEYS = { ['format'] = true, ['bibliography'] = true }
+
+local MONTH_NAMES = {
+  'January', 'February', 'March', 'April', 'May', 'June',
+  'July', 'August', 'September', 'October', 'November', 'December'
+}
+
+-- naistbuildがフロントマターを解析した結果の保存先（scripts/pre-render.shが作成）
+-- paper.qmdは.naist-cache/vars.json、それ以外の文書は.naist-cache/vars-<文書名>.json
+local function shared_vars_path(input_file)
+  local name = input_file:match('([^/\\]+)%.[^./\\]*$') or input_file
+  if name == 'paper' then
+    return ".naist-cache/vars.json"
+  end
+  return ".naist-cache/vars-" .. name .. ".json"
+end
+
+-- .naist-cache/vars.jsonの変数を読み込む関数
+-- フロントマターのハッシュが一致しない場合（古い場合）や読み込めない場合はnilを返す
+local function load_shared_vars()
+  if not (pandoc.json and pandoc.utils and pandoc.utils.sha1) then
+    return nil
+  end
+  local input_file = (quarto and quarto.doc and quarto.doc.input_file) or "paper.qmd"
+  local content = read_file(shared_vars_path(input_file))
+  if not content then
+    return nil
+  end
+  local ok, data = pcall(pandoc.json.decode, content, false)
+  if not ok or type(data) ~= 'table' or type(data.vars) ~= 'table' then
+    return nil
+  end
+  local qmd_content = read_file(input_file)
+  if not qmd_content then
+    return nil
+  end
+  local front_matter = qmd_content:match('^%-%-%-\n(.-)\n%-%-%-')
+  if not front_matter or pandoc.utils.sha1(front_matter) ~= data['front-matter-sha1'] then
+    return nil
+  end
+  return data.vars
+end
+
 -- PandocのAST形式をプレーンテキストに変換する関数（数式を$...$形式で保持）
 local function ast_to_text(ast)
   if type(ast) == 'string' then
@@ -74,89 +127,124 @@ local function ast_to_text(ast)
   return tostring(ast)
 end
 
--- 変数を展開する関数
-local function expand_vars(text, meta)
-  if not text then return text end
-  
-  -- メタデータから値を取得するヘルパー関数
-  local function get_meta_value(key)
-    local value = meta[key]
-    if value == nil then
-      return nil
+-- Pandocのメタデータから変数の値を求める関数
+local function meta_value(value)
+  -- pandoc.utils.stringifyを使用（利用可能な場合）
+  if pandoc and pandoc.utils and pandoc.utils.stringify then
+    local result = pandoc.utils.stringify(value)
+    -- エスケープされた$を元に戻す（\$を$に）
+    result = result:gsub('\\%$', '$')
+    -- 既に$...$で囲まれている数式を保護
+    local protected = {}
+    local protected_count = 0
+    result = result:gsub('%$([^$]+)%$', function(math_content)
+      protected_count = protected_count + 1
+      local placeholder = '__PROTECTED_MATH_' .. protected_count .. '__'
+      protected[placeholder] = '$' .. math_content .. '$'
+      return placeholder
+    end)
+    -- 保護されていない\コマンドを$...$で囲む（\\piを$\pi$に変換）
+    result = result:gsub('\\\\([a-zA-Z]+)', function(cmd)
+      return '$\\' .. cmd .. '$'
+    end)
+    -- 保護された数式を元に戻す
+    for placeholder, original in pairs(protected) do
+      result = result:gsub(placeholder, original)
     end
-    -- pandoc.utils.stringifyを使用（利用可能な場合）
-    if pandoc and pandoc.utils and pandoc.utils.stringify then
-      local result = pandoc.utils.stringify(value)
-      -- エスケープされた$を元に戻す（\$を$に）
-      result = result:gsub('\\%$', '$')
-      -- 既に$...$で囲まれている数式を保護
-      local protected = {}
-      local protected_count = 0
-      result = result:gsub('%$([^$]+)%$', function(math_content)
-        protected_count = protected_count + 1
-        local placeholder = '__PROTECTED_MATH_' .. protected_count .. '__'
-        protected[placeholder] = '$' .. math_content .. '$'
-        return placeholder
-      end)
-      -- 保護されていない\コマンドを$...$で囲む（\\piを$\pi$に変換）
-      result = result:gsub('\\\\([a-zA-Z]+)', function(cmd)
-        return '$\\' .. cmd .. '$'
-      end)
-      -- 保護された数式を元に戻す
-      for placeholder, original in pairs(protected) do
-        result = result:gsub(placeholder, original)
+    -- 二重に囲まれた$を修正（$$...$$を$...$に）
+    result = result:gsub('\\$\\$([^$]+)\\$\\$', '$%1$')
+    return result
+  end
+  -- フォールバック: 手動で変換
+  return ast_to_text(value)
+end
+
+-- 変数の表（変数名→値）を作る関数。文書ごとに1回だけ呼ぶ
+-- sharedが指定された場合（.naist-cache/vars.json）は、Pandocのメタデータの代わりにその値を使う
+local function build_vars(meta, shared)
+  local vars = {}
+  if shared then
+    -- LaTeX用に整形済みの値（数式のエスケープなどはnaistbuildで処理済み）
+    for key, value in pairs(shared) do
+      if type(value) == 'string' then
+        vars[key] = value
+      end
+    end
+  else
+    for key, value in pairs(meta) do
+      local kind = pandoc.utils.type and pandoc.utils.type(value) or type(value)
+      if not SKIP_KEYS[key] and kind ~= 'List' and kind ~= 'table' then
+        local var_value = meta_value(value)
+        -- keywords-japaneseとkeywords-englishの場合は、既に$...$で囲まれている数式を保持
+        -- その他の変数の場合のみ、LaTeXの特殊文字をエスケープ
+        if not KEEP_COMMANDS[key] then
+          -- \\\\Utilizing のような二重エスケープを単純なテキストに変換（改行を削除）
+          var_value = var_value:gsub('\\\\\\\\([A-Z][a-z]+)', '%1')
+          -- 単一のバックスラッシュ+大文字をエスケープ（LaTeXコマンドとして解釈されないように）
+          var_value = var_value:gsub('\\([A-Z][a-z]+)', '%1')
+        end
+        vars[key] = var_value
       end
-      -- 二重に囲まれた$を修正（$$...$$を$...$に）
-      result = result:gsub('\\$\\$([^$]+)\\$\\$', '$%1$')
-      return result
     end
-    -- フォールバック: 手動で変換
-    return ast_to_text(value)
   end
-  
-  -- $variable-name$形式を探して置換
-  local result = text:gsub('%$([%w%-]+)%$', function(var_name)
-    if var_name == 'edatestr-placeholder' then
-      return '$edatestr-placeholder$'
+
+  -- \edatestr（例: February 20, 2025）。求められない場合はプレースホルダーのまま残す
+  local month_num = tonumber(vars['submission-month'])
+  local day = vars['submission-day']
+  local year = vars['english-year']
+  if month_num and MONTH_NAMES[month_num] and day and year then
+    vars['edatestr-placeholder'] = MONTH_NAMES[month_num] .. ' ' .. day .. ', ' .. year
+  else
+    vars['edatestr-placeholder'] = '$edatestr-placeholder$'
+  end
+  return vars
+end
+
+-- 文字列中の$variable-name$を1回の走査で展開する関数
+-- keep_unknownがtrueの場合は表にない変数をそのまま残し、それ以外の場合は空文字列にする
+local function expand_text(text, vars, keep_unknown)
+  if not text:find('$', 1, true) then
+    return text
+  end
+  return (text:gsub(VAR_PATTERN, function(var_name)
+    local value = vars[var_name]
+    if value then
+      return value
     end
-    local var_value = get_meta_value(var_name)
-    if var_value then
-      -- keywords-japaneseとkeywords-englishの場合は、既に$...$で囲まれている数式を保持
-      -- その他の変数の場合のみ、LaTeXの特殊文字をエスケープ
-      if var_name ~= 'keywords-japanese' and var_name ~= 'keywords-english' then
-        -- \\\\Utilizing のような二重エスケープを単純なテキストに変換（改行を削除）
-        var_value = var_value:gsub('\\\\\\\\([A-Z][a-z]+)', '%1')
-        -- 単一のバックスラッシュ+大文字をエスケープ（LaTeXコマンドとして解釈されないように）
-        var_value = var_value:gsub('\\([A-Z][a-z]+)', '%1')
-      end
-      return var_value
+    if keep_unknown then
+      return nil
     end
     -- 変数が見つからない場合は空文字列を返す
     return ''
-  end)
-  
-  -- \edatestr-placeholderを処理
-  local month = get_meta_value('submission-month')
-  local day = get_meta_value('submission-day')
-  local year = get_meta_value('english-year')
-  
-  if month and day and year then
-    local month_names = {
-      'January', 'February', 'March', 'April', 'May', 'June',
-      'July', 'August', 'September', 'October', 'November', 'December'
-    }
-    local month_num = tonumber(month)
-    if month_num and month_num >= 1 and month_num <= 12 then
-      local edatestr = month_names[month_num] .. ' ' .. day .. ', ' .. year
-      result = result:gsub('%$edatestr%-placeholder%$', edatestr)
-    end
+  end))
+end
+
+-- 文書の変数の表（最初のフィルターのMetaで作る）
+local vars = nil
+-- 出力形式がLaTeX（naist-pdf）かどうか
+local is_latex = FORMAT:match('latex') ~= nil or FORMAT == 'beamer'
+-- 変数の値を変換したインライン要素（変数ごとに1回だけ変換する）
+local inline_cache = {}
+
+-- 変数の値を出力形式に応じたインライン要素に変換する関数
+-- LaTeXはそのまま埋め込み、HTML・Wordは$\pi$などの数式を含むMarkdownとして読み込む
+local function value_inlines(var_name)
+  local inlines = inline_cache[var_name]
+  if inlines then
+    return inlines
   end
-  
-  return result
+  local value = vars[var_name]
+  if is_latex then
+    inlines = { pandoc.RawInline('latex', value) }
+  else
+    inlines = pandoc.utils.blocks_to_inlines(pandoc.read(value, 'markdown').blocks)
+  end
+  inline_cache[var_name] = inlines
+  return inlines
 end
 
--- Meta関数でheader.texを処理
-function Meta(meta)
+-- header.texを展開してinclude-in-headerに設定する関数（LaTeXのみ）
+local function expand_header(meta)
   -- header.texのパスを取得（拡張機能内のpartialsから）
   local header_path = "partials/header.tex"
   local header_content = read_file(header_path)
@@ -167,13 +255,13 @@ function Meta(meta)
     header_content = read_file(header_path)
   end
   
+  local temp_path = "_extensions/naist/partials/header-expanded.tex"
   if header_content then
-    -- 変数を展開
-    local expanded_content = expand_vars(header_content, meta)
+    -- 変数を展開（.naist-cache/vars.jsonが最新の場合はその値を使う）
+    local expanded_content = expand_text(header_content, vars, false)
     
-    -- 展開された内容を一時ファイルに保存
-    local temp_path = "_extensions/naist/partials/header-expanded.tex"
-    if write_file(temp_path, expanded_content) then
+    -- 展開された内容を一時ファイルに保存（内容が同じ場合は書き込まない）
+    if read_file(temp_path) == expanded_content or write_file(temp_path, expanded_content) then
       -- meta.formatの各フォーマットを更新
       if meta.format then
         for format_name, format_config in pairs(meta.format) do
@@ -196,9 +284,76 @@ function Meta(meta)
     end
   else
     -- header.texが見つからない場合は、空のheader-expanded.texを作成
-    local temp_path = "_extensions/naist/partials/header-expanded.tex"
     write_file(temp_path, "% Header file not found. Please check header.tex\n")
   end
-  
+end
+
+-- Meta関数で変数の表を作り、header.texを処理
+local function Meta(meta)
+  vars = build_vars(meta, load_shared_vars())
+  if is_latex then
+    expand_header(meta)
+  end
   return meta
 end
+
+-- 本文の$variable-name$（Markdownでは数式として読み込まれる）を変数の値に置き換える
+local function Math(el)
+  if el.mathtype == 'InlineMath' and vars and vars[el.text] then
+    return value_inlines(el.text)
+  end
+end
+
+-- 数式として読み込まれなかった$variable-name$（文字列の一部）を置き換える
+local function Str(el)
+  local text = el.text
+  if not vars or not text:find('$', 1, true) then
+    return nil
+  end
+  local result = {}
+  local last = 1
+  for start, var_name, stop in text:gmatch('()' .. VAR_PATTERN .. '()') do
+    if vars[var_name] then
+      if start > last then
+        table.insert(result, pandoc.Str(text:sub(last, start - 1)))
+      end
+      for _, inline in ipairs(value_inlines(var_name)) do
+        table.insert(result, inline)
+      end
+      last = stop
+    end
+  end
+  if last == 1 then
+    return nil
+  end
+  if last <= #text then
+    table.insert(result, pandoc.Str(text:sub(last)))
+  end
+  return result
+end
+
+-- LaTeXのコード（```{=latex}など）の$variable-name$を置き換える（LaTeXのみ）
+local function Raw(el)
+  if not (vars and is_latex and (el.format == 'latex' or el.format == 'tex')) then
+    return nil
+  end
+  local text = expand_text(el.text, vars, true)
+  if text ~= el.text then
+    el.text = text
+    return el
+  end
+end
+
+-- Pandocは1つのフィルターの中ではインライン要素をMetaより先に処理するため、
+-- 変数の表を作るMetaと本文の置換を別のフィルターとして順に実行する
+local filters = {
+  { Meta = Meta },
+  { Math = Math, Str = Str, RawInline = Raw, RawBlock = Raw },
+}
+
+-- NAIST_TRACE=1の場合は、apaquartoのフィルターと同じく各フィルターの時間を記録する
+if os.getenv('NAIST_TRACE') == '1' then
+  local dir = pandoc.path.directory((debug.getinfo(1, 'S').source:gsub('^@', '')))
+  return dofile(pandoc.path.join({ dir, 'naist-filterchain.lua' })).profile('naist-vars.lua', filters)
+end
+return filters
@@ -5,6 +5,8 @@
 import sys
 import os
 
+from naistbuild import fixups, pipeline, streaming
+
 if len(sys.argv) < 2:
     print("Usage: add_before_body.py <tex_file>")
     sys.exit(1)
@@ -16,31 +18,19 @@ script_dir = os.path.dirname(os.path.abspath(__file__))
 project_root = os.path.dirname(script_dir)
 before_body_file = os.path.join(project_root, 'template', 'before-body.tex')
 
-# template/before-body.texの内容を読み込む
 if not os.path.exists(before_body_file):
     print(f"Error: {before_body_file} not found")
     sys.exit(1)
 
-with open(before_body_file, 'r', encoding='utf-8') as f:
-    before_body_content = f.read()
-
 # TeXファイルを読み込む
 with open(tex_file, 'r', encoding='utf-8') as f:
     tex_content = f.read()
 
 # \begin{document}の後にbefore-bodyの内容を挿入（まだ含まれていない場合）
-if '\\titlepage' not in tex_content and '\\cmemberspage' not in tex_content:
-    # \begin{document}の後に挿入
-    tex_content = tex_content.replace(
-        '\\begin{document}',
-        f'\\begin{{document}}\n% NAIST修士論文用LaTeX before-body（手動追加）\n{before_body_content}'
-    )
-    
-    # 変更を保存
-    with open(tex_file, 'w', encoding='utf-8') as f:
-        f.write(tex_content)
-    
-    print("✓ Added template/before-body.tex to TeX file")
+context = pipeline.PostRenderContext(tex_file, project_root)
+new_content = fixups.add_before_body(tex_content, context)
+if new_content != tex_content:
+    # 変更を保存（一時ファイルに書いてから置き換える）
+    streaming.write_if_changed(tex_file, new_content)
 else:
     print("✓ template/before-body.tex already included")
-
@@ -0,0 +1,5 @@
+"""
+NAIST修士論文テンプレートのビルド用モジュール
+
+scripts/以下の後処理スクリプトから共通して使用する。
+"""
@@ -0,0 +1,263 @@
+"""
+naistbuildのコマンドラインエントリーポイント
+
+使用例（プロジェクトルートから）:
+    PYTHONPATH=scripts python3 -m naistbuild vars paper.qmd
+    PYTHONPATH=scripts python3 -m naistbuild wait _output/paper.tex paper.tex --newer-than paper.qmd
+    PYTHONPATH=scripts python3 -m naistbuild postprocess paper.tex
+    PYTHONPATH=scripts python3 -m naistbuild aux _output
+    PYTHONPATH=scripts python3 -m naistbuild latex _output/paper.tex
+    PYTHONPATH=scripts python3 -m naistbuild latex --incremental _output/paper.tex
+    NAIST_BUILD_DIR=1 PYTHONPATH=scripts python3 -m naistbuild builddir stage paper.tex
+    PYTHONPATH=scripts python3 -m naistbuild compact paper.pdf --dpi 200
+    PYTHONPATH=scripts python3 -m naistbuild cache restore latex _output/paper.tex
+    PYTHONPATH=scripts python3 -m naistbuild bench --sizes small,medium --compare old.json
+    PYTHONPATH=scripts python3 -m naistbuild --trace postprocess paper.tex
+    PYTHONPATH=scripts python3 -m naistbuild trace chrome
+    PYTHONPATH=scripts python3 -m naistbuild batch --jobs 8 --timeout 600 theses/*
+    PYTHONPATH=scripts python3 -m naistbuild watch
+    PYTHONPATH=scripts python3 -m naistbuild render
+    PYTHONPATH=scripts python3 -m naistbuild chunks clear tbl-descriptive
+"""
+import argparse
+import os
+import sys
+
+from . import (batch, bench, builddir, cache, chapters, chunkcache, compact, figures, frontmatter, latex, pipeline,
+               preamble, readiness, render, trace, watch)
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='naistbuild', description='NAIST修士論文テンプレートのビルド処理')
+    parser.add_argument('--trace', action='store_true',
+                        help=f'各段階の時間などを{trace.TRACE_FILE}に記録する（NAIST_TRACE=1と同じ）')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    vars_parser = subparsers.add_parser('vars', help='フロントマターを解析して.naist-cache/vars.jsonに保存する')
+    vars_parser.add_argument('qmd_files', nargs='*', default=[os.path.join(PROJECT_ROOT, 'paper.qmd')],
+                             help='paper.qmd、paper_html.qmdなど（フロントマターのないファイルは無視する）')
+
+    wait_parser = subparsers.add_parser('wait', help='QuartoがTeXファイルを書き終えるまで待ち、そのパスを表示する')
+    wait_parser.add_argument('candidates', nargs='+')
+    wait_parser.add_argument('--newer-than', help='このファイル（paper.qmdなど）より新しくなるまで待つ')
+    wait_parser.add_argument('--timeout', type=float, default=15.0)
+
+    postprocess_parser = subparsers.add_parser('postprocess', help='Quartoが生成したTeXファイルを後処理する')
+    postprocess_parser.add_argument('tex_file')
+    postprocess_parser.add_argument('--no-cache', action='store_true', help='ビルドキャッシュを使わずに後処理する')
+
+    aux_parser = subparsers.add_parser('aux', help='.toc、.lof、.lotファイルの?contents?などを置き換える')
+    aux_parser.add_argument('output_dir', nargs='?', default='.')
+
+    latex_parser = subparsers.add_parser('latex', help='出力が収束するまでxelatexとbiberを実行してPDFを生成する')
+    latex_parser.add_argument('tex_file')
+    latex_parser.add_argument('--max-passes', type=int, default=latex.MAX_PASSES)
+    latex_parser.add_argument('--incremental', action='store_true',
+                              help='変更した章だけをコンパイルしてpaper-incremental.pdfを生成する')
+
+    compact_parser = subparsers.add_parser('compact', help='提出用にPDFを小さくする（画像の縮小、オブジェクトストリーム）')
+    compact_parser.add_argument('pdf_file')
+    compact_parser.add_argument('--dpi', type=int, help=f'画像の解像度の上限（既定: NAIST_COMPACT_DPIまたは{figures.DEFAULT_DPI}）')
+    compact_parser.add_argument('--force', action='store_true', help='前回の結果を使わずに書き直す')
+
+    builddir_parser = subparsers.add_parser('builddir', help='ビルドディレクトリ（NAIST_BUILD_DIR）にTeXファイルを置き、PDFを公開する')
+    builddir_parser.add_argument('action', choices=['stage', 'publish'])
+    builddir_parser.add_argument('path', help='stageはQuartoが生成したTeXファイル、publishはビルドディレクトリのPDF')
+    builddir_parser.add_argument('dest', nargs='?', help='publishの公開先（既定: プロジェクトルートの同じ名前。'
+                                 '既定以外のビルドディレクトリの場合はpaper-<ディレクトリ名>.pdfのように名前を変える）')
+
+    cache_parser = subparsers.add_parser('cache', help='.naist-cacheのビルドキャッシュを操作する')
+    cache_parser.add_argument('action', choices=['restore', 'record', 'clear'])
+    cache_parser.add_argument('stage', nargs='?', choices=sorted(cache.STAGE_INPUTS), default='latex')
+    cache_parser.add_argument('tex_file', nargs='?', default='paper.tex')
+
+    bench_parser = subparsers.add_parser('bench', help='合成した論文プロジェクトで各段階の処理時間を測定する')
+    bench_parser.add_argument('--sizes', default='small,medium,large',
+                              help=f'測定する大きさ（カンマ区切り。{", ".join(bench.SIZES)}）')
+    bench_parser.add_argument('--repeat', type=int, default=3)
+    bench_parser.add_argument('--latex', action='store_true', help='xelatexとbiberの各実行も測定する')
+    bench_parser.add_argument('--output', default=bench.DEFAULT_OUTPUT, help='結果を保存するJSONファイル')
+    bench_parser.add_argument('--compare', help='比較する以前の結果のJSONファイル')
+    bench_parser.add_argument('--keep', help='合成プロジェクトを削除せずに残すディレクトリ')
+
+    trace_parser = subparsers.add_parser('trace', help=f'{trace.TRACE_FILE}の記録を表示・変換する')
+    trace_parser.add_argument('action', choices=['summary', 'chrome', 'clear', 'event'])
+    trace_parser.add_argument('name', nargs='?', help='eventで記録する段階名')
+    trace_parser.add_argument('--since', type=float, help='eventの開始時刻（UNIX時間）')
+    trace_parser.add_argument('--exit-code', type=int)
+    trace_parser.add_argument('--log', help='eventに記録するログファイルのパス')
+
+    batch_parser = subparsers.add_parser('batch', help='複数の論文プロジェクトを並行してビルドする')
+    batch_parser.add_argument('projects', nargs='*', help='プロジェクトのディレクトリ')
+    batch_parser.add_argument('--list', help='プロジェクトのディレクトリを1行に1つ書いたファイル')
+    batch_parser.add_argument('--jobs', '-j', type=int, help='同時に実行する数（既定: CPUの数）')
+    batch_parser.add_argument('--timeout', type=float, help='1つのプロジェクトの制限時間（秒）')
+    batch_parser.add_argument('--render', action='store_true',
+                              help='post-render.shの代わりにquarto renderを実行する（paper.texがない場合）')
+
+    render_parser = subparsers.add_parser('render', help='PDF・HTML・Wordを同時にレンダリングする')
+    render_parser.add_argument('formats', nargs='*',
+                               help=f"レンダリングする形式（{', '.join(entry[0] for entry in render.FORMATS)}。省略するとすべて）")
+    render_parser.add_argument('--timeout', type=float, help='1つの形式の制限時間（秒）')
+
+    chunks_parser = subparsers.add_parser('chunks', help='計算チャンクの結果のキャッシュを表示・削除する')
+    chunks_parser.add_argument('action', choices=['list', 'clear'])
+    chunks_parser.add_argument('labels', nargs='*', help='削除するチャンクのラベル（省略するとすべて）')
+    chunks_parser.add_argument('--document', help='文書（paper、paper_htmlなど）')
+    chunks_parser.add_argument('--format', dest='output_format', help='出力形式（latex、html、docxなど）')
+
+    watch_parser = subparsers.add_parser('watch', help='常駐してファイルの変更を監視し、必要な処理だけを行う')
+    watch_parser.add_argument('tex_file', nargs='?', default='paper.tex')
+    watch_parser.add_argument('--interval', type=float, default=watch.POLL_INTERVAL,
+                              help='ファイルの変更を確認する間隔（秒）')
+
+    args = parser.parse_args(argv)
+    if args.trace:
+        os.environ['NAIST_TRACE'] = '1'
+
+    if args.command == 'vars':
+        for qmd_file in args.qmd_files:
+            if not os.path.exists(qmd_file):
+                print(f"Error: {qmd_file} not found")
+                return 1
+            # 章の.qmdファイルなど、フロントマターのないファイルは変数を持たない
+            if len(args.qmd_files) > 1 and not frontmatter.read_front_matter(qmd_file):
+                continue
+            frontmatter.load_yaml_vars(qmd_file)
+    elif args.command == 'wait':
+        tex_file = readiness.wait_until_ready(args.candidates, args.newer_than, args.timeout)
+        if tex_file is None:
+            print(f"Warning: TeX file was not ready within {args.timeout:g} seconds", file=sys.stderr)
+            return 1
+        print(tex_file)
+    elif args.command == 'postprocess':
+        tex_file = pipeline.find_tex_file(args.tex_file)
+        if tex_file is None:
+            print(f"Error: TeX file not found: {args.tex_file}")
+            return 1
+        pipeline.postprocess(tex_file, PROJECT_ROOT, use_cache=not args.no_cache)
+    elif args.command == 'aux':
+        preamble.expand_aux_files(args.output_dir)
+    elif args.command == 'latex':
+        if args.incremental:
+            return 0 if chapters.build_incremental(args.tex_file) else 1
+        return 0 if latex.build_pdf(args.tex_file, max_passes=args.max_passes) else 1
+    elif args.command == 'compact':
+        if not os.path.exists(args.pdf_file):
+            print(f"Error: {args.pdf_file} not found")
+            return 1
+        return 0 if compact.compact_pdf(args.pdf_file, dpi=args.dpi, force=args.force) else 1
+    elif args.command == 'builddir':
+        return run_builddir(args)
+    elif args.command == 'cache':
+        return run_cache(args)
+    elif args.command == 'batch':
+        projects = list(args.projects)
+        if args.list:
+            with open(args.list, 'r', encoding='utf-8') as f:
+                projects.extend(line.strip() for line in f if line.strip() and not line.startswith('#'))
+        if not projects:
+            print("Error: no project directories given")
+            return 1
+        return 0 if batch.run_batch(projects, jobs=args.jobs, timeout=args.timeout, render=args.render) else 1
+    elif args.command == 'render':
+        unknown = [name for name in args.formats if name not in [entry[0] for entry in render.FORMATS]]
+        if unknown:
+            print(f"Error: unknown format(s): {', '.join(unknown)}")
+            return 1
+        return 0 if render.render_all(PROJECT_ROOT, args.formats, timeout=args.timeout) else 1
+    elif args.command == 'chunks':
+        if args.action == 'list':
+            chunkcache.list_chunks(PROJECT_ROOT, args.document, args.output_format)
+        else:
+            count = chunkcache.clear_chunks(PROJECT_ROOT, args.labels, args.document, args.output_format)
+            print(f"✓ Removed {count} cached chunk(s) from {chunkcache.KNITR_DIR}")
+    elif args.command == 'watch':
+        return 0 if watch.watch(args.tex_file, PROJECT_ROOT, interval=args.interval) else 1
+    elif args.command == 'trace':
+        return run_trace(args)
+    elif args.command == 'bench':
+        sizes = [size.strip() for size in args.sizes.split(',') if size.strip()]
+        ok = bench.run_benchmark(PROJECT_ROOT, sizes, repeat=args.repeat, run_latex=args.latex,
+                                 output=args.output, compare=args.compare, keep_dir=args.keep)
+        return 0 if ok else 1
+    return 0
+
+
+def run_trace(args):
+    trace_file = trace.trace_file()
+    if args.action == 'event':
+        if not args.name or args.since is None:
+            print("Error: trace event requires a name and --since")
+            return 1
+        trace.record_event(args.name, args.since, exit_code=args.exit_code, log=args.log)
+        return 0
+    if args.action == 'clear':
+        if os.path.exists(trace_file):
+            os.remove(trace_file)
+        print(f"✓ Cleared {trace_file}")
+        return 0
+    if not os.path.exists(trace_file):
+        print(f"Error: {trace_file} not found. Run the build with NAIST_TRACE=1 first.")
+        return 1
+    if args.action == 'chrome':
+        output = trace.write_chrome()
+        print(f"✓ Wrote {output} (open it in chrome://tracing or https://ui.perfetto.dev)")
+        return 0
+    for name, (total, count) in trace.summary(trace.read_events()):
+        print(f"  {name:<45} {total * 1000:10.1f} ms  ({count}x)")
+    return 0
+
+
+def run_builddir(args):
+    if args.action == 'stage':
+        directory = builddir.build_dir()
+        if directory is None:
+            print("Error: NAIST_BUILD_DIR is not set", file=sys.stderr)
+            return 1
+        print(os.path.relpath(builddir.stage(args.path, directory)))
+        return 0
+    if not os.path.exists(args.path):
+        print(f"Error: {args.path} not found")
+        return 1
+    dest = args.dest or os.path.join(PROJECT_ROOT, os.path.basename(args.path))
+    dest = os.path.join(os.path.dirname(dest), builddir.published_name(os.path.basename(dest)))
+    if builddir.publish(args.path, dest):
+        print(f"✓ Published {args.path} as {os.path.relpath(dest, PROJECT_ROOT)}")
+    return 0
+
+
+def run_cache(args):
+    """restoreは入力が前回と同じ場合に出力を戻して0を、それ以外は1を返す"""
+    with trace.span(f'cache:{args.action}', stage=args.stage) as record:
+        record['exit_code'] = _run_cache(args)
+        return record['exit_code']
+
+
+def _run_cache(args):
+    build_cache = cache.BuildCache(PROJECT_ROOT)
+    if args.action == 'clear':
+        build_cache.clear()
+        print(f"✓ Cleared the build cache in {cache.CACHE_DIR} (chunk outputs are kept)")
+        return 0
+    if not cache.enabled() or not os.path.exists(args.tex_file):
+        return 1
+    output_dir = os.path.dirname(args.tex_file) or '.'
+    inputs = build_cache.stage_inputs(args.stage, args.tex_file)
+    if args.action == 'record':
+        build_cache.record(args.stage, inputs, output_dir)
+        print(f"✓ Recorded {args.stage} outputs in {cache.CACHE_DIR}")
+        return 0
+    if not build_cache.is_fresh(args.stage, inputs):
+        # 記録したファイルのハッシュ（サイズ・更新時刻）を次回のために保存
+        build_cache.save()
+        return 1
+    restored = build_cache.restore(args.stage, output_dir)
+    print(f"✓ Inputs unchanged. Reused cached {', '.join(restored)}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+"""
+複数の論文プロジェクトの一括ビルド
+
+提出時期に研究室や事務が多数の論文をまとめてビルドするためのもの。各プロジェクトの
+scripts/post-render.sh（--renderの場合はquarto render）を、最大jobs個のプロセスで
+並行して実行し、プロジェクトごとの結果と所要時間を表にして表示する。時間内に
+終わらないジョブは、xelatexなどの子プロセスも含めて終了させる。
+"""
+import concurrent.futures
+import os
+import signal
+import subprocess
+import sys
+import time
+
+# 各プロジェクトのログ（プロジェクトルートから）
+LOG_FILE = os.path.join('.naist-cache', 'batch.log')
+
+# 呼び出し元のpost-render.shから引き継がないようにする環境変数
+ISOLATED_ENV = ['NAIST_POST_RENDER_LOG', 'NAIST_POST_RENDER_LOCKED', 'NAIST_TRACE_RUN', 'NAIST_TRACE_FILE',
+                'TEXINPUTS']
+
+
+class BatchResult:
+    """1つのプロジェクトのビルド結果"""
+
+    def __init__(self, project, status, seconds, detail=''):
+        self.project = project
+        self.status = status
+        self.seconds = seconds
+        self.detail = detail
+
+
+def job_command(project, render):
+    if render:
+        # PDFはpost-render.shが生成するため、QuartoにはTeXファイルだけを生成させる
+        return ['quarto', 'render', 'paper.qmd', '--to', 'naist-latex']
+    return ['bash', os.path.join('scripts', 'post-render.sh')]
+
+
+def check_project(project, render):
+    """ビルドできないプロジェクトの場合は理由を返す"""
+    if not os.path.isdir(project):
+        return 'directory not found'
+    if not os.path.exists(os.path.join(project, 'scripts', 'post-render.sh')):
+        return 'scripts/post-render.sh not found'
+    if not render and not os.path.exists(os.path.join(project, 'paper.tex')):
+        return 'paper.tex not found (use --render)'
+    return None
+
+
+def run_job(project, render=False, timeout=None):
+    """1つのプロジェクトをビルドし、BatchResultを返す（プロセスプールのワーカーから呼ばれる）"""
+    start = time.monotonic()
+    started_at = time.time()
+    problem = check_project(project, render)
+    if problem:
+        return BatchResult(project, 'skipped', 0.0, problem)
+    env = {key: value for key, value in os.environ.items() if key not in ISOLATED_ENV}
+    log_file = os.path.join(project, LOG_FILE)
+    os.makedirs(os.path.dirname(log_file), exist_ok=True)
+    with open(log_file, 'w', encoding='utf-8') as log:
+        try:
+            # 新しいセッションで起動し、タイムアウト時にxelatexなどの子プロセスもまとめて終了させる
+            process = subprocess.Popen(job_command(project, render), cwd=project, env=env, stdout=log,
+                                       stderr=subprocess.STDOUT, start_new_session=True)
+        except FileNotFoundError as e:
+            return BatchResult(project, 'failed', 0.0, f'{e.filename} not found')
+        try:
+            returncode = process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGTERM)
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+            return BatchResult(project, 'timeout', time.monotonic() - start, f'see {LOG_FILE}')
+    seconds = time.monotonic() - start
+    if returncode != 0:
+        return BatchResult(project, 'failed', seconds, f'exit code {returncode}, see {LOG_FILE}')
+    with open(log_file, 'r', encoding='utf-8', errors='replace') as f:
+        log_text = f.read()
+    # post-render.shはxelatexが失敗しても0で終了するため、ログでも確認する
+    if '✗' in log_text:
+        return BatchResult(project, 'failed', seconds, f'errors in {LOG_FILE}')
+    pdf = os.path.join(project, 'paper.pdf')
+    if not os.path.exists(pdf):
+        return BatchResult(project, 'failed', seconds, 'no paper.pdf')
+    # 前回のビルドのpaper.pdfが残っているだけの場合を成功としない
+    # （入力が同じでキャッシュしたPDFを再利用した場合は、内容が同じため更新時刻が変わらない）
+    if os.path.getmtime(pdf) < started_at and 'Reused cached PDF' not in log_text:
+        return BatchResult(project, 'failed', seconds, f'paper.pdf was not updated, see {LOG_FILE}')
+    return BatchResult(project, 'ok', seconds, f'{os.path.getsize(pdf) / 1024:.0f} KiB')
+
+
+def print_summary(results, elapsed, stream=None, label='project'):
+    """プロジェクト（render.pyの場合は形式）ごとの結果と所要時間の表を表示する"""
+    stream = stream if stream is not None else sys.stdout
+    width = max([len(label)] + [len(result.project) for result in results])
+    print(f"\n{label:<{width}}  {'status':<8} {'time':>9}  detail", file=stream)
+    print('-' * (width + 32), file=stream)
+    for result in results:
+        print(f"{result.project:<{width}}  {result.status:<8} {result.seconds:8.1f}s  {result.detail}", file=stream)
+    total = sum(result.seconds for result in results)
+    ok = sum(1 for result in results if result.status == 'ok')
+    print(f"\n{ok}/{len(results)} {label}(s) built in {elapsed:.1f}s wall time "
+          f"({total:.1f}s total build time)", file=stream)
+
+
+def run_batch(projects, jobs=None, timeout=None, render=False):
+    """プロジェクトを並行してビルドし、すべて成功した場合Trueを返す"""
+    jobs = jobs or os.cpu_count() or 1
+    projects = list(dict.fromkeys(os.path.abspath(project) for project in projects))
+    print(f"Building {len(projects)} project(s) with {jobs} worker(s)"
+          + (f", timeout {timeout:g}s per project" if timeout else '') + '...')
+    start = time.monotonic()
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(run_job, project, render, timeout): project for project in projects}
+        for future in concurrent.futures.as_completed(futures):
+            project = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = BatchResult(project, 'failed', 0.0, f'{type(e).__name__}: {e}')
+            mark = '✓' if result.status == 'ok' else '✗'
+            print(f"  {mark} {os.path.relpath(project)}: {result.status} ({result.seconds:.1f}s)")
+            results[project] = result
+    # 表は指定された順に表示する
+    ordered = [results[project] for project in projects]
+    for result in ordered:
+        result.project = os.path.relpath(result.project)
+    print_summary(ordered, time.monotonic() - start)
+    return all(result.status == 'ok' for result in ordered)
@@ -0,0 +1,353 @@
+"""
+合成した論文プロジェクトによるビルド処理のベンチマーク
+
+このテンプレートから章・段落（ページ）・審査委員・文献・図の数を変えた合成プロジェクトを
+作成し、フロントマターの解析、fixups.pyの各修正、YAML変数の展開（expand_preamble）、
+後処理全体、xelatex・biberの各実行の時間を段階ごとに測定する。結果はJSONファイルに
+保存し、--compareで別のコミットの結果と比較できる。
+"""
+import contextlib
+import io
+import json
+import os
+import platform
+import re
+import shutil
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+from . import fixups, frontmatter, latex, pipeline, preamble
+
+RESULTS_VERSION = 1
+DEFAULT_OUTPUT = 'bench-results.json'
+
+# 合成プロジェクトの大きさ（paragraphsは1章あたりの段落数。約3段落で1ページ）
+SIZES = {
+    'small': {'chapters': 5, 'paragraphs': 20, 'members': 3, 'references': 50, 'figures': 5},
+    'medium': {'chapters': 10, 'paragraphs': 60, 'members': 4, 'references': 300, 'figures': 30},
+    'large': {'chapters': 20, 'paragraphs': 150, 'members': 5, 'references': 1000, 'figures': 100},
+    'xlarge': {'chapters': 40, 'paragraphs': 300, 'members': 6, 'references': 3000, 'figures': 300},
+}
+
+# 審査委員の4〜6人目（paper.qmdではコメントアウトされている）
+EXTRA_MEMBERS = ['fourth', 'fifth', 'sixth']
+
+# Quartoが生成するTeXファイルのうち、ヘッダー（header.tex）以外の部分
+QUARTO_HEAD = r'''% Options for packages loaded elsewhere
+\PassOptionsToPackage{unicode}{hyperref}
+\PassOptionsToPackage{hyphens}{url}
+\PassOptionsToPackage{dvipsnames,svgnames,x11names}{xcolor}
+%
+\documentclass[
+  xelatex,
+  ja=standard,
+  12pt,
+  a4paper]{bxjsarticle}
+
+\usepackage{amsmath,amssymb}
+\usepackage{iftex}
+\usepackage{unicode-math}
+\usepackage{graphicx}
+\makeatletter
+\def\fps@figure{htbp}
+\makeatother
+\setlength{\emergencystretch}{3em} % prevent overfull lines
+\setcounter{secnumdepth}{3}
+'''
+
+QUARTO_TAIL = r'''\usepackage{booktabs}
+\usepackage{caption}
+\AtBeginDocument{%
+\renewcommand*\figurename{Figure}
+\renewcommand*\tablename{Table}
+}
+\usepackage[style=template/jpa,backend=biber]{biblatex}
+\addbibresource{references/synthetic.bib}
+\usepackage{bookmark}
+\hypersetup{
+  pdftitle={<title>},
+  pdfauthor={<author>},
+  pdflang={en},
+  colorlinks=true,
+  pdfcreator={LaTeX via pandoc}}
+
+\title{<title>}
+\author{<author>}
+\date{2025-01-01}
+
+\begin{document}
+\maketitle
+
+'''
+
+PARAGRAPH = ('合成した段落です。テンプレートの後処理とLaTeXの処理時間を測定するための文章であり、'
+             '内容に意味はありません。This is a synthetic paragraph for benchmarking. ')
+
+
+def png_bytes(width, height, seed):
+    """グレースケールの小さなPNG画像を作る"""
+    rows = b''.join(b'\x00' + bytes((seed * 31 + x * 3 + y * 5) % 256 for x in range(width))
+                    for y in range(height))
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b'')
+
+
+def synthetic_front_matter(project_root, members):
+    """paper.qmdのフロントマターで、審査委員をmembers人（3〜6）にしたものを返す"""
+    front_matter = frontmatter.read_front_matter(os.path.join(project_root, 'paper.qmd'))
+    for key in EXTRA_MEMBERS[:max(0, members - 3)]:
+        front_matter = re.sub(rf'^#({key}-(?:member|position):)', r'\1', front_matter, flags=re.MULTILINE)
+    # 文献は合成した.bibファイルのみ
+    front_matter = re.sub(r'^bibliography:.*?(?=^\S)', 'bibliography: references/synthetic.bib\n',
+                          front_matter, flags=re.MULTILINE | re.DOTALL)
+    return front_matter
+
+
+def bib_entries(count):
+    return ''.join(f'@article{{Synthetic{i:05d},\n'
+                   f'  author = {{Author{i}, Taro and Coauthor{i % 17}, Hanako}},\n'
+                   f'  title = {{Synthetic Reference Number {i}}},\n'
+                   f'  journal = {{Journal of Benchmarks}},\n'
+                   f'  year = {{{1950 + i % 75}}},\n'
+                   f'  volume = {{{i % 40 + 1}}},\n'
+                   f'  pages = {{{i}--{i + 10}}}\n}}\n\n' for i in range(count))
+
+
+def chapter_sources(params):
+    """各章の.qmd（Markdown）と、Quartoが生成するTeXの本文を返す"""
+    qmd_chapters = []
+    tex_chapters = []
+    figure = 0
+    for chapter in range(params['chapters']):
+        label = f'sec-chapter{chapter:02d}'
+        qmd = [f'# 第{chapter + 1}章 {{#{label}}}\n\n']
+        tex = [f'\\section{{第{chapter + 1}章}}\\label{{{label}}}\n\n']
+        # 図は各章に均等に割り当てる
+        figures = range(figure, (chapter + 1) * params['figures'] // params['chapters'])
+        figure = figures.stop
+        for paragraph in range(params['paragraphs']):
+            if paragraph and paragraph % 10 == 0:
+                qmd.append(f'## 節{paragraph // 10}\n\n')
+                tex.append(f'\\subsection{{節{paragraph // 10}}}\n\n')
+            key = f'Synthetic{(chapter * params["paragraphs"] + paragraph) % params["references"]:05d}'
+            qmd.append(PARAGRAPH * 3 + f'[@{key}]\n\n')
+            tex.append(PARAGRAPH * 3 + f'\\autocite{{{key}}}\n\n')
+        for index in figures:
+            name = f'figures/synthetic/fig{index:04d}.png'
+            qmd.append(f'![図{index}]({name}){{#fig-synthetic{index:04d}}}\n\n')
+            tex.append('\\begin{figure}\n\n'
+                       f'\\caption{{\\label{{fig-synthetic{index:04d}}}図{index}}}\n\n'
+                       '\\centering{\n\n'
+                       f'\\includegraphics[width=0.5\\linewidth]{{{name}}}\n\n'
+                       '}\n\n\\end{figure}%\n\n')
+        qmd_chapters.append(''.join(qmd))
+        tex_chapters.append(''.join(tex))
+    return qmd_chapters, tex_chapters
+
+
+def generate_project(project_root, dest, params):
+    """合成プロジェクトをdestに作成し、Quartoが生成する形式のTeXファイルのパスを返す"""
+    shutil.copytree(os.path.join(project_root, 'template'), os.path.join(dest, 'template'))
+    os.makedirs(os.path.join(dest, 'references'))
+    os.makedirs(os.path.join(dest, 'figures', 'synthetic'))
+
+    front_matter = synthetic_front_matter(project_root, params['members'])
+    qmd_chapters, tex_chapters = chapter_sources(params)
+    includes = ''
+    for index, text in enumerate(qmd_chapters):
+        name = f'{index + 1:02d}_chapter.qmd'
+        with open(os.path.join(dest, name), 'w', encoding='utf-8') as f:
+            f.write(text)
+        includes += f'{{{{< include {name} >}}}}\n\n'
+    with open(os.path.join(dest, 'paper.qmd'), 'w', encoding='utf-8') as f:
+        f.write(f'---\n{front_matter}\n---\n\n{includes}')
+    with open(os.path.join(dest, 'references', 'synthetic.bib'), 'w', encoding='utf-8') as f:
+        f.write(bib_entries(params['references']))
+    for index in range(params['figures']):
+        with open(os.path.join(dest, 'figures', 'synthetic', f'fig{index:04d}.png'), 'wb') as f:
+            f.write(png_bytes(32, 24, index))
+
+    with open(os.path.join(project_root, '_extensions', 'naist', 'partials', 'header.tex'), 'r', encoding='utf-8') as f:
+        header = f.read()
+    with open(os.path.join(project_root, '_extensions', 'naist', 'partials', 'before-body.tex'), 'r', encoding='utf-8') as f:
+        before_body = f.read()
+    title = frontmatter.parse_front_matter(front_matter)[0].get('title', '')
+    tail = QUARTO_TAIL.replace('<title>', str(title)).replace('<author>', '合成　太郎')
+    tex_file = os.path.join(dest, 'paper.tex')
+    with open(tex_file, 'w', encoding='utf-8') as f:
+        f.write(QUARTO_HEAD + header + '\n' + tail + before_body + '\n' + ''.join(tex_chapters)
+                + '\\printbibliography[heading=none]\n\n\\end{document}\n')
+    return tex_file
+
+
+class TimedScheduler(latex.LatexScheduler):
+    """xelatex・biberの各実行の時間を記録するスケジューラ"""
+
+    def __init__(self, tex_file, timings, **kwargs):
+        super().__init__(tex_file, **kwargs)
+        self.timings = timings
+        self.counts = {}
+
+    def run(self, command, log_name):
+        self.counts[command[0]] = self.counts.get(command[0], 0) + 1
+        start = time.perf_counter()
+        try:
+            return super().run(command, log_name)
+        finally:
+            self.timings.append((f'latex:{command[0]}-{self.counts[command[0]]}', time.perf_counter() - start))
+
+
+def run_stages(tex_file, project_root, raw_content, run_latex):
+    """1回分の各段階を実行し、(段階名, 秒)のリストを返す"""
+    timings = []
+    stream = io.StringIO()
+
+    def timed(name, func, *args):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(stream), contextlib.redirect_stderr(stream):
+            result = func(*args)
+        timings.append((name, time.perf_counter() - start))
+        return result
+
+    front_matter = frontmatter.read_front_matter(os.path.join(project_root, 'paper.qmd'))
+    data = timed('frontmatter', lambda: frontmatter.parse_front_matter(front_matter)[0])
+    yaml_vars = timed('frontmatter:to_variables', frontmatter.to_variables, data)
+
+    # fixups.pyの各修正とYAML変数の展開（メモリ上のみ）
+    context = pipeline.PostRenderContext(tex_file, project_root, yaml_vars, stream=stream)
+    content = raw_content
+    for fixup in fixups.BEFORE_EXPAND:
+        content = timed(f'fixup:{fixup.__name__}', fixup, content, context)
+    content = timed('expand_preamble', pipeline.expand_preamble, content, context)
+    for fixup in fixups.AFTER_EXPAND:
+        content = timed(f'fixup:{fixup.__name__}', fixup, content, context)
+
+    # ファイルの読み書きを含む後処理全体（キャッシュなし・キャッシュあり）
+    with open(tex_file, 'w', encoding='utf-8') as f:
+        f.write(raw_content)
+    timed('postprocess', pipeline.postprocess, tex_file, project_root, stream, False)
+    with open(tex_file, 'w', encoding='utf-8') as f:
+        f.write(raw_content)
+    with contextlib.redirect_stdout(stream), contextlib.redirect_stderr(stream):
+        pipeline.postprocess(tex_file, project_root, stream, True)
+    timed('postprocess:cached', pipeline.postprocess, tex_file, project_root, stream, True)
+    timed('aux', preamble.expand_aux_files, os.path.dirname(tex_file))
+
+    if run_latex:
+        # 前回の補助ファイルを削除して、毎回同じ条件でコンパイルする
+        for ext in ['.aux', '.bbl', '.bcf', '.toc', '.lof', '.lot', '.pdf']:
+            with contextlib.suppress(OSError):
+                os.remove(os.path.splitext(tex_file)[0] + ext)
+        start = time.perf_counter()
+        ok = TimedScheduler(tex_file, timings, stream=stream).build()
+        timings.append(('latex', time.perf_counter() - start))
+        if not ok:
+            timings.append(('latex:failed', 0.0))
+    return timings
+
+
+def summarize(runs):
+    """各回の(段階名, 秒)のリストを、段階ごとの統計にまとめる"""
+    stages = {}
+    for timings in runs:
+        for name, seconds in timings:
+            stages.setdefault(name, []).append(seconds)
+    return {name: {'median': statistics.median(values), 'min': min(values), 'max': max(values),
+                   'runs': [round(value, 6) for value in values]}
+            for name, values in stages.items()}
+
+
+def git_commit(project_root):
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=project_root,
+                                capture_output=True, text=True)
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+def benchmark_size(project_root, size, params, repeat, run_latex, keep_dir=None):
+    """1つの大きさの合成プロジェクトを作成して測定し、結果の辞書を返す"""
+    dest = os.path.join(keep_dir, size) if keep_dir else tempfile.mkdtemp(prefix=f'naist-bench-{size}-')
+    if keep_dir:
+        shutil.rmtree(dest, ignore_errors=True)
+        os.makedirs(dest)
+    try:
+        start = time.perf_counter()
+        tex_file = generate_project(project_root, dest, params)
+        generate_seconds = time.perf_counter() - start
+        with open(tex_file, 'r', encoding='utf-8') as f:
+            raw_content = f.read()
+        # post-render.shと同じく、template/への参照を解決できるようにする
+        texinputs = os.environ.get('TEXINPUTS')
+        os.environ['TEXINPUTS'] = f'.:{dest}:{os.path.join(dest, "template")}:'
+        try:
+            runs = [run_stages(tex_file, dest, raw_content, run_latex) for _ in range(repeat)]
+        finally:
+            if texinputs is None:
+                del os.environ['TEXINPUTS']
+            else:
+                os.environ['TEXINPUTS'] = texinputs
+        return {'size': size, 'params': params, 'tex_bytes': len(raw_content.encode('utf-8')),
+                'generate_seconds': round(generate_seconds, 6), 'stages': summarize(runs)}
+    finally:
+        if not keep_dir:
+            shutil.rmtree(dest, ignore_errors=True)
+
+
+def print_table(results, baseline=None, stream=None):
+    """段階ごとの中央値（ミリ秒）の表を表示する。baselineがある場合は比率も表示する"""
+    stream = stream if stream is not None else sys.stdout
+    base = {entry['size']: entry['stages'] for entry in (baseline or {}).get('results', [])}
+    for entry in results:
+        print(f"\n{entry['size']} ({entry['tex_bytes'] / 1024:.0f} KiB TeX, "
+              + ', '.join(f'{k}={v}' for k, v in entry['params'].items()) + ')', file=stream)
+        for name, stats in entry['stages'].items():
+            line = f"  {name:<45} {stats['median'] * 1000:10.2f} ms"
+            old = base.get(entry['size'], {}).get(name)
+            if old and old['median'] > 0:
+                line += f"  ({stats['median'] / old['median']:.2f}x)"
+            print(line, file=stream)
+
+
+def run_benchmark(project_root, sizes, repeat=3, run_latex=False, output=DEFAULT_OUTPUT,
+                  compare=None, keep_dir=None):
+    """ベンチマークを実行して結果をoutputに保存する。成功した場合Trueを返す"""
+    unknown = [size for size in sizes if size not in SIZES]
+    if unknown:
+        print(f"Error: unknown size(s): {', '.join(unknown)} (choose from {', '.join(SIZES)})")
+        return False
+    if run_latex and shutil.which('xelatex') is None:
+        print("  ⚠ xelatex not found. Skipping LaTeX stages.")
+        run_latex = False
+
+    results = []
+    for size in sizes:
+        print(f"Benchmarking {size} ({repeat} run(s))...")
+        results.append(benchmark_size(project_root, size, SIZES[size], repeat, run_latex, keep_dir))
+
+    report = {'version': RESULTS_VERSION, 'commit': git_commit(project_root),
+              'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+              'python': platform.python_version(), 'platform': platform.platform(),
+              'repeat': repeat, 'latex': run_latex, 'results': results}
+    tmp_file = output + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_file, output)
+
+    baseline = None
+    if compare:
+        with open(compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_table(results, baseline)
+    print(f"\n✓ Wrote benchmark results to {output}")
+    return True
@@ -0,0 +1,225 @@
+"""
+引用した文献だけを渡すbiberの実行と、.bblのキャッシュ
+
+xelatexが書き出した.bcfから引用されたキーと文献ファイル（references/*.bib）を読み取り、
+引用された項目（とcrossrefなどで参照される項目、@string）だけの{jobname}-cited.bibを
+作成する。biberにはデータソースをこのファイルに置き換えた{jobname}-cited.bcfを渡す。
+
+作成した.bblは、引用キーの集合・使用した項目・スタイルファイル（template/*.bbxなど）・
+.bcfのオプションのハッシュをキーとして.naist-cache/bbl/に保存し、引用が変わって
+いない場合はbiberを実行せずに再利用する。
+"""
+import glob
+import hashlib
+import html
+import os
+import re
+import shutil
+
+from . import cache, streaming
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+BBL_CACHE_DIR = os.path.join(cache.CACHE_DIR, 'bbl')
+# 保存する.bblの数（古いものから削除する）
+BBL_CACHE_SIZE = 20
+
+# .bblの内容に影響するスタイルファイル（プロジェクトルートからのglobパターン）
+STYLE_FILES = ['template/*.bbx', 'template/*.cbx', 'template/*.dbx', 'template/*.lbx', 'template/*.cfg']
+
+CITEKEY = re.compile(r'<bcf:citekey\b[^>]*>([^<]*)</bcf:citekey>')
+DATASOURCE = re.compile(r'<bcf:datasource\b([^>]*)>([^<]*)</bcf:datasource>\s*')
+UNSORTED = re.compile(r'sortingtemplatename="none"')
+
+ENTRY_START = re.compile(r'@\s*([A-Za-z]+)\s*([{(])')
+# 他の項目を参照するフィールド（参照先も.bibに含める）
+REFERENCE_FIELD = re.compile(r'\b(?:crossref|xref|xdata|related|entryset)\s*=\s*[{"]([^}"]*)[}"]', re.IGNORECASE)
+# 常に含める項目
+KEEP_TYPES = ['string', 'preamble']
+
+
+def entry_end(text, start, opener):
+    """text[start]の開き括弧に対応する閉じ括弧の次の位置を返す。閉じていない場合はNone
+
+    BibTeXと同じく波括弧の数だけを数える（\\{や\\}もエスケープとして扱わない）。
+    """
+    closer = '}' if opener == '{' else ')'
+    depth = 0
+    pos = start + 1
+    while pos < len(text):
+        char = text[pos]
+        if char == '{':
+            depth += 1
+        elif char == '}':
+            if depth == 0 and closer == '}':
+                return pos + 1
+            depth -= 1
+        elif char == closer and depth == 0:
+            return pos + 1
+        pos += 1
+    return None
+
+
+def parse_bib(text):
+    """.bibの内容を(種類, キー, 項目の文字列)のリストにする。解析できない場合はNone"""
+    entries = []
+    pos = 0
+    while True:
+        match = ENTRY_START.search(text, pos)
+        if match is None:
+            return entries
+        end = entry_end(text, match.end() - 1, match.group(2))
+        if end is None:
+            return None
+        kind = match.group(1).lower()
+        body = text[match.end():end - 1]
+        key = body.split(',', 1)[0].strip() if kind not in KEEP_TYPES + ['comment'] else None
+        entries.append((kind, key, text[match.start():end]))
+        pos = end
+
+
+def read_bcf(bcf_text):
+    """.bcfから(引用キーのリスト、文献ファイルのリスト)を返す"""
+    keys = [html.unescape(key) for key in CITEKEY.findall(bcf_text)]
+    sources = [html.unescape(path) for attrs, path in DATASOURCE.findall(bcf_text)
+               if 'datatype="bibtex"' in attrs and 'type="file"' in attrs]
+    return keys, sources
+
+
+def find_source(path, output_dir):
+    """.bcfに書かれた文献ファイルを探す（output_dir、プロジェクトルート、BIBINPUTS、TEXINPUTSの順）"""
+    directories = [output_dir, PROJECT_ROOT]
+    for variable in ['BIBINPUTS', 'TEXINPUTS']:
+        directories.extend(d for d in os.environ.get(variable, '').split(os.pathsep) if d)
+    for directory in directories:
+        candidate = os.path.join(directory, path)
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def select_entries(entries, keys):
+    """引用キーと、それらがcrossrefなどで参照する項目を、文献ファイルの順に選ぶ"""
+    by_key = {}
+    by_folded = {}
+    for index, (_, key, raw) in enumerate(entries):
+        if key is None:
+            continue
+        # 同じキーが複数ある場合は最初のもの（biberと同じ）
+        by_key.setdefault(key, index)
+        by_folded.setdefault(key.casefold(), index)
+    selected = set()
+    pending = list(keys)
+    while pending:
+        key = pending.pop()
+        index = by_key.get(key, by_folded.get(key.casefold()))
+        if index is None or index in selected:
+            continue
+        selected.add(index)
+        for value in REFERENCE_FIELD.findall(entries[index][2]):
+            pending.extend(k.strip() for k in value.split(',') if k.strip())
+    return [raw for index, (kind, _, raw) in enumerate(entries) if kind in KEEP_TYPES or index in selected]
+
+
+def style_hash():
+    digest = hashlib.sha256()
+    for pattern in STYLE_FILES:
+        for path in sorted(glob.glob(os.path.join(PROJECT_ROOT, pattern))):
+            digest.update(os.path.basename(path).encode('utf-8'))
+            with open(path, 'rb') as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+class BiberPlan:
+    """1回のbiberの実行（引用した文献だけの.bibの作成と.bblのキャッシュ）"""
+
+    def __init__(self, output_dir, jobname):
+        self.output_dir = output_dir
+        self.jobname = jobname
+        self.bbl_file = os.path.join(output_dir, jobname + '.bbl')
+        self.cache_key = None
+        self.command = ['biber', jobname]
+        self.summary = 'full bibliography'
+
+    def prepare(self):
+        """引用した文献だけの.bibと.bcfを作成する。作成できない場合は通常のbiberの実行になる"""
+        with open(os.path.join(self.output_dir, self.jobname + '.bcf'), 'r', encoding='utf-8') as f:
+            bcf_text = f.read()
+        keys, sources = read_bcf(bcf_text)
+        if '*' in keys or not sources:
+            # \nocite{*}の場合はすべての項目が必要
+            return
+        # すべての文献ファイルの項目を連結してから選ぶ（ファイルをまたぐcrossrefのため）
+        entries = []
+        for source in sources:
+            path = find_source(source, self.output_dir)
+            if path is None:
+                return
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    parsed = parse_bib(f.read())
+            except UnicodeDecodeError:
+                return
+            if parsed is None:
+                return
+            entries.extend(parsed)
+        total = sum(1 for _, key, _ in entries if key is not None)
+        selected = select_entries(entries, keys)
+        cited_bib = '\n\n'.join(selected) + '\n'
+        pruned_name = self.jobname + '-cited'
+        first = True
+
+        def replace_source(match):
+            nonlocal first
+            if 'datatype="bibtex"' not in match.group(1):
+                return match.group(0)
+            if not first:
+                return ''
+            first = False
+            return f'<bcf:datasource{match.group(1)}>{pruned_name}.bib</bcf:datasource>\n'
+
+        cited_bcf = DATASOURCE.sub(replace_source, bcf_text)
+        streaming.write_if_changed(os.path.join(self.output_dir, pruned_name + '.bib'), cited_bib)
+        streaming.write_if_changed(os.path.join(self.output_dir, pruned_name + '.bcf'), cited_bcf)
+        self.command = ['biber', '--output-file', self.jobname + '.bbl', pruned_name + '.bcf']
+        self.summary = f'{len(selected) - sum(1 for kind, _, _ in entries if kind in KEEP_TYPES)} of {total} entries'
+
+        # キャッシュのキー（並べ替えなしの場合のみ引用順も含める）
+        options = CITEKEY.sub('', DATASOURCE.sub('', bcf_text))
+        cited = keys if UNSORTED.search(bcf_text) else sorted(set(keys))
+        digest = hashlib.sha256()
+        for part in ['\n'.join(cited), cited_bib, options, style_hash()]:
+            digest.update(hashlib.sha256(part.encode('utf-8')).digest())
+        self.cache_key = digest.hexdigest()
+
+    def cached_file(self):
+        return os.path.join(PROJECT_ROOT, BBL_CACHE_DIR, self.cache_key + '.bbl')
+
+    def restore(self):
+        """キャッシュした.bblがある場合はコピーしてTrueを返す"""
+        if self.cache_key is None or not cache.enabled() or not os.path.exists(self.cached_file()):
+            return False
+        streaming.copy_if_changed(self.cached_file(), self.bbl_file)
+        # 最近使ったものとして残す
+        os.utime(self.cached_file())
+        return True
+
+    def store(self):
+        """biberが作成した.bblをキャッシュに保存する"""
+        if self.cache_key is None or not cache.enabled() or not os.path.exists(self.bbl_file):
+            return
+        cache_dir = os.path.dirname(self.cached_file())
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = f'{self.cached_file()}.{os.getpid()}.tmp'
+        shutil.copyfile(self.bbl_file, tmp_file)
+        os.replace(tmp_file, self.cached_file())
+        cached = sorted(glob.glob(os.path.join(cache_dir, '*.bbl')), key=os.path.getmtime, reverse=True)
+        for old_file in cached[BBL_CACHE_SIZE:]:
+            os.remove(old_file)
+
+
+def plan_biber(output_dir, jobname):
+    """biberの実行方法を決める（引用した文献だけの.bibを作成し、キャッシュのキーを求める）"""
+    plan = BiberPlan(output_dir, jobname)
+    plan.prepare()
+    return plan
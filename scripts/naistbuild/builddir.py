@@ -0,0 +1,83 @@
+"""
+ビルドディレクトリでのPDF生成（NAIST_BUILD_DIR）
+
+通常はQuartoが生成したTeXファイルと同じディレクトリ（プロジェクトルートまたは_output）で
+xelatexを実行するため、.aux、.bcf、.logなどの中間ファイルがプロジェクトルートに散らばる。
+NAIST_BUILD_DIRを設定すると、Quartoが生成したTeXファイルだけをビルドディレクトリにコピーして
+そこで後処理し、template/のスタイルファイルや文献ファイルはコピーせずにTEXINPUTS・BIBINPUTSで
+プロジェクトルートから読み込む。中間ファイルはすべてビルドディレクトリに残り、
+完成したPDFだけをプロジェクトルートに公開する（ハードリンク。できない場合はコピー）。
+
+ビルドディレクトリごとに、post-render.shのロック、ビルドキャッシュの記録（cache.py）、
+公開するPDFの名前（既定のディレクトリはpaper.pdf、それ以外はpaper-<ディレクトリ名>.pdf）が
+分かれるため、下書き用と提出用などの複数のビルドを並行して実行できる。
+"""
+import os
+
+from . import streaming
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# NAIST_BUILD_DIR=1の場合のビルドディレクトリ（プロジェクトルートから）
+DEFAULT_BUILD_DIR = os.path.join('.naist-build', 'paper')
+
+
+def build_dir():
+    """ビルドディレクトリの絶対パス。NAIST_BUILD_DIRが設定されていない（または0の）場合はNone"""
+    setting = os.environ.get('NAIST_BUILD_DIR', '')
+    if setting in ('', '0'):
+        return None
+    if setting == '1':
+        setting = DEFAULT_BUILD_DIR
+    return os.path.join(PROJECT_ROOT, setting)
+
+
+def name(directory=None):
+    """ビルドディレクトリの名前（ロック、ビルドキャッシュ、公開するPDFの区別に使う）。設定されていない場合はNone"""
+    directory = directory or build_dir()
+    if directory is None:
+        return None
+    return os.path.basename(os.path.normpath(directory))
+
+
+def published_name(filename, directory=None):
+    """ビルドディレクトリのPDFを公開する名前（既定のディレクトリはそのまま、それ以外はディレクトリ名を付ける）"""
+    build_name = name(directory)
+    if build_name is None or build_name == os.path.basename(DEFAULT_BUILD_DIR):
+        return filename
+    stem, ext = os.path.splitext(filename)
+    return f'{stem}-{build_name}{ext}'
+
+
+def stage(tex_file, directory):
+    """Quartoが生成したTeXファイルをビルドディレクトリにコピーし、そのパスを返す（内容が同じ場合は書き込まない）
+
+    後処理はコピーに対して行うため、プロジェクトルートのTeXファイルは変更されない。
+    """
+    os.makedirs(directory, exist_ok=True)
+    staged = os.path.join(directory, os.path.basename(tex_file))
+    streaming.copy_if_changed(tex_file, staged)
+    # 公開したPDFとハードリンクを共有している場合は切り離す
+    # （xelatexが同じファイルを上書きすると、公開したPDFが書き込み途中の状態になるため）
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.endswith('.pdf') and os.stat(path).st_nlink > 1:
+            os.remove(path)
+    return staged
+
+
+def publish(pdf_file, dest):
+    """ビルドディレクトリのPDFをdestに公開する（ハードリンクを一時ファイル経由で置き換える）。公開した場合True"""
+    if not os.path.exists(pdf_file):
+        return False
+    if os.path.exists(dest) and os.path.samefile(pdf_file, dest):
+        return False
+    tmp_file = dest + '.tmp'
+    try:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        os.link(pdf_file, tmp_file)
+    except OSError:
+        # 別のファイルシステムなどでハードリンクを作れない場合はコピーする
+        return streaming.copy_if_changed(pdf_file, dest)
+    os.replace(tmp_file, dest)
+    return True
@@ -0,0 +1,198 @@
+"""
+内容のハッシュによるビルドキャッシュ
+
+各段階（postprocess、latex）の入力ファイルのハッシュを.naist-cache/manifest.jsonに
+記録し、入力が前回と同じ場合は処理を省略してキャッシュした出力を再利用する。
+ファイルのハッシュはサイズと更新時刻が変わった場合のみ計算し直す。
+NAIST_BUILD_DIRを設定した場合は、ビルドディレクトリごとに.naist-cache/builddirs/<名前>/に
+記録する（並行して実行する別のビルドディレクトリのビルドが互いの記録を上書きしないようにする）。
+"""
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+
+from . import builddir, figures, frontmatter, streaming
+
+CACHE_DIR = '.naist-cache'
+MANIFEST_VERSION = 1
+# ビルドディレクトリごとの記録の保存先（CACHE_DIRの中）
+BUILD_DIR_RECORDS = 'builddirs'
+
+# paper.qmdから読み込まれる章ファイル（{{< include 01_introduction.qmd >}}）
+INCLUDE_PATTERN = re.compile(r'\{\{<\s*include\s+([^\s>]+)\s*>\}\}')
+
+# 各段階の入力ファイル（プロジェクトルートからのglobパターン）
+STAGE_INPUTS = {
+    'postprocess': [
+        'template/before-body.tex',
+        'scripts/naistbuild/*.py',
+        # 後処理で縮小した図に置き換えるため（figures.py）
+        'figures/**/*',
+        'paper_files/figure-pdf/*', 'paper_files/figure-latex/*',
+    ],
+    'latex': [
+        'template/*.sty', 'template/*.tex', 'template/*.bbx', 'template/*.cbx',
+        'template/*.dbx', 'template/*.lbx', 'template/*.cfg',
+        'references/*.bib',
+        'figures/**/*',
+        'paper_files/figure-pdf/*', 'paper_files/figure-latex/*',
+    ],
+}
+
+# 各段階でキャッシュする出力（TeXファイルと同じディレクトリのファイル名）
+STAGE_OUTPUTS = {
+    'postprocess': ['paper.tex'],
+    'latex': ['paper.pdf', 'paper.aux', 'paper.bbl', 'paper.toc', 'paper.lof', 'paper.lot'],
+}
+
+
+def enabled():
+    """環境変数NAIST_CACHE=0でキャッシュを無効にできる"""
+    return os.environ.get('NAIST_CACHE', '1') != '0'
+
+
+def chapter_files(qmd_file):
+    """paper.qmdが{{< include >}}で読み込む章ファイルのパスを返す"""
+    if not os.path.exists(qmd_file):
+        return []
+    with open(qmd_file, 'r', encoding='utf-8') as f:
+        content = f.read()
+    base_dir = os.path.dirname(qmd_file)
+    return [os.path.join(base_dir, name) for name in INCLUDE_PATTERN.findall(content)]
+
+
+class BuildCache:
+    """.naist-cache/manifest.jsonの読み書きと各段階の入力ハッシュの比較"""
+
+    def __init__(self, project_root, build_name=None):
+        self.project_root = project_root
+        self.cache_dir = os.path.join(project_root, CACHE_DIR)
+        if build_name is None:
+            build_name = builddir.name()
+        # マニフェストと各段階の出力の保存先
+        self.record_dir = self.cache_dir
+        if build_name is not None:
+            self.record_dir = os.path.join(self.cache_dir, BUILD_DIR_RECORDS, build_name)
+        self.manifest_file = os.path.join(self.record_dir, 'manifest.json')
+        self.manifest = self._load()
+
+    def _load(self):
+        try:
+            with open(self.manifest_file, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+        if manifest.get('version') != MANIFEST_VERSION:
+            manifest = {'version': MANIFEST_VERSION, 'files': {}, 'stages': {}}
+        return manifest
+
+    def save(self):
+        """マニフェストを一時ファイルに書いてから置き換える（途中で中断しても壊れないようにする）"""
+        os.makedirs(self.record_dir, exist_ok=True)
+        tmp_file = self.manifest_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=1, sort_keys=True)
+        os.replace(tmp_file, self.manifest_file)
+
+    def _key(self, path):
+        return os.path.relpath(os.path.abspath(path), self.project_root)
+
+    def file_hash(self, path):
+        """ファイルのSHA-256を返す。サイズと更新時刻が前回と同じ場合は記録済みの値を使う"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        key = self._key(path)
+        entry = self.manifest['files'].get(key)
+        if entry and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+            return entry['sha256']
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        sha256 = digest.hexdigest()
+        self.manifest['files'][key] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha256': sha256}
+        return sha256
+
+    def stage_inputs(self, stage, tex_file):
+        """段階の入力（ファイル名とハッシュの辞書）を求める"""
+        inputs = {'tex': self.file_hash(tex_file)}
+        paths = []
+        for pattern in STAGE_INPUTS[stage]:
+            paths.extend(glob.glob(os.path.join(self.project_root, pattern), recursive=True))
+        if stage == 'postprocess':
+            # 後処理はフロントマターの変数と章ファイルにも依存する
+            qmd_file = os.path.join(self.project_root, 'paper.qmd')
+            if os.path.exists(qmd_file):
+                inputs['front-matter'] = frontmatter.front_matter_hash(frontmatter.read_front_matter(qmd_file))
+            paths.extend(chapter_files(qmd_file))
+            inputs['figure-settings'] = f'{figures.enabled()}:{figures.target_dpi()}'
+        for path in sorted(set(paths)):
+            if os.path.isfile(path):
+                inputs[self._key(path)] = self.file_hash(path)
+        return inputs
+
+    def is_fresh(self, stage, inputs, ignore=()):
+        """入力が前回記録したものと同じで、キャッシュした出力が記録したハッシュのとおりそろっていればTrue"""
+        record = self.manifest['stages'].get(stage)
+        if record is None:
+            return False
+        recorded = {k: v for k, v in record['inputs'].items() if k not in ignore}
+        current = {k: v for k, v in inputs.items() if k not in ignore}
+        if recorded != current:
+            return False
+        # 記録の途中で中断した場合などに、別のビルドの出力を使わないようにする
+        return all(self.file_hash(os.path.join(self.record_dir, stage, name)) == sha256
+                   for name, sha256 in record['outputs'].items())
+
+    def output_hash(self, stage, name):
+        """前回記録した出力のハッシュを返す"""
+        record = self.manifest['stages'].get(stage)
+        if record is None:
+            return None
+        return record['outputs'].get(name)
+
+    def restore(self, stage, output_dir):
+        """キャッシュした出力をoutput_dirにコピーし、コピーしたファイル名のリストを返す"""
+        restored = []
+        for name, sha256 in self.manifest['stages'][stage]['outputs'].items():
+            dest = os.path.join(output_dir, name)
+            # 既に同じ内容の場合はコピーしない（更新時刻を変えない）
+            if self.file_hash(dest) != sha256:
+                streaming.copy_if_changed(os.path.join(self.record_dir, stage, name), dest)
+            restored.append(name)
+        return restored
+
+    def record(self, stage, inputs, output_dir):
+        """段階の出力をキャッシュにコピーし、入力と出力のハッシュを記録する
+
+        出力は一時ファイル経由でコピーし、マニフェストはすべてコピーした後に保存する
+        """
+        stage_dir = os.path.join(self.record_dir, stage)
+        os.makedirs(stage_dir, exist_ok=True)
+        outputs = {}
+        for name in STAGE_OUTPUTS[stage]:
+            path = os.path.join(output_dir, name)
+            if os.path.exists(path):
+                streaming.copy_if_changed(path, os.path.join(stage_dir, name))
+                outputs[name] = self.file_hash(path)
+        self.manifest['stages'][stage] = {'inputs': inputs, 'outputs': outputs}
+        self.save()
+
+    def clear(self):
+        """ビルドキャッシュ（すべてのビルドディレクトリのマニフェストと各段階の出力）を削除する
+
+        .naist-cache/の他のファイル（knitr/のチャンクの実行結果、locks/、vars.jsonなど）は削除しない
+        """
+        for stage in STAGE_OUTPUTS:
+            shutil.rmtree(os.path.join(self.cache_dir, stage), ignore_errors=True)
+        shutil.rmtree(os.path.join(self.cache_dir, BUILD_DIR_RECORDS), ignore_errors=True)
+        manifest_file = os.path.join(self.cache_dir, 'manifest.json')
+        for path in [manifest_file, manifest_file + '.tmp']:
+            if os.path.exists(path):
+                os.remove(path)
+        self.manifest = self._load()
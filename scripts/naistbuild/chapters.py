@@ -0,0 +1,176 @@
+"""
+章（\\section）単位のインクリメンタルコンパイル
+
+後処理済みのTeXファイルの本文を\\sectionごとに分割してpaper-chapters/以下に書き出し、
+それらを\\includeで読み込むpaper-incremental.texを作成する。前回のコンパイルから
+内容が変わった章だけを\\includeonlyで指定するため、変更のない章は処理されず、
+各章の.auxに残っている番号・相互参照・目次の項目がそのまま使われる。
+
+生成されるpaper-incremental.pdfには、表紙・目次などと変更した章だけが含まれる
+（執筆中の確認用。\\includeのため各章は改ページされる）。提出用のPDFは通常の
+ビルドで生成する。
+"""
+import hashlib
+import json
+import os
+import re
+import sys
+
+from . import latex, streaming, trace
+from .preamble import BEGIN_DOCUMENT
+
+JOBNAME = 'paper-incremental'
+UNIT_DIR = 'paper-chapters'
+STATE_FILE = 'units.json'
+
+# 章の始まり（行頭の\section）と、章に含めずに本体に残す行（\appendixなど）
+SECTION_LINE = re.compile(r'\\section\*?[\[{]')
+MAIN_LINE = re.compile(r'\\appendix(?![A-Za-z@])')
+END_DOCUMENT = re.compile(r'^\\end\{document\}', flags=re.MULTILINE)
+LABEL = re.compile(r'\\label\{([^}]*)\}')
+
+
+def enabled():
+    """環境変数NAIST_INCREMENTAL=1でインクリメンタルコンパイルを使う"""
+    return os.environ.get('NAIST_INCREMENTAL', '0') == '1'
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def unit_name(section_line, index, used):
+    """章のファイル名（\\labelから作る。挿入・削除で他の章の名前が変わらないようにする）"""
+    match = LABEL.search(section_line)
+    name = re.sub(r'[^A-Za-z0-9-]', '-', match.group(1)) if match else f'section{index:02d}'
+    if name in used:
+        name = f'{name}-{index:02d}'
+    used.add(name)
+    return name
+
+
+def split_units(content):
+    """TeXの内容を(プリアンブル, 本文の部分のリスト, \\end{document}以降)に分割する
+
+    本文の部分は('main', 文字列)または('unit', 章の名前, 文字列)。
+    \\begin{document}や\\sectionがない場合はNoneを返す。
+    """
+    begin = BEGIN_DOCUMENT.search(content)
+    if begin is None:
+        return None
+    end = END_DOCUMENT.search(content, begin.end())
+    if end is None:
+        return None
+    parts = [['main', []]]
+    used = set()
+    for line in content[begin.end():end.start()].splitlines(keepends=True):
+        if SECTION_LINE.match(line):
+            parts.append(['unit', [line], unit_name(line, len(parts), used)])
+        elif MAIN_LINE.match(line):
+            parts.append(['main', [line]])
+        else:
+            parts[-1][1].append(line)
+    if not any(part[0] == 'unit' for part in parts):
+        return None
+    body = [('main', ''.join(part[1])) if part[0] == 'main' else ('unit', part[2], ''.join(part[1]))
+            for part in parts]
+    return content[:begin.end()], body, content[end.start():]
+
+
+class IncrementalBuild:
+    """paper-incremental.texと章ごとのファイルを作成し、変更した章だけをコンパイルする"""
+
+    def __init__(self, tex_file, stream=None):
+        self.output_dir = os.path.dirname(tex_file) or '.'
+        self.tex_file = tex_file
+        self.unit_dir = os.path.join(self.output_dir, UNIT_DIR)
+        self.state_file = os.path.join(self.unit_dir, STATE_FILE)
+        self.stream = stream if stream is not None else sys.stdout
+
+    def log(self, message):
+        print(message, file=self.stream)
+
+    def load_state(self):
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def full_build_reason(self, state, preamble_hash, names):
+        if not state:
+            return 'first incremental build'
+        if state.get('preamble') != preamble_hash:
+            return 'preamble changed'
+        if state.get('order') != names:
+            # 章の追加・削除・並べ替えでは、後ろの章の番号がずれるため全体をコンパイルする
+            return 'chapters were added, removed or reordered'
+        for name in names:
+            if not os.path.exists(os.path.join(self.unit_dir, name + '.aux')):
+                return f'{name}.aux missing'
+        return None
+
+    def build(self):
+        """インクリメンタルコンパイルを行い、成功した場合Trueを返す"""
+        with open(self.tex_file, 'r', encoding='utf-8') as f:
+            split = split_units(f.read())
+        if split is None:
+            self.log("  ⚠ No \\section found. Incremental build is not possible.")
+            return False
+        head, body, tail = split
+        units = [(part[1], part[2]) for part in body if part[0] == 'unit']
+        names = [name for name, _ in units]
+        hashes = {name: text_hash(text) for name, text in units}
+        preamble_hash = text_hash(head)
+        # 表紙・目次など、章以外の本文（常にコンパイルされる）
+        main_hash = text_hash(''.join(part[1] for part in body if part[0] == 'main'))
+
+        state = self.load_state()
+        reason = self.full_build_reason(state, preamble_hash, names)
+        if reason:
+            included = names
+            self.log(f"  Incremental build: compiling all {len(names)} chapter(s) ({reason})")
+        else:
+            included = [name for name in names if state['units'].get(name) != hashes[name]]
+            if (not included and state.get('main') == main_hash
+                    and os.path.exists(os.path.join(self.output_dir, JOBNAME + '.pdf'))):
+                self.log(f"✓ No chapter changed. Reusing {JOBNAME}.pdf")
+                return True
+            self.log(f"  Incremental build: {len(included)} of {len(names)} chapter(s) changed: "
+                     f"{', '.join(included) or '(none)'}")
+
+        # 章ごとのファイル（内容が変わったものだけ書き込む）
+        os.makedirs(self.unit_dir, exist_ok=True)
+        for name, text in units:
+            streaming.write_if_changed(os.path.join(self.unit_dir, name + '.tex'), text)
+
+        # \includeonlyは\begin{document}の前に置く
+        begin = BEGIN_DOCUMENT.search(head)
+        includeonly = '\\includeonly{' + ','.join(f'{UNIT_DIR}/{name}' for name in included) + '}\n'
+        pieces = [head[:begin.start()], includeonly, head[begin.start():]]
+        for part in body:
+            pieces.append(part[1] if part[0] == 'main' else f'\\include{{{UNIT_DIR}/{part[1]}}}\n')
+        pieces.append(tail)
+        main_file = os.path.join(self.output_dir, JOBNAME + '.tex')
+        streaming.write_if_changed(main_file, ''.join(pieces))
+
+        watch = [os.path.join(self.unit_dir, name + '.aux') for name in names]
+        if not latex.build_pdf(main_file, stream=self.stream, watch=watch):
+            return False
+
+        # コンパイルした章のハッシュを記録（失敗した場合は次回も再コンパイルする）
+        recorded = {} if reason else dict(state['units'])
+        for name in included:
+            recorded[name] = hashes[name]
+        # 書き込みの途中で中断した場合に、壊れたunits.jsonで次回の差分を判断しないようにする
+        with streaming.atomic_writer(self.state_file) as f:
+            json.dump({'preamble': preamble_hash, 'main': main_hash, 'order': names, 'units': recorded}, f, indent=1)
+        self.log(f"✓ Wrote {JOBNAME}.pdf (contains only the compiled chapters)")
+        return True
+
+
+def build_incremental(tex_file, stream=None):
+    """tex_fileから章単位のインクリメンタルコンパイルでpaper-incremental.pdfを生成する"""
+    with trace.span('latex:incremental', tex_file=tex_file) as record:
+        record['ok'] = IncrementalBuild(tex_file, stream=stream).build()
+        return record['ok']
@@ -0,0 +1,99 @@
+"""
+計算チャンクの結果のキャッシュ（scripts/chunk-cache.R）の一覧表示と削除
+
+chunk-cache.Rは、knitrのcacheで各チャンクの結果を.naist-cache/knitr/<文書>/<出力形式>/に
+<ラベル>_<ハッシュ>.rdb・.rdx・.RDataとして保存する。ハッシュはチャンクのコード、
+オプション、data-filesで宣言したデータファイルのMD5から求められるため、本文の文章を
+編集しても変わらない。解析に使うRパッケージを更新した場合など、キャッシュのキーに
+含まれない変更があったときは、ここから削除して再実行させる（削除したチャンクが
+再実行されると、そのオブジェクトを使うチャンクもknitrが再実行する）。
+"""
+import os
+import re
+import shutil
+import time
+
+KNITR_DIR = os.path.join('.naist-cache', 'knitr')
+CACHE_FILE = re.compile(r'^(?P<label>.+)_(?P<hash>[0-9a-f]{32})\.(?:rdb|rdx|RData)$')
+
+
+class CachedChunk:
+    """1つのチャンクのキャッシュ（同じハッシュの.rdb・.rdx・.RData）"""
+
+    def __init__(self, document, output_format, label, digest):
+        self.document = document
+        self.output_format = output_format
+        self.label = label
+        self.digest = digest
+        self.files = []
+
+    @property
+    def size(self):
+        return sum(os.path.getsize(path) for path in self.files if os.path.exists(path))
+
+    @property
+    def mtime(self):
+        return max((os.path.getmtime(path) for path in self.files if os.path.exists(path)), default=0)
+
+
+def cache_dirs(project_root, document=None, output_format=None):
+    """(文書, 出力形式, ディレクトリ)のリストを返す"""
+    root = os.path.join(project_root, KNITR_DIR)
+    dirs = []
+    for doc in sorted(os.listdir(root)) if os.path.isdir(root) else []:
+        if document and doc != document:
+            continue
+        for fmt in sorted(os.listdir(os.path.join(root, doc))):
+            path = os.path.join(root, doc, fmt)
+            if os.path.isdir(path) and (not output_format or fmt == output_format):
+                dirs.append((doc, fmt, path))
+    return dirs
+
+
+def find_chunks(project_root, document=None, output_format=None):
+    """キャッシュされたチャンクを、文書・出力形式ごとに保存した順に返す"""
+    chunks = []
+    for doc, fmt, path in cache_dirs(project_root, document, output_format):
+        found = {}
+        for name in os.listdir(path):
+            match = CACHE_FILE.match(name)
+            if match is None:
+                continue
+            key = (match.group('label'), match.group('hash'))
+            if key not in found:
+                found[key] = CachedChunk(doc, fmt, *key)
+            found[key].files.append(os.path.join(path, name))
+        chunks.extend(sorted(found.values(), key=lambda chunk: chunk.mtime))
+    return chunks
+
+
+def list_chunks(project_root, document=None, output_format=None):
+    chunks = find_chunks(project_root, document, output_format)
+    if not chunks:
+        print(f"No cached chunks in {KNITR_DIR}")
+        return
+    width = max(len(chunk.label) for chunk in chunks)
+    current = None
+    for chunk in chunks:
+        if (chunk.document, chunk.output_format) != current:
+            current = (chunk.document, chunk.output_format)
+            print(f"{chunk.document} ({chunk.output_format}):")
+        saved = time.strftime('%Y-%m-%d %H:%M', time.localtime(chunk.mtime))
+        print(f"  {chunk.label:<{width}}  {chunk.size / 1024:8.1f} KiB  {saved}  {chunk.digest[:8]}")
+    total = sum(chunk.size for chunk in chunks)
+    print(f"{len(chunks)} cached chunk(s), {total / (1 << 20):.1f} MiB")
+
+
+def clear_chunks(project_root, labels=(), document=None, output_format=None):
+    """指定したラベルのチャンク（指定しない場合はすべて）のキャッシュを削除し、削除した数を返す"""
+    if not labels:
+        dirs = cache_dirs(project_root, document, output_format)
+        count = len(find_chunks(project_root, document, output_format))
+        for _, _, path in dirs:
+            shutil.rmtree(path, ignore_errors=True)
+        return count
+    chunks = [chunk for chunk in find_chunks(project_root, document, output_format) if chunk.label in labels]
+    for chunk in chunks:
+        for path in chunk.files:
+            os.remove(path)
+    return len(chunks)
@@ -0,0 +1,214 @@
+"""
+提出用にPDFを小さくする（NAIST_COMPACT=1）
+
+knitrの図やCJKフォントを多く含む論文では、xelatexが生成したPDFが大きくなり、
+提出システムへのアップロードや保存に時間がかかる。ここでは完成したPDFを次のように書き直す。
+
+  - Ghostscript（gs）: 同じ画像を1つにまとめ（DetectDuplicateImages）、表示される大きさに
+    対してNAIST_COMPACT_DPI（既定300dpi）を超える画像を縮小し、フォントのサブセットを
+    まとめて埋め込み直す
+  - qpdf: オブジェクトストリームと圧縮した相互参照ストリームで書き直す
+
+どちらかがない場合は、ある方だけを使う（両方ない場合は何もしない）。結果は元のPDFの内容の
+ハッシュと設定ごとに.naist-cache/compact/に保存するため、PDFが変わっていない場合は再実行しない。
+結果が元より小さくならない場合は元のPDFをそのまま使い、そのことだけを記録する。
+PDFは一時ファイルに書いてから置き換える。
+"""
+import glob
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+
+from . import cache, figures, streaming, trace
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+COMPACT_DIR = os.path.join(cache.CACHE_DIR, 'compact')
+# 保存する結果の数（古いものから削除する）
+COMPACT_CACHE_SIZE = 4
+# 変換方法を変えた場合に更新する（古い結果を使わないため）
+COMPACT_VERSION = 1
+# この倍率以上の解像度の画像だけを縮小する（わずかに大きい画像を劣化させないため）
+DOWNSAMPLE_THRESHOLD = 1.5
+
+
+def enabled():
+    """環境変数NAIST_COMPACT=1で有効"""
+    return os.environ.get('NAIST_COMPACT', '0') == '1'
+
+
+def target_dpi():
+    try:
+        return int(os.environ.get('NAIST_COMPACT_DPI', figures.DEFAULT_DPI))
+    except ValueError:
+        return figures.DEFAULT_DPI
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def gs_command(source, dest, dpi):
+    command = ['gs', '-q', '-dNOPAUSE', '-dBATCH', '-dSAFER', '-sDEVICE=pdfwrite',
+               '-dCompatibilityLevel=1.5', '-dAutoRotatePages=/None',
+               '-dDetectDuplicateImages=true', '-dSubsetFonts=true', '-dCompressFonts=true', '-dEmbedAllFonts=true',
+               # Ghostscript 10.02以降はオブジェクトストリームも書ける（それより前は無視される）
+               '-dWriteObjStms=true', '-dWriteXRefStm=true']
+    for kind in ['Color', 'Gray', 'Mono']:
+        command += [f'-dDownsample{kind}Images=true', f'-d{kind}ImageResolution={dpi}',
+                    f'-d{kind}ImageDownsampleThreshold={DOWNSAMPLE_THRESHOLD}']
+    command += ['-dColorImageDownsampleType=/Bicubic', '-dGrayImageDownsampleType=/Bicubic',
+                f'-sOutputFile={dest}', source]
+    return command
+
+
+def qpdf_command(source, dest):
+    return ['qpdf', '--object-streams=generate', '--compress-streams=y', '--recompress-flate',
+            '--compression-level=9', source, dest]
+
+
+def tools():
+    """使えるツールの名前のリスト"""
+    return [name for name in ['gs', 'qpdf'] if shutil.which(name)]
+
+
+def valid_pdf(path):
+    """PDFとして最後まで書かれている場合True（ツールが途中で失敗した場合の確認）"""
+    try:
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            if f.read(5) != b'%PDF-':
+                return False
+            f.seek(max(0, size - 1024))
+            return b'%%EOF' in f.read()
+    except OSError:
+        return False
+
+
+def format_size(size):
+    return f'{size / (1 << 20):.1f} MiB' if size >= 1 << 20 else f'{size / 1024:.0f} KiB'
+
+
+class PdfCompactor:
+    """1つのPDFの書き直しと、その結果のキャッシュ"""
+
+    def __init__(self, pdf_file, dpi=None, log=print):
+        self.pdf_file = pdf_file
+        self.dpi = dpi or target_dpi()
+        self.log = log
+        self.tools = tools()
+        self.settings = f'{COMPACT_VERSION}:{self.dpi}:{",".join(self.tools)}'
+
+    @property
+    def cache_dir(self):
+        return os.path.join(PROJECT_ROOT, COMPACT_DIR)
+
+    def key(self, source_hash):
+        return hashlib.sha256(f'{source_hash}\0{self.settings}'.encode('utf-8')).hexdigest()[:32]
+
+    def records(self):
+        for record_file in glob.glob(os.path.join(self.cache_dir, '*.json')):
+            try:
+                with open(record_file, 'r', encoding='utf-8') as f:
+                    yield json.load(f)
+            except (OSError, ValueError):
+                continue
+
+    def compact(self, force=False):
+        """PDFを書き直し、成功した（または既に書き直してある）場合Trueを返す"""
+        if not self.tools:
+            self.log("  ⚠ Neither Ghostscript (gs) nor qpdf found. Skipping PDF compaction.")
+            return False
+        name = os.path.basename(self.pdf_file)
+        source_hash = file_sha256(self.pdf_file)
+        if not force:
+            for record in self.records():
+                if record.get('output') == source_hash and record.get('settings') == self.settings:
+                    self.log(f"✓ {name} is already compacted ({format_size(record['after'])})")
+                    return True
+        key = self.key(source_hash)
+        cached = os.path.join(self.cache_dir, key + '.pdf')
+        if not force and os.path.exists(cached) and os.path.exists(os.path.join(self.cache_dir, key + '.json')):
+            before = os.path.getsize(self.pdf_file)
+            streaming.copy_if_changed(cached, self.pdf_file)
+            # 最近使ったものとして残す
+            os.utime(os.path.join(self.cache_dir, key + '.json'))
+            self.log(f"✓ PDF unchanged. Reused compacted {name}: {format_size(before)} → "
+                     f"{format_size(os.path.getsize(self.pdf_file))}")
+            return True
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        result = self.run_tools(key)
+        if result is None:
+            return False
+        before = os.path.getsize(self.pdf_file)
+        after = os.path.getsize(result)
+        record = {'source': source_hash, 'settings': self.settings, 'before': before}
+        if after < before:
+            os.replace(result, cached)
+            streaming.copy_if_changed(cached, self.pdf_file)
+            record.update(output=file_sha256(cached), after=after)
+        else:
+            # 小さくならない場合は元のPDFをそのまま使い、結果は保存しない
+            # （出力が元のPDFと同じという記録だけを残し、次回は再実行しない）
+            os.remove(result)
+            record.update(output=source_hash, after=before)
+            after = before
+        with streaming.atomic_writer(os.path.join(self.cache_dir, key + '.json')) as f:
+            json.dump(record, f, indent=1, sort_keys=True)
+        self.prune()
+        if after < before:
+            self.log(f"✓ Compacted {name} with {' + '.join(self.tools)} at {self.dpi} dpi: "
+                     f"{format_size(before)} → {format_size(after)} (-{100 * (before - after) / before:.0f}%)")
+        else:
+            self.log(f"✓ {name} is already compact ({format_size(before)}). Kept the original.")
+        return True
+
+    def run_tools(self, key):
+        """gs・qpdfを順に実行し、結果の一時ファイルのパスを返す（失敗した場合はNone）"""
+        source = self.pdf_file
+        outputs = []
+        for tool in self.tools:
+            dest = os.path.join(self.cache_dir, f'{key}.{tool}.tmp')
+            command = gs_command(source, dest, self.dpi) if tool == 'gs' else qpdf_command(source, dest)
+            with trace.subprocess_span(tool, command) as record:
+                result = subprocess.run(command, capture_output=True, text=True, errors='replace')
+                record['exit_code'] = result.returncode
+            # qpdfは警告がある場合に3で終了する（出力は作られる）
+            ok = result.returncode == 0 or (tool == 'qpdf' and result.returncode == 3)
+            if not ok or not valid_pdf(dest):
+                self.log(f"  ⚠ {tool} failed (exit code {result.returncode}). Keeping the uncompacted PDF.")
+                for line in (result.stderr or result.stdout).strip().splitlines()[-5:]:
+                    self.log(f"    {line}")
+                for path in outputs + [dest]:
+                    if os.path.exists(path):
+                        os.remove(path)
+                return None
+            outputs.append(dest)
+            source = dest
+        for path in outputs[:-1]:
+            os.remove(path)
+        return outputs[-1]
+
+    def prune(self):
+        """古い記録と結果を削除する（元のPDFを使った記録には結果のPDFがない）"""
+        records = sorted(glob.glob(os.path.join(self.cache_dir, '*.json')), key=os.path.getmtime, reverse=True)
+        for record_file in records[COMPACT_CACHE_SIZE:]:
+            os.remove(record_file)
+            cached = os.path.splitext(record_file)[0] + '.pdf'
+            if os.path.exists(cached):
+                os.remove(cached)
+
+
+def compact_pdf(pdf_file, dpi=None, force=False, log=print):
+    """pdf_fileを提出用に書き直し、成功した場合Trueを返す"""
+    compactor = PdfCompactor(pdf_file, dpi=dpi, log=log)
+    with trace.span('compact', pdf_file=pdf_file) as record:
+        ok = compactor.compact(force=force)
+        record.update(ok=ok, bytes_written=os.path.getsize(pdf_file) if ok else 0)
+        return ok
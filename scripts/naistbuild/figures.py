@@ -0,0 +1,292 @@
+"""
+LaTeXに渡す前の図の準備（縮小・最適化）と、内容のハッシュによるキャッシュ
+
+TeXファイルの\\includegraphicsが参照するPNG・JPEG画像を、表示される幅で
+NAIST_FIGURE_DPI（既定300dpi）になる大きさまで縮小し、メタデータを除いて最適化した
+ものを.naist-cache/figures/に保存して、\\includegraphicsのパスを置き換える。
+表示される幅はwidthオプション、ない場合は画像の解像度（dpi）から求めた本来の幅で決める。
+縮小した画像には縮小した割合の解像度を記録し（本来の大きさを変えない）、ICCプロファイルも残す。
+xelatexは各パスで画像を読み込むため、高解像度の画像が多い論文ほど効果が大きい。
+
+保存先は元の画像の内容のハッシュと縮小後の大きさで決まるため、変更のない画像は
+再処理されない。変換は複数のプロセスで並行して行う。PDFの図（knitrのfigure-pdf・figure-latex）は
+ベクター画像のためそのまま使う。Pillowがない場合は何もしない。
+"""
+import concurrent.futures
+import hashlib
+import math
+import os
+import re
+
+from . import texgroups
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# 準備した図の保存先（プロジェクトルートから。cache.CACHE_DIRの中）
+FIGURE_DIR = os.path.join('.naist-cache', 'figures')
+# 変換方法を変えた場合に更新する（古い変換結果を使わないため）
+PREPARE_VERSION = 2
+
+DEFAULT_DPI = 300
+# 本文の幅（A4、左右の余白25mm。header.texの\geometry）
+TEXT_WIDTH_INCHES = 160 / 25.4
+UNIT_INCHES = {'in': 1.0, 'cm': 1 / 2.54, 'mm': 1 / 25.4, 'pt': 1 / 72.27, 'bp': 1 / 72}
+
+RASTER_FORMATS = {'.png': 'PNG', '.jpg': 'JPEG', '.jpeg': 'JPEG'}
+# 拡張子のない\includegraphics{figures/fig1}で試す順（graphicxと同じ）
+EXTENSIONS = ['.pdf', '.png', '.jpg', '.jpeg']
+
+GRAPHICS = re.compile(r'\\includegraphics\s*(?:\[([^\]]*)\])?\s*\{([^}]*)\}')
+WIDTH = re.compile(r'(?:^|,)\s*width\s*=\s*([0-9.]*)\s*(\\linewidth|\\textwidth|\\columnwidth|in|cm|mm|pt|bp)')
+HEIGHT = re.compile(r'(?:^|,)\s*(?:total)?height\s*=')
+SCALE = re.compile(r'(?:^|,)\s*scale\s*=\s*([0-9.]+)')
+
+
+def enabled():
+    """環境変数NAIST_FIGURES=0で図の準備を無効にできる"""
+    return os.environ.get('NAIST_FIGURES', '1') != '0' and Image is not None
+
+
+def target_dpi():
+    try:
+        return int(os.environ.get('NAIST_FIGURE_DPI', DEFAULT_DPI))
+    except ValueError:
+        return DEFAULT_DPI
+
+
+def natural_inches(path):
+    """画像の解像度（PNGのpHYs、JPEGのJFIF・Exif）から、xelatexが使う本来の幅（インチ）を求める
+
+    解像度の情報がない場合はNone（xelatexは72dpiとみなすが、作成したソフトによって異なるため推測しない）。
+    """
+    try:
+        # Image.openはヘッダーだけを読む
+        with Image.open(path) as image:
+            dpi = image.info.get('dpi')
+            if not dpi or not dpi[0] or dpi[0] <= 0:
+                return None
+            return image.width / dpi[0]
+    except (OSError, ValueError):
+        return None
+
+
+def display_inches(options, natural=None):
+    """\\includegraphicsのオプションと画像の本来の幅naturalから、表示される幅（インチ）を求める
+
+    widthがない場合は本来の幅（scaleを掛け、本文の幅まで）。heightだけが指定されている場合や、
+    本来の幅がわからない場合はNone。
+    """
+    match = WIDTH.search(options or '')
+    if match is None:
+        if natural is None or HEIGHT.search(options or ''):
+            return None
+        scale = SCALE.search(options or '')
+        return min(natural * (float(scale.group(1)) if scale else 1.0), TEXT_WIDTH_INCHES)
+    factor = float(match.group(1)) if match.group(1) else 1.0
+    unit = match.group(2)
+    if unit.startswith('\\'):
+        return min(factor, 1.0) * TEXT_WIDTH_INCHES
+    return min(factor * UNIT_INCHES[unit], TEXT_WIDTH_INCHES)
+
+
+def resolve(path, output_dir, project_root=None):
+    """\\includegraphicsのパスから画像ファイルを探し、output_dirからの相対パスを返す
+
+    output_dirにない場合は、TEXINPUTSで読み込むプロジェクトルートからも探す
+    （_outputやビルドディレクトリのTeXファイルが参照するfigures/など）。
+    """
+    candidates = [path] if os.path.splitext(path)[1] else [path + ext for ext in EXTENSIONS]
+    for directory in [output_dir, project_root]:
+        if directory is None:
+            continue
+        for candidate in candidates:
+            if os.path.isfile(os.path.join(directory, candidate)):
+                return os.path.relpath(os.path.join(directory, candidate), output_dir)
+    return None
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def convert(source, dest, max_width):
+    """sourceを幅max_width以下に縮小し、メタデータを除いてdestに保存する
+
+    解像度（dpi）は縮小した割合で下げて保存するため、xelatexが使う本来の大きさは変わらない。
+    ICCプロファイルは色の再現に必要なため残す。縮小も容量の削減もできなかった場合は
+    保存せずにFalseを返す（元の画像を使う）。プロセスプールのワーカーで実行される。
+    """
+    image_format = RASTER_FORMATS[os.path.splitext(dest)[1].lower()]
+    with Image.open(source) as image:
+        image.load()
+        dpi = image.info.get('dpi')
+        if dpi and not all(value > 0 for value in dpi):
+            dpi = None
+        icc_profile = image.info.get('icc_profile')
+        resized = image.width > max_width
+        if resized:
+            scale = max_width / image.width
+            if dpi:
+                # JPEGの解像度は整数で保存されるため、整数のdpiに合わせて大きさを決める
+                new_dpi = tuple(max(1, round(value * scale)) for value in dpi)
+                size = (max(1, round(image.width * new_dpi[0] / dpi[0])),
+                        max(1, round(image.height * new_dpi[1] / dpi[1])))
+                dpi = new_dpi
+            else:
+                size = (max_width, max(1, round(image.height * scale)))
+            image = image.resize(size, Image.LANCZOS)
+        # 別のビルドディレクトリのビルドが同じ図を同時に変換しても互いに上書きしないようにする
+        tmp_file = f'{dest}.{os.getpid()}.tmp'
+        # pnginfo・exifは渡さないため、解像度とICCプロファイル以外のメタデータは保存されない
+        options = {}
+        if dpi:
+            options['dpi'] = dpi
+        if icc_profile:
+            options['icc_profile'] = icc_profile
+        if image_format == 'JPEG':
+            image.convert('RGB' if image.mode not in ('L', 'RGB', 'CMYK') else image.mode).save(
+                tmp_file, 'JPEG', quality=90, optimize=True, **options)
+        else:
+            image.save(tmp_file, 'PNG', optimize=True, **options)
+    if not resized and os.path.getsize(tmp_file) >= os.path.getsize(source):
+        os.remove(tmp_file)
+        return False
+    os.replace(tmp_file, dest)
+    return True
+
+
+class FigureCache:
+    """準備した図の保存先（元の画像のハッシュと縮小後の幅ごとのディレクトリ）"""
+
+    def __init__(self, project_root):
+        self.root = os.path.abspath(os.path.join(project_root, FIGURE_DIR))
+
+    def entry(self, sha256, max_width):
+        key = hashlib.sha256(f'{PREPARE_VERSION}:{sha256}:{max_width}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, key[:2], key)
+
+    def lookup(self, entry_dir, name):
+        """(準備した図のパス、または元の画像を使う場合None, 処理済みかどうか)を返す"""
+        prepared = os.path.join(entry_dir, name)
+        if os.path.exists(prepared):
+            return prepared, True
+        if os.path.exists(os.path.join(entry_dir, '.original')):
+            return None, True
+        return None, False
+
+
+class FigurePlan:
+    """TeXが参照する図と、それぞれを置き換える準備した図
+
+    scanでTeXの内容（分割して渡してもよい）から図を集め、prepareで変換してから、
+    applyで\\includegraphicsのパスを置き換える。
+    """
+
+    def __init__(self, output_dir, project_root):
+        self.output_dir = output_dir
+        self.project_root = project_root
+        self.figure_cache = FigureCache(project_root)
+        self.dpi = target_dpi()
+        # (output_dirからのパス, 縮小後の幅) -> 準備した図のパス（元の画像を使う場合None）
+        self.targets = {}
+        # output_dirからのパス -> 画像の本来の幅（インチ。解像度の情報がない場合None）
+        self.natural = {}
+
+    def target(self, match, text):
+        """\\includegraphicsのマッチから(パス, 縮小後の幅)を返す。準備しない図の場合はNone"""
+        if texgroups.in_comment(text, match.start()):
+            return None
+        path = resolve(match.group(2).strip(), self.output_dir, self.project_root)
+        if path is None or os.path.splitext(path)[1].lower() not in RASTER_FORMATS:
+            return None
+        if os.path.abspath(os.path.join(self.output_dir, path)).startswith(self.figure_cache.root + os.sep):
+            # 既に置き換えた図（後処理済みのTeXファイル）
+            return None
+        if path not in self.natural:
+            self.natural[path] = natural_inches(os.path.join(self.output_dir, path))
+        inches = display_inches(match.group(1), self.natural[path])
+        if inches is None:
+            # 表示される幅がわからない図は縮小しない
+            return None
+        # PNGの解像度は1メートルあたりの画素数のため、誤差で1画素大きくならないように丸める
+        return path, math.ceil(round(inches * self.dpi, 1))
+
+    def scan(self, text):
+        """置き換える図を集める（同じ図が複数の幅で使われる場合はそれぞれ準備する）"""
+        for match in GRAPHICS.finditer(text):
+            key = self.target(match, text)
+            if key is not None:
+                self.targets.setdefault(key, None)
+
+    def prepare(self, log=print, jobs=None, file_hash=file_sha256):
+        """キャッシュにない図を並行して変換する"""
+        pending = []
+        hashes = {}
+        for path, max_width in self.targets:
+            source = os.path.join(self.output_dir, path)
+            if source not in hashes:
+                hashes[source] = file_hash(source)
+            entry_dir = self.figure_cache.entry(hashes[source], max_width)
+            prepared, done = self.figure_cache.lookup(entry_dir, os.path.basename(path))
+            if done:
+                self.targets[(path, max_width)] = prepared
+            else:
+                os.makedirs(entry_dir, exist_ok=True)
+                pending.append((path, max_width, source, os.path.join(entry_dir, os.path.basename(path))))
+
+        if pending:
+            # 画像の変換は並行して行う
+            workers = min(len(pending), jobs or os.cpu_count() or 1)
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(convert, source, dest, max_width): (path, max_width, dest)
+                           for path, max_width, source, dest in pending}
+                for future in concurrent.futures.as_completed(futures):
+                    path, max_width, dest = futures[future]
+                    try:
+                        converted = future.result()
+                    except Exception as e:
+                        log(f"  ⚠ Failed to prepare {path}: {e}. Using the original image.")
+                        continue
+                    if converted:
+                        self.targets[(path, max_width)] = dest
+                    else:
+                        open(os.path.join(os.path.dirname(dest), '.original'), 'w').close()
+
+        prepared_count = sum(1 for value in self.targets.values() if value is not None)
+        log(f"✓ Prepared {len(self.targets)} figure(s) at {self.dpi} dpi "
+            f"({len(pending)} converted, {prepared_count} replaced with downsampled copies)")
+
+    def apply(self, text):
+        """\\includegraphicsのパスを準備した図に置き換えた内容を返す"""
+        if not any(self.targets.values()):
+            return text
+
+        def replace(match):
+            key = self.target(match, text)
+            prepared = self.targets.get(key) if key is not None else None
+            if prepared is None:
+                return match.group(0)
+            relative = os.path.relpath(prepared, self.output_dir).replace(os.sep, '/')
+            options = f'[{match.group(1)}]' if match.group(1) is not None else ''
+            return f'\\includegraphics{options}{{{relative}}}'
+
+        return GRAPHICS.sub(replace, text)
+
+
+def prepare_figures(content, output_dir, project_root, log=print, jobs=None, file_hash=file_sha256):
+    """TeXの内容の\\includegraphicsを準備した図に置き換えた内容を返す"""
+    if not enabled():
+        return content
+    plan = FigurePlan(output_dir, project_root)
+    plan.scan(content)
+    if not plan.targets:
+        return content
+    plan.prepare(log=log, jobs=jobs, file_hash=file_hash)
+    return plan.apply(content)
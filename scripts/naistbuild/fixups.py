@@ -0,0 +1,311 @@
+"""
+post-render.shで行っていたTeXファイルの修正処理
+
+各関数はTeXの内容（文字列）とPostRenderContextを受け取り、修正後の内容を返す。
+ファイルの読み書きはpipeline.pyでまとめて1回だけ行う。
+"""
+import os
+import re
+
+from . import texgroups
+from .preamble import BEGIN_DOCUMENT, MONTH_NAMES
+
+MAKETITLE_COMMENT = '% \\maketitle removed (NAIST format uses \\titlepage)'
+
+# \begin{document}の直後に追加する設定（$number-depth$はexpand_preambleで展開される）
+DOCUMENT_SETTINGS_MARKER = 'secnumdepthを確実に設定（NAISTスタイルファイルの読み込み後に上書きされる可能性があるため）'
+DOCUMENT_SETTINGS = '''
+% secnumdepthを確実に設定（NAISTスタイルファイルの読み込み後に上書きされる可能性があるため）
+% \\AtBeginDocumentを使用して、\\begin{document}の後に確実に設定する
+% これにより、\\titlepageや\\cmemberspageなどのコマンドが実行された後でも、secnumdepthが3に設定される
+% number-depthの値はexpand_preambleで展開される（デフォルトは3）
+\\makeatletter
+\\AtBeginDocument{%
+  \\setcounter{secnumdepth}{$number-depth$}%
+  \\setcounter{tocdepth}{$number-depth$}%
+}
+\\makeatother
+% 目次のタイトルとハイパーリンクの設定（post-render.shで追加）
+\\makeatletter
+\\renewcommand*\\contentsname{目次}
+\\renewcommand*\\listfigurename{図目次}
+\\renewcommand*\\listtablename{表目次}
+\\hypersetup{
+  colorlinks=true,
+  linkcolor=black,
+  filecolor=black,
+  urlcolor=black,
+  citecolor=black
+}
+\\makeatother'''
+
+# NAISTフォーマットの必須要素（expand_preambleが失敗した場合のフォールバック）
+NAIST_ELEMENTS = [
+    '% NAISTフォーマットの必須要素\n',
+    '\\studentnumber{123456}\n',
+    '\\doctitle{\\mastersthesis}\n',
+    '\\major{\\engineering}\n',
+    '\\program{\\ise}\n'
+]
+
+
+def _is_comment(line):
+    return line.strip().startswith('%')
+
+
+def remove_legacy_includes(content, context):
+    """古いtemplate/preamble.tex、template/header.texへの参照を削除"""
+    markers = [
+        ('template/preamble.tex', '\\input{template/preamble.tex}', 'NAIST修士論文用LaTeXプリアンブル（手動追加）'),
+        ('template/header.tex', '\\input{template/header.tex}', 'NAIST修士論文用LaTeXヘッダー（手動追加）'),
+    ]
+    for path, command, comment in markers:
+        if path in content:
+            context.log(f"Removing old {path} reference...")
+            lines = content.splitlines(keepends=True)
+            content = ''.join(line for line in lines if command not in line and comment not in line)
+    return content
+
+
+def add_before_body(content, context):
+    """template/before-body.texの内容を\\begin{document}の後に追加（まだ含まれていない場合）"""
+    if '\\titlepage' in content or '\\cmemberspage' in content or '\\firstabstract' in content:
+        return content
+    before_body_file = os.path.join(context.project_root, 'template', 'before-body.tex')
+    if not os.path.exists(before_body_file):
+        context.log(f"Warning: {before_body_file} not found")
+        return content
+    with open(before_body_file, 'r', encoding='utf-8') as f:
+        before_body_content = f.read()
+    context.log("✓ Added template/before-body.tex to TeX file")
+    return BEGIN_DOCUMENT.sub(
+        lambda m: f'\\begin{{document}}\n% NAIST修士論文用LaTeX before-body（手動追加）\n{before_body_content}',
+        content, count=1
+    )
+
+
+def fix_secnumdepth(content, context):
+    """Quartoが生成する\\setcounter{secnumdepth}{-\\maxdimen}を上書き（subsubsectionまで表示）"""
+    return re.sub(r'\\setcounter\{secnumdepth\}\{-\\maxdimen\}[^%\n]*',
+                  lambda m: '\\setcounter{secnumdepth}{3} % show subsubsection', content)
+
+
+def remove_maketitle(content, context):
+    """\\maketitleを削除（NAISTフォーマットでは\\titlepageを使用）"""
+    lines = content.splitlines(keepends=True)
+    removed = False
+    for i, line in enumerate(lines):
+        if line.strip() == '\\maketitle':
+            lines[i] = MAKETITLE_COMMENT + '\n'
+            removed = True
+    if removed:
+        context.log("  ✓ Removed \\maketitle")
+        content = ''.join(lines)
+    return content
+
+
+def remove_pass_options(content, context):
+    """\\PassOptionsToPackageを削除（TeXLive 2018互換性、ltjsarticleとの衝突回避）"""
+    lines = content.splitlines(keepends=True)
+    new_lines = [line for line in lines if '\\PassOptionsToPackage' not in line or _is_comment(line)]
+    if len(new_lines) != len(lines):
+        context.log(f"  ✓ Removed {len(lines) - len(new_lines)} \\PassOptionsToPackage line(s)")
+    return ''.join(new_lines)
+
+
+def remove_at_begin_document(content, context):
+    """Quartoが自動生成した\\contentsnameなどの\\AtBeginDocumentブロックを削除"""
+    pieces = []
+    last = 0
+    for command in texgroups.find_commands(content, 'AtBeginDocument'):
+        # NAISTヘッダーのブロックは残し、Quartoの名前定義ブロックのみ削除
+        if '\\ifdefined\\contentsname' not in command.args[0]:
+            continue
+        # ブロックを含む行全体を削除
+        start = max(content.rfind('\n', 0, command.start) + 1, last)
+        end = content.find('\n', command.end)
+        end = len(content) if end < 0 else end + 1
+        first_line = content.count('\n', 0, start) + 1
+        last_line = first_line + content.count('\n', start, end) - 1
+        context.log(f"  ✓ Removed \\AtBeginDocument block (lines {first_line} to {last_line})")
+        pieces.append(content[last:start])
+        last = end
+    pieces.append(content[last:])
+    return ''.join(pieces)
+
+
+def ensure_begin_document(content, context):
+    """\\begin{document}が存在しない場合、\\date{...}の後に挿入"""
+    if re.search(r'^\\begin\{document\}', content, flags=re.MULTILINE):
+        return content
+    context.log("  ✓ Inserted \\begin{document}")
+    return re.sub(r'^(\\date\{.*\n)', lambda m: m.group(1) + '\\begin{document}\n', content, flags=re.MULTILINE)
+
+
+def move_title_author(content, context):
+    """\\titleと\\authorが\\begin{document}の前に存在することを確認"""
+    lines = content.splitlines(keepends=True)
+    doc_start_idx = next((i for i, line in enumerate(lines) if line.startswith('\\begin{document}')), None)
+    if doc_start_idx is None:
+        context.log("  ✗ \\begin{document} not found")
+        return content
+
+    preamble = [line for line in lines[:doc_start_idx] if not _is_comment(line)]
+    if any('\\title{' in line for line in preamble) and any('\\author{' in line for line in preamble):
+        return content
+
+    # \begin{document}の後に\titleと\authorを探す
+    title_line = None
+    author_line = None
+    for line in lines[doc_start_idx + 1:]:
+        if title_line is None and '\\title{' in line and not _is_comment(line):
+            title_line = line.strip()
+        if author_line is None and '\\author{' in line and not _is_comment(line):
+            author_line = line.strip()
+    if not (title_line and author_line):
+        context.log("  ✗ \\title or \\author not found")
+        return content
+
+    new_lines = [line for i, line in enumerate(lines)
+                 if i <= doc_start_idx or (title_line not in line and author_line not in line)]
+    new_lines[doc_start_idx:doc_start_idx] = [title_line + '\n', author_line + '\n']
+    context.log("  ✓ Moved \\title and \\author before \\begin{document}")
+    return ''.join(new_lines)
+
+
+def add_document_settings(content, context):
+    """\\begin{document}の直後に目次のタイトルとハイパーリンクの設定を追加"""
+    if DOCUMENT_SETTINGS_MARKER in content:
+        return content
+    if not BEGIN_DOCUMENT.search(content):
+        context.log("  ✗ \\begin{document} not found")
+        return content
+    context.log("  ✓ Added document settings after \\begin{document}")
+    return BEGIN_DOCUMENT.sub(lambda m: m.group(0) + DOCUMENT_SETTINGS, content, count=1)
+
+
+def set_figure_placement(content, context):
+    """図のデフォルト配置を独立ページ（[p]）に設定"""
+    return content.replace('\\def\\fps@figure{htbp}', '\\def\\fps@figure{p}')
+
+
+def remove_section_prefix(content, context):
+    """Section~\\ref{...}を\\ref{...}に置換（数字だけを表示するため）"""
+    return re.sub(r'Section~\\ref\{([^}]+)\}', r'\\ref{\1}', content)
+
+
+def add_edatestr_fallback(content, context):
+    """\\smonth, \\sday, \\esyearから\\edatestrを設定（\\def\\edatestrがない場合のフォールバック）"""
+    if '\\smonth{' not in content or '\\def\\edatestr' in content:
+        return content
+    month_match = re.search(r'\\smonth\{([^}]+)\}', content)
+    day_match = re.search(r'\\sday\{([^}]+)\}', content)
+    year_match = re.search(r'\\esyear\{([^}]+)\}', content)
+    if not (month_match and day_match and year_match) or not BEGIN_DOCUMENT.search(content):
+        return content
+    try:
+        month_name = MONTH_NAMES[int(month_match.group(1))]
+    except (ValueError, KeyError):
+        month_name = 'February'
+    edatestr_value = f'{month_name} {day_match.group(1)}, {year_match.group(1)}'
+    context.log(f"  ✓ Added \\def\\edatestr{{{edatestr_value}}}")
+    return BEGIN_DOCUMENT.sub(lambda m: f'\\def\\edatestr{{{edatestr_value}}}\n' + m.group(0), content, count=1)
+
+
+def remove_caption_label_separator(content, context):
+    """\\DeclareCaptionLabelSeparator{space}を削除（spacefactorエラーの原因となるため）"""
+    lines = content.splitlines(keepends=True)
+    return ''.join(line for line in lines if 'DeclareCaptionLabelSeparator{space}' not in line)
+
+
+def add_secnumdepth_after_introduction(content, context):
+    """\\section{はじめに}の直後に\\setcounter{secnumdepth}{3}を追加"""
+    if re.search(r'\\section\{はじめに\}[^\n]*\n[^\n]*\\setcounter\{secnumdepth\}', content):
+        return content
+    return re.sub(r'(\\section\{はじめに\}[^\n]*\n)', r'\1\\setcounter{secnumdepth}{3}\n', content, count=1)
+
+
+def remove_auto_bibliography(content, context):
+    """Quartoが自動的に追加した\\printbibliography（headingオプションなし）を削除"""
+    lines = content.splitlines(keepends=True)
+    new_lines = []
+    removed = False
+    for line in lines:
+        if line.strip() == '\\printbibliography':
+            removed = True
+            # 前の行が空行なら削除
+            if new_lines and new_lines[-1].strip() == '':
+                new_lines.pop()
+            continue
+        new_lines.append(line)
+    if removed:
+        context.log("  ✓ Removed auto-added \\printbibliography")
+    return ''.join(new_lines)
+
+
+def add_eabstracttext_fallback(content, context):
+    """\\eabstract{...}の後に\\def\\eabstracttext{...}を追加（naist-mcommon.styが読み込まれていない場合）"""
+    if '\\eabstract{' not in content or '\\def\\eabstracttext' in content:
+        return content
+    match = re.search(r'^.*\\eabstract\{([^}]+)\}.*\n', content, flags=re.MULTILINE)
+    if not match:
+        return content
+    context.log("  ✓ Added \\def\\eabstracttext")
+    return content[:match.end()] + f'\\def\\eabstracttext{{{match.group(1)}}}\n' + content[match.end():]
+
+
+def add_naist_elements_fallback(content, context):
+    """\\studentnumberなどのNAIST要素がない場合、\\begin{document}の前に追加"""
+    if '\\studentnumber{' in content:
+        return content
+    lines = content.splitlines(keepends=True)
+    doc_start_idx = next((i for i, line in enumerate(lines) if line.startswith('\\begin{document}')), None)
+    if doc_start_idx is None:
+        return content
+    context.log("  ✓ Added NAIST elements")
+    return ''.join(lines[:doc_start_idx] + NAIST_ELEMENTS + lines[doc_start_idx:])
+
+
+# expand_preambleの前に実行する修正（post-render.shの実行順）
+BEFORE_EXPAND = [
+    remove_legacy_includes,
+    add_before_body,
+    fix_secnumdepth,
+    remove_maketitle,
+    remove_pass_options,
+    remove_at_begin_document,
+    ensure_begin_document,
+    move_title_author,
+    add_document_settings,
+    set_figure_placement,
+]
+
+# expand_preambleの後に実行する修正
+AFTER_EXPAND = [
+    remove_section_prefix,
+    add_edatestr_fallback,
+    remove_caption_label_separator,
+    add_secnumdepth_after_introduction,
+    remove_auto_bibliography,
+    add_eabstracttext_fallback,
+    add_naist_elements_fallback,
+    remove_maketitle,
+]
+
+# 本文（最初の見出し以降）をチャンクごとに処理する場合に実行する修正
+# （行単位の修正のみ。プリアンブルや\begin{document}を対象とする修正は前半だけに実行する）
+BODY_BEFORE_EXPAND = [
+    remove_legacy_includes,
+    fix_secnumdepth,
+    remove_maketitle,
+    remove_pass_options,
+    set_figure_placement,
+]
+
+BODY_AFTER_EXPAND = [
+    remove_section_prefix,
+    remove_caption_label_separator,
+    add_secnumdepth_after_introduction,
+    remove_auto_bibliography,
+    remove_maketitle,
+]
@@ -0,0 +1,222 @@
+"""
+paper.qmdのYAMLフロントマターから論文情報の変数を読み込む
+
+PyYAMLがある場合はYAMLとして解析し、ない場合は簡易パーサーで解析する。
+LaTeX用に整形した変数は.naist-cache/vars.jsonにフロントマターのハッシュとともに
+保存し、フロントマターが変わるまで再利用する。naist-vars.luaも同じファイルを読むため、
+LuaフィルターとPythonの後処理で値（数式のエスケープなど）が食い違わない。paper_html.qmdなど
+ほかの文書の変数は.naist-cache/vars-<文書名>.jsonに保存し、HTML・Wordでも同じ値を使う。
+"""
+import hashlib
+import json
+import os
+import re
+import sys
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+from . import trace
+
+FRONT_MATTER = re.compile(r'^---\n(.*?)\n---', re.DOTALL)
+
+# 解析結果の保存先（プロジェクトルートから。cache.CACHE_DIRの中）
+VARS_FILE = os.path.join('.naist-cache', 'vars.json')
+VARS_VERSION = 1
+
+# 数式（$...$）を含むため、\\Utilizingのようなコマンドの除去を行わない変数
+KEEP_COMMANDS = ['keywords-japanese', 'keywords-english']
+
+# 変数として扱わないトップレベルのキー（number-depthはformatから別に読み取る）
+SKIP_KEYS = ['format', 'bibliography']
+
+
+def vars_file_for(qmd_file):
+    """文書の解析結果の保存先（プロジェクトルートから）。paper.qmdはVARS_FILE"""
+    name = os.path.splitext(os.path.basename(qmd_file))[0]
+    if name == 'paper':
+        return VARS_FILE
+    return os.path.join(os.path.dirname(VARS_FILE), f'vars-{name}.json')
+
+
+def read_front_matter(qmd_file):
+    """paper.qmdのYAMLフロントマター部分の文字列を返す。存在しない場合は空文字列"""
+    with open(qmd_file, 'r', encoding='utf-8') as f:
+        match = FRONT_MATTER.search(f.read())
+    return match.group(1) if match else ''
+
+
+def front_matter_hash(front_matter):
+    """フロントマターのSHA-1（naist-vars.luaのpandoc.utils.sha1と同じ値）"""
+    return hashlib.sha1(front_matter.encode('utf-8')).hexdigest()
+
+
+def latex_value(name, value):
+    """YAMLの値をLaTeXに埋め込む文字列に変換する"""
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    text = str(value)
+    # 複数行の値（|）は空行を除いて1段落にまとめる（\abstractなどの引数に\parを含めない）
+    text = '\n'.join(line.strip() for line in text.strip().splitlines() if line.strip())
+    # 数式内の\\pi（YAMLの単一引用符・|ではバックスラッシュが2つ残る）を\piに変換
+    text = re.sub(r'\$[^$]*\$', lambda m: re.sub(r'\\\\(?=[A-Za-z])', r'\\', m.group(0)), text)
+    if name not in KEEP_COMMANDS:
+        # \\Utilizingのような改行と、\Utilizingのような大文字で始まるコマンドを単純なテキストに変換
+        text = re.sub(r'\\\\([A-Z][a-z]+)', r'\1', text)
+        text = re.sub(r'\\([A-Z][a-z]+)', r'\1', text)
+    return text
+
+
+def _unquote(value):
+    """YAMLの引用符を外す（二重引用符の場合は\\\\と\\"のエスケープも戻す）"""
+    value = value.strip()
+    if len(value) >= 2 and value[0] == value[-1] == '"':
+        return value[1:-1].replace('\\\\', '\\').replace('\\"', '"')
+    if len(value) >= 2 and value[0] == value[-1] == "'":
+        return value[1:-1].replace("''", "'")
+    return value
+
+
+def _parse_simple(yaml_content):
+    """PyYAMLがない場合の簡易パーサー（トップレベルのキー: 値と|の複数行の値のみ）"""
+    data = {}
+    current_key = None
+    current_value = []
+    in_format_section = False
+
+    for line in yaml_content.split('\n'):
+        line_stripped = line.strip()
+        line_indent = len(line) - len(line.lstrip())
+
+        # コメント行は無視
+        if line_stripped.startswith('#'):
+            continue
+
+        # format:セクションの開始/終了を検出
+        if line_stripped.startswith('format:'):
+            in_format_section = True
+            continue
+        elif in_format_section and line_indent == 0 and line_stripped:
+            # formatセクションの終了（新しいトップレベルのキー）
+            in_format_section = False
+
+        # formatセクション内でも、number-depthは読み取る
+        if in_format_section:
+            if line_indent > 0 and ':' in line_stripped and not line_stripped.startswith('-'):
+                key, value = line_stripped.split(':', 1)
+                if key.strip() == 'number-depth':
+                    data.setdefault('format', {}).setdefault('naist-pdf', {})['number-depth'] = _unquote(value)
+            continue
+
+        # キー:値の形式（トップレベルのみ）
+        if line_indent == 0 and ':' in line and not line_stripped.startswith('-'):
+            # 前のキーの値を保存
+            if current_key:
+                data[current_key] = '\n'.join(current_value)
+            key, value = line.split(':', 1)
+            key = key.strip()
+            if value.strip() == '|':
+                # 複数行の値
+                current_key = key
+                current_value = []
+            elif not value.strip():
+                # crossref:のような入れ子のキー（変数としては扱わない）
+                data[key] = {}
+                current_key = None
+                current_value = []
+            else:
+                data[key] = _unquote(value)
+                current_key = None
+                current_value = []
+        elif current_key and (line.startswith('  ') or line.startswith('\t') or line_stripped == ''):
+            # 複数行の値の続き
+            current_value.append(line.lstrip())
+    # 最後のキーの値を保存
+    if current_key:
+        data[current_key] = '\n'.join(current_value)
+    return data
+
+
+def parse_front_matter(front_matter):
+    """フロントマターを解析し、(データ, 使用したパーサー名)を返す"""
+    if yaml is not None:
+        try:
+            data = yaml.safe_load(front_matter)
+            return (data if isinstance(data, dict) else {}), 'yaml'
+        except yaml.YAMLError as e:
+            print(f"  Warning: Failed to parse front matter as YAML ({e}). Using simple parser.", file=sys.stderr)
+    return _parse_simple(front_matter), 'simple'
+
+
+def to_variables(data):
+    """解析したフロントマターから、LaTeXに埋め込む変数名と値の辞書を作る"""
+    yaml_vars = {}
+    for key, value in data.items():
+        if key in SKIP_KEYS or isinstance(value, (dict, list)):
+            continue
+        yaml_vars[str(key)] = latex_value(str(key), value)
+    # format:セクション（naist-pdf: など）のnumber-depth
+    formats = data.get('format')
+    if isinstance(formats, dict):
+        for format_config in formats.values():
+            if isinstance(format_config, dict) and 'number-depth' in format_config:
+                yaml_vars['number-depth'] = latex_value('number-depth', format_config['number-depth'])
+                print(f"  Found number-depth in format section: {yaml_vars['number-depth']}", file=sys.stderr)
+                break
+    return yaml_vars
+
+
+def _read_vars_file(vars_file, digest):
+    try:
+        with open(vars_file, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cached.get('version') != VARS_VERSION or cached.get('front-matter-sha1') != digest:
+        return None
+    return cached.get('vars')
+
+
+def write_vars_file(vars_file, digest, parser, yaml_vars):
+    """解析結果をvars.jsonに保存する（一時ファイルに書いてから置き換える）"""
+    os.makedirs(os.path.dirname(vars_file), exist_ok=True)
+    tmp_file = vars_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump({'version': VARS_VERSION, 'front-matter-sha1': digest, 'parser': parser,
+                   'vars': yaml_vars}, f, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(tmp_file, vars_file)
+
+
+def load_yaml_vars(qmd_file, use_cache=True):
+    """paper.qmdのYAMLフロントマターを読み込み、変数名と値の辞書を返す
+
+    フロントマターのハッシュが.naist-cache/vars.jsonと同じ場合は、解析せずに保存した値を返す。
+    """
+    front_matter = read_front_matter(qmd_file)
+    digest = front_matter_hash(front_matter)
+    vars_file = os.path.join(os.path.dirname(os.path.abspath(qmd_file)), vars_file_for(qmd_file))
+
+    with trace.span('frontmatter', bytes_read=len(front_matter.encode('utf-8'))) as record:
+        yaml_vars = _read_vars_file(vars_file, digest) if use_cache else None
+        record['cached'] = yaml_vars is not None
+        if yaml_vars is not None:
+            print(f"✓ Loaded {len(yaml_vars)} YAML variables (cached in {vars_file_for(qmd_file)})")
+        else:
+            data, parser = parse_front_matter(front_matter)
+            record['parser'] = parser
+            yaml_vars = to_variables(data)
+            try:
+                write_vars_file(vars_file, digest, parser, yaml_vars)
+            except OSError as e:
+                print(f"  Warning: Failed to write {vars_file_for(qmd_file)}: {e}", file=sys.stderr)
+            print(f"✓ Loaded {len(yaml_vars)} YAML variables")
+
+    # デバッグ: 読み込んだ変数を表示
+    for key in ['supervisor', 'lab-name-japanese', 'japanese-year', 'submission-month', 'submission-day', 'number-depth']:
+        if key in yaml_vars:
+            print(f"  {key}: {yaml_vars[key][:50]}")
+    return yaml_vars
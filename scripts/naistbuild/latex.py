@@ -0,0 +1,221 @@
+"""
+収束するまでxelatexを繰り返すPDF生成のスケジューラ
+
+xelatexを固定で3回実行する代わりに、.aux、.toc、.lof、.lotが変化しなくなり、
+ログが再実行を求めなくなった時点で終了する。文献は最初に.bcfができた時点と.bcfの
+ハッシュが変わった場合（または.bblがない場合）に確認し、引用キー・使用する項目・
+スタイルが前回と同じ場合はキャッシュした.bblを使い、異なる場合のみ引用した文献だけを
+渡してbiberを実行する（bibliography.py）。
+固定のプリアンブルは、ダンプしたフォーマットから読み込む（texformat.py）。
+"""
+import glob
+import hashlib
+import os
+import re
+import subprocess
+import sys
+
+from . import bibliography, texformat, trace
+
+# 変化しなくなるまでxelatexを繰り返す補助ファイル
+CONVERGENCE_EXTENSIONS = ['.aux', '.toc', '.lof', '.lot']
+
+# 無限ループを防ぐためのxelatexの最大実行回数
+MAX_PASSES = 5
+
+# xelatexのログで再実行が求められている場合のメッセージ
+RERUN_PATTERN = re.compile(r'Rerun to get|Please rerun LaTeX|Label\(s\) may have changed|'
+                           r'Rerun LaTeX|has changed\. Rerun')
+
+
+def file_hash(path):
+    """ファイルのSHA-256を返す。存在しない場合はNone"""
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+class LatexScheduler:
+    """xelatexとbiber（bibtex）の実行回数を出力の収束に合わせて決める"""
+
+    def __init__(self, tex_file, stream=None, max_passes=MAX_PASSES, watch=()):
+        self.output_dir = os.path.dirname(tex_file) or '.'
+        # CONVERGENCE_EXTENSIONS以外に収束を確認するファイル（\includeした章の.auxなど）
+        self.watch = list(watch)
+        self.tex_name = os.path.basename(tex_file)
+        self.jobname = os.path.splitext(self.tex_name)[0]
+        self.stream = stream if stream is not None else sys.stdout
+        self.max_passes = max_passes
+        self.passes = 0
+        self.bibliography_runs = 0
+        # 最後に文献を確認した時点の.bcfのハッシュ（このビルドでまだ確認していない場合はNone）
+        self.bibliography_bcf = None
+        self.reasons = []
+        # 固定のプリアンブルをダンプしたフォーマット（使わない場合はNone）
+        self.preamble_format = None
+        self.format_file = None
+
+    def log(self, message):
+        print(message, file=self.stream)
+
+    def path(self, extension):
+        return os.path.join(self.output_dir, self.jobname + extension)
+
+    def snapshot(self):
+        state = {ext: file_hash(self.path(ext)) for ext in CONVERGENCE_EXTENSIONS}
+        for path in self.watch:
+            state[os.path.basename(path)] = file_hash(path)
+        return state
+
+    def tail(self, log_file, lines):
+        try:
+            with open(log_file, 'r', encoding='utf-8', errors='replace') as f:
+                for line in f.readlines()[-lines:]:
+                    self.log(line.rstrip('\n'))
+        except OSError:
+            pass
+
+    def run(self, command, log_name):
+        """コマンドをoutput_dirで実行し、出力をlog_nameに保存する。成功した場合True"""
+        log_file = os.path.join(self.output_dir, log_name)
+        with trace.subprocess_span(command[0], command, log=log_file) as record:
+            try:
+                with open(log_file, 'w', encoding='utf-8') as f:
+                    result = subprocess.run(command, cwd=self.output_dir, stdout=f, stderr=subprocess.STDOUT)
+            except FileNotFoundError:
+                record['error'] = 'not found'
+                self.log(f"  ✗ {command[0]} not found. Please install TeX Live.")
+                return False
+            record['exit_code'] = result.returncode
+        return result.returncode == 0
+
+    def read_log(self):
+        try:
+            with open(self.path('.log'), 'r', encoding='utf-8', errors='replace') as f:
+                return f.read()
+        except OSError:
+            return ''
+
+    def run_xelatex(self, reason):
+        self.passes += 1
+        self.reasons.append(reason)
+        log_name = f'{self.jobname}-xelatex-{self.passes}.log'
+        self.log(f"  [xelatex {self.passes}] Running xelatex ({reason})...")
+        command = ['xelatex', '-interaction=nonstopmode', '-halt-on-error', self.tex_name]
+        format_log = None
+        if self.format_file:
+            if self.run(command[:1] + [f'-fmt={self.format_file}'] + command[1:], log_name):
+                return True
+            # 本文の誤りでも失敗するため、通常の読み込みでやり直して、フォーマットが原因かを確かめる
+            format_log = f'{self.jobname}-xelatex-{self.passes}-format.log'
+            os.replace(os.path.join(self.output_dir, log_name), os.path.join(self.output_dir, format_log))
+        if not self.run(command, log_name):
+            # 通常の読み込みでも失敗する場合はフォーマットの問題ではないため、フォーマットは使い続ける
+            if format_log:
+                os.remove(os.path.join(self.output_dir, format_log))
+            self.log(f"  ✗ xelatex (pass {self.passes}) failed. Check {log_name}")
+            self.tail(os.path.join(self.output_dir, log_name), 20)
+            return False
+        if format_log:
+            # フォーマットでだけ失敗した場合は、プリアンブルが変わるまでフォーマットを使わない
+            self.preamble_format.reject(f'xelatex failed only with the format, see {format_log}')
+            self.format_file = None
+        return True
+
+    def run_bibliography(self):
+        """biber（.bcfがある場合）またはbibtexを実行する。失敗しても続行する"""
+        self.bibliography_runs += 1
+        if os.path.exists(self.path('.bcf')):
+            self.bibliography_bcf = file_hash(self.path('.bcf'))
+            # 引用した文献だけをbiberに渡し、引用が前回と同じ場合はキャッシュした.bblを使う
+            plan = bibliography.plan_biber(self.output_dir, self.jobname)
+            if plan.restore():
+                self.log(f"  [biber] Citations unchanged. Reused cached {self.jobname}.bbl ({plan.summary})")
+                return
+            self.log(f"  [biber] Running biber (processing bibliography, {plan.summary})...")
+            ok = self.run(plan.command, f'{self.jobname}-biber.log')
+            if not ok and plan.cache_key is not None:
+                self.log("  ⚠ biber failed with the cited-only bibliography. Retrying with all entries...")
+                plan.cache_key = None
+                ok = self.run(['biber', self.jobname], f'{self.jobname}-biber.log')
+            if ok:
+                plan.store()
+            else:
+                self.log("  ⚠ biber failed (version mismatch). Continuing anyway...")
+                self.tail(os.path.join(self.output_dir, f'{self.jobname}-biber.log'), 5)
+                self.log("  Note: Bibliography may not be generated. Please upgrade biber to 2.15+ for biblatex 3.21.")
+        else:
+            self.log("  [bibtex] Running bibtex (processing bibliography)...")
+            if not self.run(['bibtex', self.jobname], f'{self.jobname}-bibtex.log'):
+                self.log(f"  ✗ bibtex failed. Check {self.jobname}-bibtex.log")
+                self.tail(os.path.join(self.output_dir, f'{self.jobname}-bibtex.log'), 10)
+
+    def bibliography_reason(self):
+        """biber（bibtex）を実行すべき理由を返す。不要な場合はNone"""
+        if os.path.exists(self.path('.bcf')):
+            # 文献ファイル（references/*.bib）の編集は.bcfに現れないため、ビルドごとに1回は
+            # 確認する（biberを実行するかはplan_biber().restore()が入力のハッシュで決める）
+            if self.bibliography_bcf is None:
+                return 'first check in this build'
+            if file_hash(self.path('.bcf')) != self.bibliography_bcf:
+                return '.bcf changed'
+            if not os.path.exists(self.path('.bbl')):
+                return '.bbl missing'
+            return None
+        # biblatexを使わない場合（bibtex）: \bibdataがあり.bblがない場合のみ
+        aux = self.path('.aux')
+        if os.path.exists(aux) and not os.path.exists(self.path('.bbl')):
+            with open(aux, 'r', encoding='utf-8', errors='replace') as f:
+                if '\\bibdata' in f.read():
+                    return '.bbl missing'
+        return None
+
+    def build(self):
+        """PDFを生成し、成功した場合Trueを返す"""
+        # 前回のビルドで残った各回のログを削除（今回の実行回数と対応させる）
+        for old_log in glob.glob(os.path.join(self.output_dir, f'{self.jobname}-xelatex-*.log')):
+            os.remove(old_log)
+        if texformat.enabled():
+            self.preamble_format = texformat.PreambleFormat(self)
+            self.format_file = self.preamble_format.prepare()
+        reason = 'initial pass'
+        while reason:
+            if self.passes >= self.max_passes:
+                self.log(f"  ⚠ Output did not converge after {self.passes} xelatex passes ({reason}). Stopping.")
+                break
+            before = self.snapshot()
+            bbl_before = file_hash(self.path('.bbl'))
+            if not self.run_xelatex(reason):
+                return False
+            log_text = self.read_log()
+
+            reason = None
+            bibliography_reason = self.bibliography_reason()
+            if bibliography_reason:
+                self.log(f"  Bibliography needs update ({bibliography_reason})")
+                self.run_bibliography()
+                if file_hash(self.path('.bbl')) != bbl_before:
+                    reason = 'bibliography changed'
+
+            changed = [ext for ext, value in self.snapshot().items() if before[ext] != value]
+            if changed:
+                reason = ', '.join(changed) + ' changed' + (f'; {reason}' if reason else '')
+            elif not reason and RERUN_PATTERN.search(log_text):
+                reason = 'log requested rerun'
+
+        self.log(f"✓ PDF generated after {self.passes} xelatex pass(es) and "
+                 f"{self.bibliography_runs} bibliography run(s)")
+        for i, pass_reason in enumerate(self.reasons, 1):
+            self.log(f"  pass {i}: {pass_reason}")
+        return True
+
+
+def build_pdf(tex_file, stream=None, max_passes=MAX_PASSES, watch=()):
+    """tex_fileからPDFを生成する（TEXINPUTSは呼び出し側で設定する）"""
+    scheduler = LatexScheduler(tex_file, stream=stream, max_passes=max_passes, watch=watch)
+    with trace.span('latex', tex_file=tex_file) as record:
+        ok = scheduler.build()
+        record.update(ok=ok, passes=scheduler.passes, bibliography_runs=scheduler.bibliography_runs)
+        return ok
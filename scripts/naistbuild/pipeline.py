@@ -0,0 +1,220 @@
+"""
+Quartoが生成したTeXファイルの後処理パイプライン
+
+TeXファイルを1回だけ読み込み、fixups.pyの修正とYAML変数の展開をすべて
+メモリ上で行ってから、1回だけ書き戻す。大きいTeXファイルは、前半（プリアンブルと
+表紙・目次など）だけをメモリ上で処理し、本文はチャンクごとに処理する（streaming.py）。
+入力が前回と同じ場合はcache.pyに記録した後処理済みのTeXファイルを再利用する。
+"""
+import os
+import sys
+
+from . import cache, figures, fixups, frontmatter, preamble, readiness, streaming, trace
+
+
+class PostRenderContext:
+    """後処理の各段階で共有する情報"""
+
+    def __init__(self, tex_file, project_root, yaml_vars=None, stream=None):
+        self.tex_file = tex_file
+        self.project_root = project_root
+        self.yaml_vars = yaml_vars if yaml_vars is not None else {}
+        self.stream = stream if stream is not None else sys.stdout
+
+    @property
+    def output_dir(self):
+        return os.path.dirname(self.tex_file) or '.'
+
+    def log(self, message):
+        print(message, file=self.stream)
+
+
+def find_tex_file(tex_file):
+    """TeXファイルが存在しない場合、_output/paper.texまたはpaper.texを探す"""
+    if os.path.exists(tex_file):
+        return tex_file
+    for candidate in ['_output/paper.tex', 'paper.tex']:
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def wait_for_quarto(tex_file, qmd_file, timeout=10.0):
+    """paper.qmdがTeXファイルより新しい場合、Quartoのレンダリングが完了するまで待つ"""
+    if not (os.path.exists(qmd_file) and os.path.exists(tex_file)):
+        return True
+    if readiness.is_ready(tex_file, qmd_file):
+        return True
+    print(f"  paper.qmd is newer than {tex_file}. Waiting for Quarto to finish rendering...", file=sys.stderr)
+    if readiness.wait_until_ready([tex_file], qmd_file, timeout) is None:
+        print(f"  Warning: {tex_file} was not updated within {timeout:g} seconds", file=sys.stderr)
+        return False
+    print("  TeX file has been updated by Quarto", file=sys.stderr)
+    return True
+
+
+def expand_preamble(content, context):
+    """YAML変数を展開し、Quartoが生成した\\hypersetupを削除"""
+    yaml_vars = context.yaml_vars
+    edatestr_value = preamble.edatestr_value(yaml_vars, content)
+    content, table = preamble.expand(content, yaml_vars)
+
+    if table.count('number-depth'):
+        context.log(f"  Expanded $number-depth$ to {yaml_vars.get('number-depth', '3')}")
+    for key in ['lab-name-japanese', 'supervisor']:
+        if key in yaml_vars:
+            if table.count(key):
+                context.log(f"  Replacing {key}: {yaml_vars[key]}")
+            else:
+                context.log(f"  Warning: {key} pattern not found in TeX file")
+    for key in preamble.MEMBER_DEFAULTS:
+        if table.count(f'{key} condition'):
+            context.log(f"  Replaced {key} condition")
+    for key in ['third-member', 'third-position', 'fourth-member', 'fourth-position',
+                'fifth-member', 'fifth-position', 'sixth-member', 'sixth-position']:
+        if table.count(key):
+            context.log(f"  Replaced ${key}$ placeholder with: '{yaml_vars.get(key, '').strip()}'")
+    if table.count('cmembers fourth'):
+        context.log("  Replaced fourth member arguments in \\cmembers with empty strings")
+    if edatestr_value and (table.count('edatestr-placeholder') or table.count('edatestr')):
+        context.log(f"  Set \\edatestr to: {edatestr_value}")
+
+    # Quartoが生成した\hypersetupを削除（本文に表示されないようにする）
+    content, removed_count = preamble.remove_hypersetup(content)
+    if removed_count > 0:
+        context.log(f"  Removed {removed_count} \\hypersetup command(s) with pdfauthor/pdftitle")
+    return content
+
+
+def restore_postprocess(build_cache, inputs, context):
+    """入力が前回と同じ場合、後処理済みのTeXファイルをキャッシュから戻してTrueを返す"""
+    fresh = build_cache.is_fresh('postprocess', inputs)
+    if not fresh and inputs['tex'] == build_cache.output_hash('postprocess', 'paper.tex'):
+        # Quartoが再生成していない（既に後処理済みの）TeXファイル
+        fresh = build_cache.is_fresh('postprocess', inputs, ignore=['tex'])
+    if not fresh:
+        return False
+    build_cache.restore('postprocess', context.output_dir)
+    preamble.expand_aux_files(context.output_dir)
+    context.log(f"✓ Inputs unchanged. Reused cached post-processed {context.tex_file}")
+    return True
+
+
+def postprocess(tex_file, project_root, stream=None, use_cache=True):
+    """TeXファイルを読み込み、すべての修正を行ってから1回だけ書き戻す"""
+    with trace.span('postprocess', tex_file=tex_file) as record:
+        return _postprocess(tex_file, project_root, stream, use_cache, record)
+
+
+def run_fixups(content, context):
+    """fixups.pyの修正とYAML変数の展開を順に行う（トレースが有効な場合は各段階を記録）"""
+    for fixup in fixups.BEFORE_EXPAND:
+        with trace.span(f'fixup:{fixup.__name__}'):
+            content = fixup(content, context)
+    with trace.span('expand_preamble'):
+        content = expand_preamble(content, context)
+    for fixup in fixups.AFTER_EXPAND:
+        with trace.span(f'fixup:{fixup.__name__}'):
+            content = fixup(content, context)
+    return content
+
+
+def transform(content, context, file_hash=figures.file_sha256):
+    """Quartoが生成したTeXの内容にすべての修正を行った内容を返す（ファイルの読み書きはしない）"""
+    content = run_fixups(content, context)
+    # 図を表示される大きさに縮小したものに置き換える
+    with trace.span('figures'):
+        content = figures.prepare_figures(content, context.output_dir, context.project_root, log=context.log,
+                                          file_hash=file_hash)
+    return content
+
+
+def transform_stream(tex_file, context, file_hash=figures.file_sha256):
+    """TeXファイルをメモリ使用量を抑えて後処理し、(読み込んだバイト数, 書き込んだバイト数)を返す
+
+    前半にはtransformと同じ修正を行い、本文にはfixups.BODY_BEFORE_EXPAND・BODY_AFTER_EXPANDの
+    行単位の修正とYAML変数の展開だけをチャンクごとに行う。
+    """
+    plan = None
+    if figures.enabled():
+        # 図の変換は本文を書き換える前にまとめて行う（1行ずつ読んで\includegraphicsを集める）
+        plan = figures.FigurePlan(context.output_dir, context.project_root)
+        with open(tex_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                if 'includegraphics' in line:
+                    plan.scan(line)
+        if plan.targets:
+            with trace.span('figures'):
+                plan.prepare(log=context.log, file_hash=file_hash)
+
+    bytes_read = bytes_written = 0
+    with open(tex_file, 'r', encoding='utf-8') as source, streaming.atomic_writer(tex_file) as output:
+        front, first_line = streaming.read_front(source)
+        bytes_read += len(front.encode('utf-8'))
+        front = run_fixups(front, context)
+        if plan is not None:
+            front = plan.apply(front)
+        output.write(front)
+        bytes_written += len(front.encode('utf-8'))
+
+        # 本文の$p$などの数式は残す（未定義の変数を空にするのはプリアンブルのみ）
+        table = preamble.build_table(context.yaml_vars, front)
+        table.missing = None
+        introduction_done = False
+        with trace.span('body', streaming=True) as record:
+            for chunk in streaming.iter_chunks(source, first_line):
+                bytes_read += len(chunk.encode('utf-8'))
+                for fixup in fixups.BODY_BEFORE_EXPAND:
+                    chunk = fixup(chunk, context)
+                chunk = table.substitute(chunk)
+                for fixup in fixups.BODY_AFTER_EXPAND:
+                    # \section{はじめに}の直後への追加は最初の1回のみ（ファイル全体の場合と同じ）
+                    if fixup is fixups.add_secnumdepth_after_introduction and introduction_done:
+                        continue
+                    chunk = fixup(chunk, context)
+                introduction_done = introduction_done or '\\section{はじめに}' in chunk
+                if plan is not None:
+                    chunk = plan.apply(chunk)
+                output.write(chunk)
+                bytes_written += len(chunk.encode('utf-8'))
+            record['bytes_written'] = bytes_written
+    return bytes_read, bytes_written
+
+
+def _postprocess(tex_file, project_root, stream, use_cache, record):
+    qmd_file = os.path.join(project_root, 'paper.qmd')
+    context = PostRenderContext(tex_file, project_root, stream=stream)
+    build_cache = None
+    if use_cache and cache.enabled():
+        build_cache = cache.BuildCache(project_root)
+        inputs = build_cache.stage_inputs('postprocess', tex_file)
+        if restore_postprocess(build_cache, inputs, context):
+            record['cached'] = True
+            return None
+    if os.path.exists(qmd_file):
+        context.yaml_vars = frontmatter.load_yaml_vars(qmd_file)
+
+    file_hash = build_cache.file_hash if build_cache is not None else figures.file_sha256
+    if streaming.enabled(tex_file):
+        context.log(f"  Streaming {tex_file} ({os.path.getsize(tex_file) / (1 << 20):.1f} MiB) in chunks")
+        record['streaming'] = True
+        record['bytes_read'], record['bytes_written'] = transform_stream(tex_file, context, file_hash)
+        content = None
+    else:
+        with open(tex_file, 'r', encoding='utf-8') as f:
+            content = f.read()
+        record['bytes_read'] = len(content.encode('utf-8'))
+
+        content = transform(content, context, file_hash)
+
+        # 一時ファイルに書いてから置き換える（途中で中断しても壊れたTeXファイルを残さない）
+        with streaming.atomic_writer(tex_file) as f:
+            f.write(content)
+        record['bytes_written'] = len(content.encode('utf-8'))
+
+    # .toc、.lof、.lotファイルも処理（?contents?を置き換える）
+    preamble.expand_aux_files(context.output_dir)
+    if build_cache is not None:
+        build_cache.record('postprocess', inputs, context.output_dir)
+    context.log(f"✓ Post-processed {tex_file}")
+    return content
@@ -0,0 +1,252 @@
+"""
+Quartoが生成したTeXファイルのYAML変数・既定値スロットを展開する
+
+expand_preamble.pyで行っていた個別の置換を、1つのSlotTableにまとめて
+1回の走査で展開する。
+"""
+import os
+import re
+
+from . import streaming, texgroups, trace
+from .substitute import SlotTable
+
+MONTH_NAMES = {
+    1: 'January', 2: 'February', 3: 'March', 4: 'April',
+    5: 'May', 6: 'June', 7: 'July', 8: 'August',
+    9: 'September', 10: 'October', 11: 'November', 12: 'December'
+}
+
+# 審査委員3・4人目の既定値（header-expanded.texの旧形式）
+MEMBER_DEFAULTS = {
+    'third-member': ('tempthird', '○○ ○○ 准教授'),
+    'third-position': ('tempthirdpos', '（副指導教員，情報科学領域）'),
+    'fourth-member': ('tempfourth', '○○ ○○ 准教授'),
+    'fourth-position': ('tempfourthpos', '（△△大学）'),
+}
+
+# 目次・図目次・表目次の名前（Mtex形式に合わせて日本語に統一）
+TOC_NAMES_TEX = {
+    '?contents?': '目次',
+    '?listfigure?': '図目次',
+    '?listtable?': '表目次',
+    '?Contents?': '目次',
+    '?Listfigure?': '図目次',
+    '?Listtable?': '表目次',
+    '?figure?': 'Figure',
+    '?table?': 'Table',
+}
+
+# .toc、.lof、.lotファイル内の名前
+TOC_NAMES_AUX = {
+    '?contents?': 'Contents',
+    '?listfigure?': 'List of Figures',
+    '?listtable?': 'List of Tables',
+    '?figure?': 'Figure',
+    '?table?': 'Table',
+}
+
+# \contentsnameなどの定義の置換（\newcommand版は英語のまま）
+NAME_DEFINITIONS = [
+    (r'\\renewcommand\*\\contentsname\{[^}]+\}', '\\renewcommand*\\contentsname{目次}'),
+    (r'\\newcommand\\contentsname\{[^}]+\}', '\\newcommand\\contentsname{目次}'),
+    (r'\\renewcommand\*\\listfigurename\{[^}]+\}', '\\renewcommand*\\listfigurename{図目次}'),
+    (r'\\newcommand\\listfigurename\{[^}]+\}', '\\newcommand\\listfigurename{List of Figures}'),
+    (r'\\renewcommand\*\\listtablename\{[^}]+\}', '\\renewcommand*\\listtablename{表目次}'),
+    (r'\\newcommand\\listtablename\{[^}]+\}', '\\newcommand\\listtablename{List of Tables}'),
+]
+
+# 行頭の\begin{document}
+BEGIN_DOCUMENT = re.compile(r'^\\begin\{document\}', flags=re.MULTILINE)
+
+# \cmembersの引数の数（主指導教員から4人目までの氏名と所属）
+CMEMBERS_NARGS = 8
+
+
+def escape_value(value):
+    """YAMLの$\\\\pi$（バックスラッシュ2つ）をLaTeXの$\\pi$に変換する"""
+    return value.replace('$\\\\pi$', '$\\pi$')
+
+
+def edatestr_value(yaml_vars, tex_content):
+    """\\edatestrの値（例: February 20, 2025）を返す。求められない場合はNone"""
+    month_value = yaml_vars.get('submission-month', '')
+    day_value = yaml_vars.get('submission-day', '')
+    year_value = yaml_vars.get('english-year', '')
+
+    # YAML変数から取得できない場合は、\smonth{}, \sday{}, \esyear{}から値を読み取る（フォールバック）
+    if not month_value or not day_value or not year_value:
+        month_match = re.search(r'\\smonth\{([^}$]+)\}', tex_content)
+        day_match = re.search(r'\\sday\{([^}$]+)\}', tex_content)
+        year_match = re.search(r'\\esyear\{([^}$]+)\}', tex_content)
+        if month_match:
+            month_value = month_match.group(1)
+        if day_match:
+            day_value = day_match.group(1)
+        if year_match:
+            year_value = year_match.group(1)
+
+    if not (month_value and day_value and year_value):
+        return None
+    try:
+        month_name = MONTH_NAMES.get(int(month_value), '')
+    except ValueError:
+        return None
+    return f'{month_name} {day_value}, {year_value}'
+
+
+def blank_fourth_member(table):
+    """\\cmembersの4人目（7・8番目の引数）を空にするコマンドスロットの処理を返す"""
+    def handler(command, text):
+        if not all(arg.strip() for arg in command.args):
+            return None
+        # 前半（\\cmembersから6番目の引数まで）に含まれるスロットも同じテーブルで展開する
+        # （前半には引数が6つしかないため、\\cmembersのコマンドスロットには再びマッチしない）
+        head = table.substitute(text[command.start:command.spans[5][1]])
+        gap = text[command.spans[5][1]:command.spans[6][0]]
+        return f'{head}{gap}{{}}{{}}'
+    return handler
+
+
+def build_table(yaml_vars, tex_content):
+    """YAML変数からTeXファイル用のSlotTableを作成する"""
+    table = SlotTable()
+
+    # $var-name$形式のYAML変数
+    for var_name, var_value in yaml_vars.items():
+        table.variable(var_name, escape_value(var_value))
+    table.variable('number-depth', yaml_vars.get('number-depth', '3'))
+    for name in ['fourth-member', 'fourth-position', 'fifth-member',
+                 'fifth-position', 'sixth-member', 'sixth-position']:
+        if name not in yaml_vars:
+            table.variable(name, '')
+
+    # 存在しない変数のプレースホルダーはプリアンブル内でのみ空文字列に置換
+    # （本文中の$p$などの数式は残す）
+    doc_match = BEGIN_DOCUMENT.search(tex_content)
+    doc_start = doc_match.start() if doc_match else len(tex_content)
+    table.missing = lambda name, match: '' if match.start() < doc_start else None
+
+    # 研究室名
+    if 'lab-name-japanese' in yaml_vars:
+        table.literal('\\jlabname{xxx 研究室}',
+                      f'\\jlabname{{{yaml_vars["lab-name-japanese"]}}}', label='lab-name-japanese')
+    if 'lab-name-english' in yaml_vars:
+        table.literal('\\elabname{xxx Lab.}',
+                      f'\\elabname{{{yaml_vars["lab-name-english"]}}}', label='lab-name-english')
+
+    # 審査委員
+    if 'supervisor' in yaml_vars:
+        table.literal('\\cmembers{○○ ○○ 教授}{（主指導教員，情報科学領域）}',
+                      f'\\cmembers{{{yaml_vars["supervisor"]}}}{{（主指導教員，情報科学領域）}}',
+                      label='supervisor')
+        table.literal('Professor ○○ ○○ 教授', f'Professor {yaml_vars["supervisor"]}')
+    if 'co-supervisor' in yaml_vars:
+        co_supervisor = yaml_vars['co-supervisor']
+        table.pattern(r'(\s+)\{○○ ○○ 教授\}\s*\{（副指導教員，情報科学領域）\}',
+                      lambda m: f'{m.group(1)}{{{co_supervisor}}}{{（副指導教員，情報科学領域）}}',
+                      label='co-supervisor')
+
+    # 3・4人目: \def\tempX{既定値}と\cmembers内の条件分岐
+    for key, (macro, default) in MEMBER_DEFAULTS.items():
+        condition = f'{{\\ifx\\{macro}\\empty\\else\\{macro}\\fi}}'
+        if key in yaml_vars:
+            value = yaml_vars[key]
+            table.literal(f'\\def\\{macro}{{{default}}}', f'\\def\\{macro}{{{value}}}')
+            if value.strip():
+                table.literal(condition, f'{{{value}}}', label=f'{key} condition')
+        elif key.startswith('fourth-'):
+            # 4人目がコメントアウトされている場合は空文字列を設定
+            table.literal(f'\\def\\{macro}{{{default}}}', f'\\def\\{macro}{{}}')
+            table.literal(condition, '{}', label=f'{key} condition')
+
+    # 4人目が未設定の場合、\cmembersの4番目の引数を空にする
+    fourth_member = yaml_vars.get('fourth-member', '').strip()
+    fourth_position = yaml_vars.get('fourth-position', '').strip()
+    if not fourth_member or not fourth_position:
+        table.command('cmembers', CMEMBERS_NARGS, blank_fourth_member(table), label='cmembers fourth')
+
+    # \edatestr
+    edatestr = edatestr_value(yaml_vars, tex_content)
+    table.variable('edatestr-placeholder', edatestr or '')
+    if edatestr:
+        table.literal('\\def\\edatestr{}', f'\\def\\edatestr{{{edatestr}}}', label='edatestr')
+        # naist-mcommon.styの\edatestr定義を上書きするため、naist-jmthesis.styの読み込み後に\defで再定義
+        redef = f'\n% naist-mcommon.styの\\edatestr定義を上書き\n\\makeatletter\n\\def\\edatestr{{{edatestr}}}\n\\makeatother\n'
+        # 既に再定義が追加されている場合は追加しない（再実行時の重複を防ぐ）
+        if '% naist-mcommon.styの\\edatestr定義を上書き' not in tex_content:
+            # フォーマットにダンプするプリアンブル（texformat.py）の後に追加する
+            for anchor in ['\\input{template/naist-jmthesis.sty}\n\\makeatother\n\\csname endofdump\\endcsname',
+                           '\\input{template/naist-jmthesis.sty}\n\\makeatother',
+                           '\\input{template/naist-jmthesis.sty}']:
+                table.literal(anchor, anchor + redef, label='edatestr after sty')
+        # \begin{document}の直前にも追加（naist-mcommon.styの定義を確実に上書き）
+        redef_doc = f'% \\edatestrを再定義（naist-mcommon.styの定義を上書き）\n\\makeatletter\n\\def\\edatestr{{{edatestr}}}\n\\makeatother\n'
+        # コメント中の\begin{document}を避けるため、行頭のもののみ対象にする
+        if '% \\edatestrを再定義（naist-mcommon.styの定義を上書き）' not in tex_content:
+            table.pattern(r'(?m:^)\\begin\{document\}', lambda m: redef_doc + m.group(0),
+                          label='edatestr before document')
+
+    # ?contents?、?listfigure?、?listtable?を日本語に変更（Mtex形式）
+    for old_value, new_value in TOC_NAMES_TEX.items():
+        table.literal(old_value, new_value)
+    for regex, replacement in NAME_DEFINITIONS:
+        table.pattern(regex, lambda m, r=replacement: r)
+
+    # \listoftablesの前の\newpageを削除（表目次は改ページしない）
+    table.pattern(r'\\newpage\s*\\listoftables', lambda m: '\\listoftables')
+
+    return table
+
+
+def expand(tex_content, yaml_vars):
+    """TeXの内容を1回の走査で展開し、(展開後の内容, SlotTable)を返す"""
+    table = build_table(yaml_vars, tex_content)
+    return table.substitute(tex_content), table
+
+
+def aux_table():
+    """.toc、.lof、.lotファイル用のSlotTableを作成する"""
+    table = SlotTable()
+    for old_value, new_value in TOC_NAMES_AUX.items():
+        table.literal(old_value, new_value)
+    return table
+
+
+def remove_hypersetup(tex_content):
+    """pdftitle、pdfauthor、pdflang、pdfcreatorが含まれる\\hypersetupをすべて削除し、(内容, 削除数)を返す"""
+    pieces = []
+    last = 0
+    for command in texgroups.find_commands(tex_content, 'hypersetup'):
+        if not any(keyword in command.args[0] for keyword in ['pdftitle', 'pdfauthor', 'pdflang', 'pdfcreator']):
+            continue
+        # 前後の空白行も削除
+        before_start = command.start
+        after_end = command.end
+        # 前の行が空行の場合は削除（直前に削除した範囲とは重ねない）
+        if before_start > last and tex_content[before_start-1] == '\n':
+            j = before_start - 2
+            while j >= last and tex_content[j] in [' ', '\t']:
+                j -= 1
+            if j >= last and tex_content[j] == '\n':
+                before_start = j + 1
+        # 後の行が空行の場合は削除
+        if after_end < len(tex_content) and tex_content[after_end] == '\n':
+            after_end += 1
+        pieces.append(tex_content[last:before_start])
+        last = after_end
+    pieces.append(tex_content[last:])
+    return ''.join(pieces), len(pieces) - 1
+
+
+def expand_aux_files(output_dir):
+    """.toc、.lof、.lotファイルの?contents?などを置き換える"""
+    toc_table = aux_table()
+    with trace.span('aux', output_dir=output_dir) as record:
+        record['bytes_read'] = record['bytes_written'] = 0
+        for toc_file_name in ['paper.toc', 'paper.lof', 'paper.lot']:
+            toc_file = os.path.join(output_dir, toc_file_name)
+            if os.path.exists(toc_file):
+                # 1行ずつ置換できるため、行単位のチャンクごとに書き換える
+                bytes_read, bytes_written = streaming.rewrite(toc_file, toc_table.substitute)
+                record['bytes_read'] += bytes_read
+                record['bytes_written'] += bytes_written
@@ -0,0 +1,127 @@
+"""
+Quartoが生成したTeXファイルの書き込み完了を待つ
+
+一定時間sleepして様子を見る代わりに、TeXファイルの末尾の\\end{document}を
+完了の目印として確認し、まだ書き込み中の場合はLinuxのinotifyで書き込み完了
+（IN_CLOSE_WRITE）などのイベントを待つ。inotifyが使えない環境（macOSなど）では、
+間隔を徐々に伸ばしながらポーリングする。
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import sys
+import time
+
+from . import trace
+
+# TeXファイルの書き込みが完了したことを示す末尾の行
+COMPLETION_MARKER = b'\\end{document}'
+
+# inotifyのイベント（<sys/inotify.h>）
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+# ポーリングの間隔（秒）: 最初は短く、待つほど長くする
+POLL_INITIAL = 0.05
+POLL_MAX = 1.0
+
+
+def tex_complete(tex_file):
+    """TeXファイルが\\end{document}で終わっていればTrue"""
+    try:
+        with open(tex_file, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(0, size - 256))
+            return f.read().rstrip().endswith(COMPLETION_MARKER)
+    except OSError:
+        return False
+
+
+def is_ready(tex_file, newer_than=None):
+    """TeXファイルが書き込み済みで、newer_than（paper.qmdなど）より新しければTrue"""
+    if not tex_complete(tex_file):
+        return False
+    if newer_than and os.path.exists(newer_than):
+        try:
+            return os.path.getmtime(tex_file) >= os.path.getmtime(newer_than)
+        except OSError:
+            return False
+    return True
+
+
+class InotifyWatcher:
+    """ディレクトリ内のファイルの作成・書き込み完了・移動を待つ"""
+
+    def __init__(self, directories):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        for directory in directories:
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(directory),
+                                        IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+            if wd < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), f'inotify_add_watch failed: {directory}')
+
+    def wait(self, timeout):
+        """イベントが届くかtimeout秒経つまで待つ（イベントの内容は呼び出し側で確認し直す）"""
+        readable, _, _ = select.select([self.fd], [], [], max(0, timeout))
+        if readable:
+            try:
+                while os.read(self.fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+def create_watcher(paths):
+    """inotifyが使える場合はInotifyWatcherを、使えない場合はNoneを返す"""
+    if not sys.platform.startswith('linux'):
+        return None
+    directories = sorted({os.path.dirname(os.path.abspath(path)) for path in paths})
+    directories = [d for d in directories if os.path.isdir(d)]
+    if not directories:
+        return None
+    try:
+        return InotifyWatcher(directories)
+    except (OSError, AttributeError):
+        return None
+
+
+def wait_until_ready(candidates, newer_than=None, timeout=15.0):
+    """候補のTeXファイルのうち最初に準備ができたもののパスを返す。timeout秒経っても準備できない場合はNone"""
+    with trace.span('wait', timeout=timeout) as record:
+        tex_file = _wait_until_ready(candidates, newer_than, timeout, record)
+        record['ready'] = tex_file
+        return tex_file
+
+
+def _wait_until_ready(candidates, newer_than, timeout, record):
+    deadline = time.monotonic() + timeout
+    watcher = create_watcher(candidates)
+    record['method'] = 'poll' if watcher is None else 'inotify'
+    delay = POLL_INITIAL
+    try:
+        while True:
+            # ウォッチを登録してから確認する（確認とイベントの間の書き込みを取りこぼさない）
+            for tex_file in candidates:
+                if is_ready(tex_file, newer_than):
+                    return tex_file
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            if watcher is not None:
+                watcher.wait(remaining)
+            else:
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, POLL_MAX)
+    finally:
+        if watcher is not None:
+            watcher.close()
@@ -0,0 +1,271 @@
+"""
+PDF・HTML・Wordの同時レンダリング（naistbuild render）
+
+paper.qmd（PDF）、paper_html.qmd、paper_word.qmdは同じ章ファイルから作られるが、
+1つずつレンダリングすると、フロントマターの解析や文献データベースの読み込みを形式ごとに
+繰り返し、待ち時間はそれぞれの時間の合計になる。ここでは共通の準備を1回だけ行ってから、
+各形式のquarto renderを別のプロセスで同時に実行する（待ち時間は最も遅い形式の時間になる）。
+
+  - 共通の準備: すべての文書のフロントマターの解析（.naist-cache/vars*.json。各プロセスの
+    pre-render.shは保存した値を使う）と、HTML・Wordの文書ごとの、本文で引用された文献だけの.bibの
+    作成（文書のbibliography:の文献ファイルから選ぶ。citeprocには数千件の文献ファイルの代わりにこれを渡す）
+  - PDF: QuartoにはTeXファイルだけを生成させ（naist-latex）、post-render.shで1回だけ組版する
+  - HTML・Word: 各形式のquarto render（post-render.shは何もしない）
+
+引用キーは本文（章ファイルを含む）とnocite:から探す。文献ファイルにないキーがある場合や
+nocite: @*の場合は、文書に書かれた文献ファイルをそのまま使う。チャンクやインラインのRの出力で
+作られた引用は事前にわからないため、レンダリングのログにciteprocが見つけられなかった引用が
+あり、それが元の文献ファイルにある場合は、元の文献ファイルでレンダリングし直す。
+
+計算チャンクは形式の間で共有しない。knitrは文書・形式ごとに実行され（図のデバイスや
+出力が形式によって異なるため）、同時にレンダリングしても、チャンクは形式の数だけ実行される。
+2回目以降は、文書・形式ごとのknitrのキャッシュ（chunk-cache.R）で再実行が省略される。
+"""
+import concurrent.futures
+import os
+import re
+import signal
+import subprocess
+import time
+
+from . import batch, bibliography, cache, frontmatter, streaming
+
+# 各形式のログと共通の準備の保存先（プロジェクトルートから）
+RENDER_DIR = os.path.join(cache.CACHE_DIR, 'render')
+
+# (形式, 文書, quarto renderの--to（Noneは文書のformat:）, 出力ファイル)
+FORMATS = [
+    ('pdf', 'paper.qmd', 'naist-latex', 'paper.pdf'),
+    ('html', 'paper_html.qmd', None, 'paper_html.html'),
+    ('docx', 'paper_word.qmd', None, 'paper_word.docx'),
+]
+
+# 本文の引用（@key、[@key; @key2]、@{key}）。メールアドレスなど直前が英数字の場合は除く
+CITATION = re.compile(r'(?<![\w@])@(?:\{([^}\s]+)\}|(\w[\w:.#$%&+?<>~/-]*))')
+# 図表などの相互参照（@fig-xxx）の接頭辞（文献の引用ではない）
+CROSSREF_PREFIXES = ('fig-', 'tbl-', 'lst-', 'eq-', 'sec-', 'apx-', 'thm-', 'lem-', 'cor-', 'prp-', 'cnj-',
+                     'def-', 'exm-', 'exr-', 'sol-', 'rem-', 'tip-', 'nte-', 'wrn-', 'imp-', 'cau-')
+# 文献ファイルの一覧（簡易パーサーの場合。- references/a.bib  # コメント）
+BIBLIOGRAPHY_ITEMS = re.compile(r'^bibliography:[ \t]*((?:#.*)?\n(?:[ \t]+-[ \t]*[^\n]*\n?)+)', re.MULTILINE)
+# citeprocが文献ファイルに見つけられなかった引用（[WARNING] Citeproc: citation xxx not found）
+UNRESOLVED = re.compile(r'Citeproc: citation (\S+) not found')
+
+
+def source_files(project_root, documents):
+    """文書と、文書から読み込まれる章ファイル（{{< include >}}）のパスを返す"""
+    files = []
+    pending = [os.path.join(project_root, document) for document in documents]
+    while pending:
+        path = pending.pop(0)
+        if path in files or not os.path.exists(path):
+            continue
+        files.append(path)
+        with open(path, 'r', encoding='utf-8') as f:
+            for match in cache.INCLUDE_PATTERN.finditer(f.read()):
+                pending.append(os.path.join(os.path.dirname(path), match.group(1)))
+    return files
+
+
+def cited_keys(paths):
+    """本文で引用されたキーの集合（図表の相互参照@fig-などは除く）"""
+    keys = set()
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+        for match in CITATION.finditer(text):
+            # 文末の句読点はキーに含めない（@key.の場合）
+            key = match.group(1) or match.group(2).rstrip('.:')
+            if not key.startswith(CROSSREF_PREFIXES):
+                keys.add(key)
+    return keys
+
+
+def _string_list(value):
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, list):
+        return [item for item in value if isinstance(item, str)]
+    return []
+
+
+def declared_bibliography(qmd_file):
+    """文書のフロントマターのbibliography:とnocite:を(文献ファイルのリスト, nocite:の文字列)で返す"""
+    front_matter = frontmatter.read_front_matter(qmd_file)
+    data, parser = frontmatter.parse_front_matter(front_matter)
+    files = _string_list(data.get('bibliography'))
+    if not files and parser == 'simple':
+        # 簡易パーサーは一覧を扱わないため、- で始まる行を読む
+        match = BIBLIOGRAPHY_ITEMS.search(front_matter + '\n')
+        if match:
+            for line in match.group(1).splitlines()[1:]:
+                item = line.strip()[1:].split(' #', 1)[0].strip().strip('"\'')
+                if item:
+                    files.append(item)
+    base_dir = os.path.dirname(qmd_file)
+    nocite = data.get('nocite')
+    return [os.path.join(base_dir, path) for path in files], nocite if isinstance(nocite, str) else ''
+
+
+class CitedBibliography:
+    """1つの文書の、引用された文献だけの.bib"""
+
+    def __init__(self, path, known):
+        self.path = path
+        # 元の文献ファイルのキー（大文字・小文字を区別しない）
+        self.known = known
+
+    def missing(self, log_text):
+        """ログでciteprocが見つけられなかった引用のうち、元の文献ファイルにあるもの"""
+        return sorted({key for key in UNRESOLVED.findall(log_text) if key.casefold() in self.known})
+
+
+def write_cited_bib(project_root, document):
+    """文書で引用された文献だけの.bibを作成し、CitedBibliographyを返す
+
+    元の文献ファイルをそのまま使う場合はNone
+    """
+    qmd_file = os.path.join(project_root, document)
+    bib_files, nocite = declared_bibliography(qmd_file)
+    if not bib_files or '@*' in nocite:
+        return None
+    keys = cited_keys(source_files(project_root, [document]))
+    keys.update(match.group(1) or match.group(2).rstrip('.:') for match in CITATION.finditer(nocite))
+    entries = []
+    for bib_file in bib_files:
+        if not bib_file.endswith('.bib') or not os.path.exists(bib_file):
+            # CSL JSONなどの文献ファイルは選ばずにそのまま使う
+            return None
+        with open(bib_file, 'r', encoding='utf-8') as f:
+            parsed = bibliography.parse_bib(f.read())
+        if parsed is None:
+            return None
+        entries.extend(parsed)
+    known = {key.casefold() for _, key, _ in entries if key}
+    unresolved = sorted(key for key in keys if key.casefold() not in known)
+    if not keys or unresolved:
+        if unresolved:
+            print(f"  {document}: {', '.join(unresolved[:5])} not found in the bibliography. "
+                  f"Using the full bibliography.")
+        return None
+    name = os.path.splitext(os.path.basename(document))[0]
+    path = os.path.join(project_root, RENDER_DIR, f'{name}-cited.bib')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    streaming.write_if_changed(path, '\n\n'.join(bibliography.select_entries(entries, keys)) + '\n')
+    return CitedBibliography(os.path.relpath(path, project_root), known)
+
+
+def format_command(document, to, cited_bib):
+    command = ['quarto', 'render', document]
+    if to:
+        command += ['--to', to]
+    elif cited_bib:
+        command += ['-M', f'bibliography:{cited_bib.path}']
+    return command
+
+
+def run_process(command, cwd, env, log, timeout):
+    """コマンドを新しいセッションで実行し、終了コード（時間内に終わらない場合はNone）を返す"""
+    process = subprocess.Popen(command, cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT,
+                               start_new_session=True)
+    try:
+        return process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGTERM)
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+        return None
+
+
+def render_format(project_root, name, document, to, output, cited_bib=None, timeout=None):
+    """1つの形式をレンダリングし、batch.BatchResultを返す（スレッドプールのワーカーから呼ばれる）"""
+    start = time.monotonic()
+    started_at = time.time()
+    env = {key: value for key, value in os.environ.items() if key not in batch.ISOLATED_ENV}
+    # post-render.shは何もしない（PDFはquarto renderの後にこのワーカーが生成する）
+    env['NAIST_RENDER_ALL'] = '1'
+    log_file = os.path.join(RENDER_DIR, f'{name}.log')
+    log_path = os.path.join(project_root, log_file)
+    os.makedirs(os.path.join(project_root, RENDER_DIR), exist_ok=True)
+    with open(log_path, 'w', encoding='utf-8') as log:
+        def run(command):
+            """コマンドを実行し、失敗した場合はBatchResultを返す"""
+            log.write(f"$ {' '.join(command)}\n")
+            log.flush()
+            deadline = timeout - (time.monotonic() - start) if timeout else None
+            try:
+                returncode = run_process(command, project_root, env, log, deadline)
+            except FileNotFoundError as e:
+                return batch.BatchResult(name, 'failed', time.monotonic() - start, f'{e.filename} not found')
+            if returncode is None:
+                return batch.BatchResult(name, 'timeout', time.monotonic() - start, f'see {log_file}')
+            if returncode != 0:
+                return batch.BatchResult(name, 'failed', time.monotonic() - start,
+                                         f'exit code {returncode}, see {log_file}')
+            return None
+
+        failure = run(format_command(document, to, cited_bib))
+        if failure is None and cited_bib:
+            # チャンクなどの出力で引用された文献が選んだ.bibにない場合は、元の文献ファイルで作り直す
+            with open(log_path, 'r', encoding='utf-8', errors='replace') as f:
+                missing = cited_bib.missing(f.read())
+            if missing:
+                log.write(f"Citations not in {cited_bib.path}: {', '.join(missing[:5])}. "
+                          f"Rendering again with the full bibliography.\n")
+                failure = run(format_command(document, to, None))
+        if failure is None and name == 'pdf':
+            env.pop('NAIST_RENDER_ALL')
+            failure = run(['bash', os.path.join('scripts', 'post-render.sh')])
+        if failure is not None:
+            return failure
+    seconds = time.monotonic() - start
+    output_file = os.path.join(project_root, output)
+    if not os.path.exists(output_file) or os.path.getmtime(output_file) < started_at:
+        return batch.BatchResult(name, 'failed', seconds, f'{output} was not updated, see {log_file}')
+    with open(log_path, 'r', encoding='utf-8', errors='replace') as f:
+        # post-render.shはxelatexが失敗しても0で終了するため、ログでも確認する
+        if '✗' in f.read():
+            return batch.BatchResult(name, 'failed', seconds, f'errors in {log_file}')
+    return batch.BatchResult(name, 'ok', seconds, f'{output} ({os.path.getsize(output_file) / 1024:.0f} KiB)')
+
+
+def render_all(project_root, names=None, timeout=None):
+    """指定した形式（省略した場合は文書があるすべての形式）を同時にレンダリングし、すべて成功した場合Trueを返す"""
+    formats = [entry for entry in FORMATS
+               if (not names or entry[0] in names) and os.path.exists(os.path.join(project_root, entry[1]))]
+    if not formats:
+        print("Error: no documents to render")
+        return False
+    start = time.monotonic()
+
+    # 共通の準備（各形式のプロセスを起動する前に1回だけ行う）
+    for _, document, _, _ in formats:
+        frontmatter.load_yaml_vars(os.path.join(project_root, document))
+    cited_bibs = {}
+    for name, document, to, _ in formats:
+        # PDFの文献はpost-render.sh（biber）が引用された項目だけを選ぶ
+        if to is None:
+            cited_bibs[name] = write_cited_bib(project_root, document)
+            if cited_bibs[name]:
+                print(f"✓ Wrote references cited in {document} to {cited_bibs[name].path}")
+
+    print(f"Rendering {', '.join(name for name, _, _, _ in formats)} concurrently...")
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(formats)) as executor:
+        futures = {executor.submit(render_format, project_root, name, document, to, output,
+                                   cited_bibs.get(name), timeout): name
+                   for name, document, to, output in formats}
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = batch.BatchResult(name, 'failed', 0.0, f'{type(e).__name__}: {e}')
+            mark = '✓' if result.status == 'ok' else '✗'
+            print(f"  {mark} {name}: {result.status} ({result.seconds:.1f}s)")
+            results[name] = result
+    ordered = [results[name] for name, _, _, _ in formats]
+    batch.print_summary(ordered, time.monotonic() - start, label='format')
+    return all(result.status == 'ok' for result in ordered)
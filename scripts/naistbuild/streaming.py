@@ -0,0 +1,161 @@
+"""
+ファイル全体をメモリに読み込まずに書き換えるためのストリーミング処理
+
+巨大な表を含む付録などでTeXファイルが大きい場合、ファイル全体の文字列と置換の途中の
+コピーでファイルサイズの数倍のメモリが必要になる。ここでは内容をCHUNK_SIZEごとに
+行単位で区切って処理し、一時ファイルに書き終えてから元のファイルと置き換える
+（途中で中断しても元のファイルは壊れない）。
+
+TeXファイルや.toc・.lof・.lotなどの出力はすべてatomic_writer・write_if_changedで書き込む。
+内容が前と同じ場合は置き換えないため、更新時刻が変わらず、post-render.shの-ntによる
+比較やエディタ・プレビューの再読み込みが不要に起きない。
+"""
+import contextlib
+import os
+import re
+import shutil
+
+# 1回に処理する大きさ（文字数の目安。行の途中では区切らない）
+CHUNK_SIZE = 1 << 20
+# このサイズ以上のTeXファイルはストリーミングで後処理する
+STREAM_THRESHOLD = 16 << 20
+# 次のチャンクに持ち越す空行の上限（空行だけが続く場合にチャンクが大きくならないようにする）
+MAX_CARRY = 64
+
+# 行頭の\begin{document}（preamble.BEGIN_DOCUMENTと同じ。preamble.pyから読み込まれるため別に定義する）
+BEGIN_DOCUMENT = re.compile(r'\\begin\{document\}')
+# 本文の始まり（\begin{document}の後の最初の見出し）
+BODY_START = re.compile(r'\\(?:part|chapter|section)\*?\s*[\[{]')
+
+
+def enabled(tex_file):
+    """環境変数NAIST_STREAM=1で常に、NAIST_STREAM=0で使わない。それ以外はファイルサイズで決める"""
+    setting = os.environ.get('NAIST_STREAM', '')
+    if setting in ('0', '1'):
+        return setting == '1'
+    try:
+        return os.path.getsize(tex_file) >= STREAM_THRESHOLD
+    except OSError:
+        return False
+
+
+def read_front(f):
+    """プリアンブルと表紙・概要・目次など（本文の最初の見出しの前まで）を読み込む
+
+    (前半の内容, 本文の最初の行)を返す。見出しがない場合は残りすべてが前半になる。
+    """
+    lines = []
+    in_document = False
+    for line in f:
+        if in_document and BODY_START.match(line):
+            return ''.join(lines), line
+        if BEGIN_DOCUMENT.match(line):
+            in_document = True
+        lines.append(line)
+    return ''.join(lines), ''
+
+
+def iter_chunks(f, first='', chunk_size=None):
+    """firstとfの残りの内容を、約chunk_sizeごとに行単位で区切って返す
+
+    各チャンクの最後の行（とその直前の空行）は次のチャンクの先頭に持ち越す。
+    前後の行を見る修正（\\printbibliographyの前の空行の削除など）がチャンクの境目でも
+    ファイル全体を処理した場合と同じ結果になるようにするため。
+    """
+    chunk_size = chunk_size or CHUNK_SIZE
+    buffer = [first] if first else []
+    size = len(first)
+    for line in f:
+        buffer.append(line)
+        size += len(line)
+        if size < chunk_size:
+            continue
+        keep = 1
+        while keep < min(len(buffer), MAX_CARRY) and not buffer[-keep - 1].strip():
+            keep += 1
+        # 持ち越す行だけの場合（空行だけが続く場合）は、区切らずに次の行を読む
+        if keep < len(buffer):
+            yield ''.join(buffer[:-keep])
+            buffer = buffer[-keep:]
+            size = sum(len(kept) for kept in buffer)
+    if buffer:
+        yield ''.join(buffer)
+
+
+@contextlib.contextmanager
+def atomic_writer(path):
+    """path.tmpに書き込み、withブロックが正常に終了した場合のみpathと置き換える
+
+    書き込んだ内容がpathと同じ場合は置き換えない（pathの更新時刻を変えない）。
+    """
+    tmp_file = path + '.tmp'
+    try:
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            yield f
+        replace_if_changed(tmp_file, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_file)
+        raise
+
+
+def same_content(first, second):
+    """2つのファイルの内容が同じ場合Trueを返す（大きいファイルも少しずつ比較する）"""
+    try:
+        if os.path.getsize(first) != os.path.getsize(second):
+            return False
+        with open(first, 'rb') as f1, open(second, 'rb') as f2:
+            while True:
+                block1 = f1.read(CHUNK_SIZE)
+                if block1 != f2.read(CHUNK_SIZE):
+                    return False
+                if not block1:
+                    return True
+    except OSError:
+        return False
+
+
+def replace_if_changed(tmp_file, path):
+    """tmp_fileの内容がpathと異なる場合はpathと置き換え、同じ場合は削除する。置き換えた場合Trueを返す"""
+    if same_content(tmp_file, path):
+        os.remove(tmp_file)
+        return False
+    os.replace(tmp_file, path)
+    return True
+
+
+def write_if_changed(path, content):
+    """内容が変わった場合のみ一時ファイル経由で書き込み、書き込んだ場合Trueを返す"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            if f.read() == content:
+                return False
+    except (OSError, UnicodeDecodeError):
+        pass
+    with atomic_writer(path) as f:
+        f.write(content)
+    return True
+
+
+def copy_if_changed(source, path):
+    """sourceの内容がpathと異なる場合のみ一時ファイル経由でコピーし、コピーした場合Trueを返す"""
+    tmp_file = path + '.tmp'
+    try:
+        shutil.copyfile(source, tmp_file)
+        return replace_if_changed(tmp_file, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_file)
+        raise
+
+
+def rewrite(path, transform, chunk_size=None):
+    """pathをチャンクごとにtransformで書き換え、(読み込んだバイト数, 書き込んだバイト数)を返す"""
+    bytes_read = bytes_written = 0
+    with open(path, 'r', encoding='utf-8') as source, atomic_writer(path) as output:
+        for chunk in iter_chunks(source, chunk_size=chunk_size):
+            bytes_read += len(chunk.encode('utf-8'))
+            chunk = transform(chunk)
+            bytes_written += len(chunk.encode('utf-8'))
+            output.write(chunk)
+    return bytes_read, bytes_written
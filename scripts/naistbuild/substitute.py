@@ -0,0 +1,153 @@
+"""
+TeX文字列を1回の走査で置換する置換エンジン
+
+$var-name$、\\def\\tempX{...}、?listfigure? などのスロットを1つの正規表現に
+まとめ、1つのルックアップテーブル（SlotTable）で解決する。
+\\cmembers{..}{..}...のように引数の波括弧の対応が必要なコマンドは、texgroups.pyで
+引数を読み取ってから置換する。置換結果は再走査しないため、処理時間はTeXファイルの
+サイズに比例する。
+"""
+import re
+
+from . import texgroups
+
+# $variable-name$形式のプレースホルダー
+VARIABLE_PATTERN = r'\$(?P<vname>[A-Za-z0-9_-]+)\$'
+
+
+class SlotTable:
+    """置換スロット（変数・固定文字列・正規表現・コマンド）のルックアップテーブル"""
+
+    def __init__(self):
+        self.variables = {}
+        self.literals = {}
+        self.patterns = []
+        self.commands = []
+        # 未定義の$name$を処理する関数（Noneを返すとそのまま残す）
+        self.missing = None
+        # ラベルごとの置換回数（ログ出力用）
+        self.hits = {}
+        self._compiled = None
+        self._fallback = None
+
+    def variable(self, name, value):
+        """$name$をvalueに置換する"""
+        self.variables[name] = value
+        self._compiled = None
+
+    def literal(self, text, replacement, label=None):
+        """固定文字列textをreplacement（文字列または関数）に置換する"""
+        self.literals[text] = (replacement, label)
+        self._compiled = None
+
+    def pattern(self, regex, handler, label=None):
+        """正規表現regexにマッチした部分をhandler(match)の戻り値に置換する"""
+        self.patterns.append((re.compile(regex), handler, label))
+        self._compiled = None
+
+    def command(self, name, nargs, handler, label=None):
+        """コメント外の\\nameとnargs個の引数をhandler(command, text)の戻り値に置換する
+
+        commandはtexgroups.Command。handlerがNoneを返した場合や引数が足りない場合は、
+        同じ位置で他のスロットを試す。
+        """
+        self.commands.append((name, nargs, handler, label))
+        self._compiled = None
+
+    def count(self, label):
+        """labelの置換回数を返す"""
+        return self.hits.get(label, 0)
+
+    def _hit(self, label):
+        if label is not None:
+            self.hits[label] = self.hits.get(label, 0) + 1
+
+    def _alternatives(self):
+        alternatives = []
+        # 正規表現スロットを先に試す（固定文字列を含む長い構文を優先するため）
+        for index, (regex, _, _) in enumerate(self.patterns):
+            alternatives.append(f'(?P<p{index}>{regex.pattern})')
+        if self.literals:
+            # 同じ位置では長い文字列を優先する
+            literals = sorted(self.literals, key=len, reverse=True)
+            alternatives.append('(?P<lit>' + '|'.join(re.escape(s) for s in literals) + ')')
+        alternatives.append(f'(?P<var>{VARIABLE_PATTERN})')
+        return alternatives
+
+    def compile(self):
+        """すべてのスロットを1つの正規表現にまとめる"""
+        if self._compiled is None:
+            alternatives = self._alternatives()
+            # コマンドスロットを最優先にし、使えない場合は_fallback（コマンド以外）で再マッチする
+            commands = [f'(?P<c{index}>{texgroups.command_pattern(name)})'
+                        for index, (name, _, _, _) in enumerate(self.commands)]
+            self._compiled = re.compile('|'.join(commands + alternatives))
+            self._fallback = re.compile('|'.join(alternatives))
+        return self._compiled
+
+    def _resolve(self, match):
+        kind = match.lastgroup
+        if kind == 'var':
+            name = match.group('vname')
+            if name in self.variables:
+                self._hit(name)
+                return self.variables[name]
+            if self.missing is not None:
+                value = self.missing(name, match)
+                if value is not None:
+                    self._hit(name)
+                    return value
+            return match.group(0)
+        if kind == 'lit':
+            text = match.group('lit')
+            replacement, label = self.literals[text]
+            self._hit(label)
+            return replacement(text) if callable(replacement) else replacement
+        regex, handler, label = self.patterns[int(kind[1:])]
+        self._hit(label)
+        # スロット自身の正規表現で再マッチして、グループ番号をずらさずに渡す
+        return handler(regex.fullmatch(match.group(0)))
+
+    def _resolve_command(self, text, match, scanner):
+        """コマンドスロットを解決し、(置換文字列, 次の走査位置)を返す。使えない場合はNone"""
+        name, nargs, handler, label = self.commands[int(match.lastgroup[1:])]
+        if texgroups.in_comment(text, match.start()):
+            return None
+        command = texgroups.parse_arguments(text, match.start(), match.end(), nargs, scanner)
+        if command is None:
+            return None
+        replacement = handler(command, text)
+        if replacement is None:
+            return None
+        self._hit(label)
+        return replacement, command.end
+
+    def substitute(self, text):
+        """textを1回走査して、すべてのスロットを置換した文字列を返す"""
+        regex = self.compile()
+        if not self.commands:
+            return regex.sub(self._resolve, text)
+        # 閉じていない引数の後ろのコマンドで、毎回テキストの最後まで走査し直さないようにする
+        scanner = texgroups.GroupScanner(text)
+        pieces = []
+        pos = 0
+        while True:
+            match = regex.search(text, pos)
+            if match is None:
+                break
+            start = match.start()
+            pieces.append(text[pos:start])
+            resolved = None
+            if match.lastgroup.startswith('c'):
+                resolved = self._resolve_command(text, match, scanner)
+                if resolved is None:
+                    # 同じ位置で他のスロットを試す。どれにもマッチしなければ1文字進める
+                    match = self._fallback.match(text, start)
+                    if match is None:
+                        resolved = (text[start], start + 1)
+            if resolved is None:
+                resolved = (self._resolve(match), match.end())
+            pieces.append(resolved[0])
+            pos = resolved[1]
+        pieces.append(text[pos:])
+        return ''.join(pieces)
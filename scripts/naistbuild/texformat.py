@@ -0,0 +1,157 @@
+"""
+固定のプリアンブルをダンプしたxelatexのフォーマット（.fmt）
+
+xelatexは各パスでbxjsarticle、unicode-math、template/naist-jmthesis.styなどを毎回
+読み込み直す。header.texの\\csname endofdump\\endcsname（mylatexformatの目印）までの
+プリアンブルは論文の内容によらないため、mylatexformatでフォーマットにダンプしておき、
+各パスはそのフォーマットから始めて目印の後だけを読み込む（目印はフォーマットを使わない
+場合は何もしない）。
+
+フォーマットは目印までの内容、template/のスタイルファイル、TeXの配布物（xelatexの
+バージョンと基本のフォーマットファイル）のハッシュごとに.naist-cache/latex-format/に
+保存する。プリアンブルやスタイルファイルが変わった場合は作り直し、ダンプできない場合
+（XeTeXはOpenTypeフォントを読み込んだ状態をダンプできない）やフォーマットでの実行に
+失敗した場合は、そのハッシュでは通常の読み込みに戻す。
+"""
+import glob
+import hashlib
+import os
+import shutil
+import subprocess
+
+from . import cache
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+FORMAT_DIR = os.path.join(cache.CACHE_DIR, 'latex-format')
+# 保存するフォーマットの数（古いものから削除する）
+FORMAT_CACHE_SIZE = 4
+
+# ダンプするプリアンブルの終わり（_extensions/naist/partials/header.tex）
+BOUNDARY = '\\csname endofdump\\endcsname'
+
+# フォーマットの内容に影響するスタイルファイル（プロジェクトルートからのglobパターン）
+STYLE_FILES = ['template/*.sty', 'template/*.tex']
+
+_distribution = None
+
+
+def enabled():
+    """環境変数NAIST_FORMAT=0で無効"""
+    return os.environ.get('NAIST_FORMAT', '1') != '0'
+
+
+def distribution_id():
+    """TeXの配布物を表す文字列（xelatexのバージョンと基本のフォーマットファイル）。見つからない場合はNone"""
+    global _distribution
+    if _distribution is None:
+        try:
+            version = subprocess.run(['xelatex', '--version'], capture_output=True, text=True).stdout
+            base = subprocess.run(['kpsewhich', '-engine=xetex', 'xelatex.fmt'],
+                                  capture_output=True, text=True).stdout.strip()
+            mylatexformat = subprocess.run(['kpsewhich', 'mylatexformat.ltx'],
+                                           capture_output=True, text=True).stdout.strip()
+        except OSError:
+            return None
+        if not base or not mylatexformat:
+            return None
+        stat = os.stat(base)
+        _distribution = f'{version.splitlines()[0] if version else ""}\n{base}:{stat.st_size}:{stat.st_mtime_ns}'
+    return _distribution
+
+
+def read_prefix(tex_file):
+    """TeXファイルの目印までの内容を返す（目印がない場合はNone）"""
+    lines = []
+    with open(tex_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            lines.append(line)
+            if line.strip() == BOUNDARY:
+                return ''.join(lines)
+            if line.startswith('\\begin{document}'):
+                return None
+    return None
+
+
+def format_key(prefix):
+    distribution = distribution_id()
+    if distribution is None:
+        return None
+    digest = hashlib.sha256()
+    for part in [prefix, distribution]:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    for pattern in STYLE_FILES:
+        for path in sorted(glob.glob(os.path.join(PROJECT_ROOT, pattern))):
+            digest.update(os.path.basename(path).encode('utf-8'))
+            with open(path, 'rb') as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()[:32]
+
+
+class PreambleFormat:
+    """1つのTeXファイルのためのフォーマット（LatexSchedulerから使う）"""
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.key = None
+        prefix = read_prefix(os.path.join(scheduler.output_dir, scheduler.tex_name))
+        if prefix is not None:
+            self.key = format_key(prefix)
+
+    @property
+    def cache_dir(self):
+        return os.path.join(PROJECT_ROOT, FORMAT_DIR)
+
+    def path(self, extension):
+        return os.path.join(self.cache_dir, self.key + extension)
+
+    def prepare(self):
+        """使えるフォーマットのパス（拡張子なし）を返す。使えない場合はNone"""
+        if self.key is None or not cache.enabled():
+            return None
+        if os.path.exists(self.path('.fmt')):
+            # 最近使ったものとして残す
+            os.utime(self.path('.fmt'))
+            self.scheduler.log(f"  [format] Preamble unchanged. Using precompiled format {self.key[:8]}")
+            return self.path('')
+        if os.path.exists(self.path('.failed')):
+            return None
+        return self.dump()
+
+    def dump(self):
+        """mylatexformatで目印までのプリアンブルをダンプする"""
+        scheduler = self.scheduler
+        jobname = f'{scheduler.jobname}-format'
+        scheduler.log(f"  [format] Preamble changed. Dumping precompiled format {self.key[:8]}...")
+        command = ['xelatex', '-ini', '-interaction=nonstopmode', '-halt-on-error', f'-jobname={jobname}',
+                   '&xelatex', 'mylatexformat.ltx', scheduler.tex_name]
+        fmt_file = os.path.join(scheduler.output_dir, jobname + '.fmt')
+        if not scheduler.run(command, f'{jobname}-ini.log') or not os.path.exists(fmt_file):
+            self.reject(f'dump failed, see {jobname}-ini.log')
+            return None
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # 別のビルドディレクトリで同じフォーマットを同時にダンプしても互いに上書きしないようにする
+        tmp_file = self.path(f'.fmt.{os.getpid()}.tmp')
+        shutil.move(fmt_file, tmp_file)
+        os.replace(tmp_file, self.path('.fmt'))
+        self.prune()
+        return self.path('')
+
+    def prune(self):
+        """古いフォーマットと失敗の記録を削除する"""
+        for pattern in ['*.fmt', '*.failed']:
+            cached = sorted(glob.glob(os.path.join(self.cache_dir, pattern)), key=os.path.getmtime, reverse=True)
+            for old_file in cached[FORMAT_CACHE_SIZE:]:
+                os.remove(old_file)
+
+    def reject(self, reason):
+        """このハッシュのフォーマットを使わないことを記録する（プリアンブルが変わるまで再試行しない）"""
+        self.scheduler.log(f"  ⚠ Precompiled format unavailable ({reason}). Loading the preamble normally.")
+        if self.key is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self.path('.failed'), 'w', encoding='utf-8') as f:
+            f.write(reason + '\n')
+        if os.path.exists(self.path('.fmt')):
+            os.remove(self.path('.fmt'))
+        self.prune()
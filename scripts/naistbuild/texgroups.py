@@ -0,0 +1,125 @@
+"""
+TeXのグループ（{...}）の対応を1回の走査で求める
+
+\\hypersetup{...}、\\AtBeginDocument{...}、\\cmembers{..}{..}...などのコマンドと
+その引数を、波括弧の対応（\\{、\\}のエスケープと%コメントを考慮）を数えて探す。
+各文字は1回しか調べないため、処理時間はTeXファイルのサイズに比例する。
+閉じていない'{'がある場合（TeXではそれ以降がすべてそのグループの中身になる）は、
+GroupScannerがその位置を覚えて、それより後ろのグループを走査し直さない。
+"""
+import re
+from collections import namedtuple
+
+# 波括弧の対応に影響するトークン（エスケープされた文字、波括弧、コメント）
+GROUP_TOKEN = re.compile(r'\\.|[{}]|%[^\n]*', re.DOTALL)
+COMMENT_TOKEN = re.compile(r'\\.|%', re.DOTALL)
+# 引数の間の空白（改行を含む）
+ARGUMENT_SPACE = re.compile(r'\s*')
+
+# コマンドとその引数（argsは中身、spansは波括弧を含む各引数の位置）
+Command = namedtuple('Command', ['start', 'end', 'args', 'spans'])
+
+
+def group_end(text, start):
+    """text[start]の'{'に対応する'}'の次の位置を返す。閉じていない場合はNone"""
+    depth = 0
+    for token in GROUP_TOKEN.finditer(text, start):
+        if token.group() == '{':
+            depth += 1
+        elif token.group() == '}':
+            depth -= 1
+            if depth == 0:
+                return token.end()
+    return None
+
+
+class GroupScanner:
+    """1つのテキストのグループの対応を求める。閉じていない'{'を見つけた後は、その後ろを走査しない"""
+
+    def __init__(self, text):
+        self.text = text
+        # 最初に見つかった閉じていない'{'の位置
+        self.unclosed = None
+
+    def group_end(self, start):
+        if self.unclosed is not None and start > self.unclosed:
+            return None
+        end = group_end(self.text, start)
+        if end is None:
+            self.unclosed = start
+        return end
+
+
+def in_comment(text, pos):
+    """text[pos]が%コメントの中にあればTrue"""
+    line_start = text.rfind('\n', 0, pos) + 1
+    return any(token.group() == '%' for token in COMMENT_TOKEN.finditer(text, line_start, pos))
+
+
+def parse_arguments(text, start, pos, nargs, scanner=None):
+    """posから空白をはさんで続くnargs個の{...}引数を読み、Commandを返す。足りない場合はNone
+
+    同じテキストの複数のコマンドを読む場合は、GroupScannerを渡す。
+    """
+    if scanner is None:
+        scanner = GroupScanner(text)
+    args = []
+    spans = []
+    for _ in range(nargs):
+        pos = ARGUMENT_SPACE.match(text, pos).end()
+        if not text.startswith('{', pos):
+            return None
+        end = scanner.group_end(pos)
+        if end is None:
+            return None
+        args.append(text[pos + 1:end - 1])
+        spans.append((pos, end))
+        pos = end
+    return Command(start, pos, args, spans)
+
+
+def command_pattern(name):
+    """\\nameにマッチする正規表現（\\nameabcなどの長いコマンド名は除く）"""
+    return r'\\' + re.escape(name) + r'(?![A-Za-z@])'
+
+
+def find_commands(text, name, nargs=1):
+    """コメント外の\\nameとそれに続くnargs個の引数を、先頭から順にCommandとして返す"""
+    regex = re.compile(command_pattern(name))
+    scanner = GroupScanner(text)
+    pos = 0
+    while True:
+        match = regex.search(text, pos)
+        if match is None:
+            return
+        command = None
+        if not in_comment(text, match.start()):
+            command = parse_arguments(text, match.start(), match.end(), nargs, scanner)
+        if command is None:
+            if scanner.unclosed is not None:
+                # 閉じていない引数より後ろは、TeXではすべてその引数の中身になる
+                return
+            pos = match.end()
+            continue
+        yield command
+        pos = command.end
+
+
+def rewrite_commands(text, name, nargs, replace):
+    """replace(command)が返した文字列で各コマンドを置き換え、(内容, 置換数)を返す
+
+    replaceがNoneを返したコマンドはそのまま残す。結果は最後に1回だけ連結する。
+    """
+    pieces = []
+    last = 0
+    count = 0
+    for command in find_commands(text, name, nargs):
+        replacement = replace(command)
+        if replacement is None:
+            continue
+        pieces.append(text[last:command.start])
+        pieces.append(replacement)
+        last = command.end
+        count += 1
+    pieces.append(text[last:])
+    return ''.join(pieces), count
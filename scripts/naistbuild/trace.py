@@ -0,0 +1,139 @@
+"""
+ビルド処理の各段階の記録（トレース）
+
+環境変数NAIST_TRACE=1（またはnaistbuild --trace）の場合、各段階の開始時刻・所要時間・
+読み書きしたバイト数・サブプロセスの終了コードを、プロジェクトルートの
+naist-trace.jsonlに1行1段階のJSONとして追記する。post-render.shから起動される
+複数のプロセスの記録は、NAIST_TRACE_RUN（post-render.shのプロセスID）でまとめられる。
+naistbuild trace chromeでChromeのトレース形式（chrome://tracing、Perfetto）に変換できる。
+"""
+import contextlib
+import json
+import os
+import resource
+import time
+
+TRACE_FILE = 'naist-trace.jsonl'
+CHROME_FILE = 'naist-trace.json'
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# getrusageのブロック数の単位（バイト）
+BLOCK_SIZE = 512
+
+
+def enabled():
+    """環境変数NAIST_TRACE=1でトレースを記録する"""
+    return os.environ.get('NAIST_TRACE', '0') == '1'
+
+
+def trace_file():
+    """記録先（NAIST_TRACE_FILEで変更できる）"""
+    return os.environ.get('NAIST_TRACE_FILE') or os.path.join(PROJECT_ROOT, TRACE_FILE)
+
+
+def write_event(event):
+    """1段階分の記録を追記する（1回のwriteで書くため、複数のプロセスから追記しても行が混ざらない）"""
+    line = json.dumps(event, ensure_ascii=False, sort_keys=True) + '\n'
+    try:
+        fd = os.open(trace_file(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode('utf-8'))
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+def make_event(name, start, duration, fields):
+    event = {'name': name, 'ts': round(start, 6), 'dur': round(duration, 6), 'pid': os.getpid()}
+    if os.environ.get('NAIST_TRACE_RUN'):
+        event['run'] = os.environ['NAIST_TRACE_RUN']
+    event.update({key: value for key, value in fields.items() if value is not None})
+    return event
+
+
+@contextlib.contextmanager
+def span(name, **fields):
+    """withブロックの処理を1段階として記録する
+
+    ブロック内でyieldされた辞書にbytes_read、bytes_written、exit_codeなどを設定すると、
+    それも記録される。トレースが無効な場合は何もしない。
+    """
+    if not enabled():
+        yield {}
+        return
+    record = dict(fields)
+    start = time.time()
+    counter = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record.setdefault('error', f'{type(e).__name__}: {e}')
+        raise
+    finally:
+        write_event(make_event(name, start, time.perf_counter() - counter, record))
+
+
+@contextlib.contextmanager
+def subprocess_span(name, command, **fields):
+    """サブプロセスの実行を記録する（CPU時間とブロックI/Oはgetrusageの子プロセス分の差）"""
+    with span(name, command=' '.join(command), **fields) as record:
+        if not enabled():
+            yield record
+            return
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        try:
+            yield record
+        finally:
+            after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            record['cpu_seconds'] = round((after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime), 6)
+            record['bytes_read'] = (after.ru_inblock - before.ru_inblock) * BLOCK_SIZE
+            record['bytes_written'] = (after.ru_oublock - before.ru_oublock) * BLOCK_SIZE
+
+
+def record_event(name, since, **fields):
+    """シェルスクリプトの段階など、開始時刻（UNIX時間）から現在までを1段階として記録する"""
+    if enabled():
+        write_event(make_event(name, since, max(0.0, time.time() - since), fields))
+
+
+def read_events(path=None):
+    events = []
+    with open(path or trace_file(), 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                continue
+    return events
+
+
+def to_chrome(events):
+    """記録をChromeのトレース形式（Trace Event FormatのComplete Event）に変換する"""
+    trace_events = []
+    for event in events:
+        # 同じpost-render.shから起動したプロセスを1つのプロセスとして表示する
+        run = event.get('run', event['pid'])
+        args = {key: value for key, value in event.items() if key not in ('name', 'ts', 'dur', 'pid')}
+        trace_events.append({'name': event['name'], 'ph': 'X', 'ts': int(event['ts'] * 1e6),
+                             'dur': int(event['dur'] * 1e6), 'pid': int(run) if str(run).isdigit() else run,
+                             'tid': event['pid'], 'args': args})
+    return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+
+def write_chrome(output=None, path=None):
+    """naist-trace.jsonlをChromeのトレース形式で保存し、保存先を返す"""
+    output = output or os.path.join(os.path.dirname(path or trace_file()), CHROME_FILE)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(to_chrome(read_events(path)), f, ensure_ascii=False)
+    return output
+
+
+def summary(events):
+    """段階名ごとの合計時間（秒）と回数を、合計時間の大きい順に返す"""
+    totals = {}
+    for event in events:
+        total, count = totals.get(event['name'], (0.0, 0))
+        totals[event['name']] = (total + event['dur'], count + 1)
+    return sorted(totals.items(), key=lambda item: item[1][0], reverse=True)
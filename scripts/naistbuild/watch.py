@@ -0,0 +1,376 @@
+"""
+常駐してファイルの変更を監視するビルド（naistbuild watch）
+
+quarto previewでは、保存のたびにpost-render.shが新しいPythonプロセスを起動し、
+paper.qmdのフロントマターやテンプレートを読み直してから後処理とxelatexを行う。
+watchは1つのプロセスとして常駐し、解析したフロントマター、header.tex、Quartoが生成した
+展開前のTeXをメモリ上に保持して、変更されたファイルに応じて必要な処理だけを行う。
+
+  - フロントマターの変数（タイトル、概要、審査委員など）、header.tex、
+    template/before-body.tex、図: Quartoを実行せずに、保持している展開前のTeXを
+    メモリ上で展開し直し、内容が変わった場合のみxelatexを実行する
+  - 本文（paper.qmdの本文、章の.qmd）、format:などQuartoの設定: quarto renderを実行し、
+    生成されたTeXを後処理する
+  - スタイルファイル、文献: xelatexのみ実行する
+
+watchが起動したquarto renderでは、post-render.shは何もしない（NAIST_WATCH=1）。
+"""
+import glob
+import hashlib
+import os
+import re
+import subprocess
+import time
+
+from . import cache, figures, frontmatter, latex, pipeline, preamble, readiness, streaming, trace
+
+# ファイルの変更を確認する間隔（秒）
+POLL_INTERVAL = 0.2
+
+HEADER_FILE = os.path.join('_extensions', 'naist', 'partials', 'header.tex')
+# 展開し直す入力（プロジェクトルートからのglobパターン）
+EXPAND_INPUTS = [HEADER_FILE, 'template/before-body.tex', 'figures/**/*', 'paper_files/figure-pdf/*',
+                 'paper_files/figure-latex/*']
+# xelatexだけを実行し直す入力
+LATEX_INPUTS = [pattern for pattern in cache.STAGE_INPUTS['latex'] if pattern not in EXPAND_INPUTS]
+
+# Quartoが生成した展開前のTeXの保存先（プロジェクトルートから。再起動時にquarto renderを省略する）
+STATE_DIR = os.path.join('.naist-cache', 'watch')
+
+# 展開前のTeXで、header.texを展開した部分を置き換える目印
+HEADER_SLOT = '% naistbuild watch: header.tex\n'
+PLACEHOLDER = re.compile(r'\$([A-Za-z][\w-]*)\$')
+# header.texの変数以外に、展開結果に影響するフロントマターの変数（\edatestr）
+DERIVED_VARS = ['submission-month', 'submission-day', 'english-year']
+
+
+def header_anchors(header):
+    """header.texの最初の変数より前の部分と、最後の変数より後の部分（展開しても変わらない部分）を返す"""
+    lines = header.splitlines(keepends=True)
+    positions = [i for i, line in enumerate(lines) if PLACEHOLDER.search(line)]
+    if not positions:
+        return None
+    head = ''.join(lines[:positions[0]])
+    tail = ''.join(lines[positions[-1] + 1:])
+    if not head.strip() or not tail.strip():
+        return None
+    return head, tail
+
+
+def extract_template(tex, header):
+    """TeXのheader.texを展開した部分（Quartoのinclude-in-headerなど）をHEADER_SLOTに置き換える
+
+    見つからない場合はNoneを返す。
+    """
+    anchors = header_anchors(header)
+    if anchors is None:
+        return None
+    head, tail = anchors
+    parts = []
+    pos = 0
+    while True:
+        start = tex.find(head, pos)
+        if start < 0:
+            break
+        end = tex.find(tail, start + len(head))
+        if end < 0:
+            break
+        parts.extend([tex[pos:start], HEADER_SLOT])
+        pos = end + len(tail)
+    if not parts:
+        return None
+    parts.append(tex[pos:])
+    return ''.join(parts)
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class Watcher:
+    """メモリ上に保持した入力と、変更されたファイルに応じた再ビルド"""
+
+    def __init__(self, tex_file, project_root, interval=POLL_INTERVAL, stream=None):
+        self.project_root = project_root
+        self.qmd_file = os.path.join(project_root, 'paper.qmd')
+        self.tex_file = tex_file
+        self.interval = interval
+        self.context = pipeline.PostRenderContext(tex_file, project_root, stream=stream)
+        self.build_cache = cache.BuildCache(project_root) if cache.enabled() else None
+        # paper.qmdのフロントマター（ハッシュと解析結果）と本文のハッシュ
+        self.front_matter = None
+        self.front_matter_data = {}
+        self.body = None
+        self.chapters = []
+        self.header = ''
+        # Quartoが生成した展開前のTeX（header.texの部分はHEADER_SLOT）
+        self.template = None
+        # 最後に書き込んだ展開後のTeXのハッシュ
+        self.written = None
+        self.stats = {}
+
+    def log(self, message):
+        self.context.log(message)
+
+    def watched_files(self):
+        """監視するファイルをグループ（qmd、chapters、expand、latex）ごとに返す"""
+        def expand_patterns(patterns):
+            paths = []
+            for pattern in patterns:
+                paths.extend(glob.glob(os.path.join(self.project_root, pattern), recursive=True))
+            return sorted(path for path in set(paths) if os.path.isfile(path))
+        return {
+            'qmd': [self.qmd_file],
+            'chapters': self.chapters,
+            'expand': expand_patterns(EXPAND_INPUTS),
+            'latex': expand_patterns(LATEX_INPUTS),
+        }
+
+    def poll(self):
+        """前回から更新時刻・サイズが変わった（追加・削除された）ファイルのグループを返す"""
+        changed = set()
+        stats = {}
+        for group, paths in self.watched_files().items():
+            for path in paths:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                stats[path] = (group, st.st_mtime_ns, st.st_size)
+        for path in set(stats) | set(self.stats):
+            if stats.get(path) != self.stats.get(path):
+                changed.add((stats.get(path) or self.stats.get(path))[0])
+        self.stats = stats
+        return changed
+
+    def read_qmd(self):
+        """paper.qmdを読み込み、(フロントマター, 本文)を返す"""
+        with open(self.qmd_file, 'r', encoding='utf-8') as f:
+            content = f.read()
+        match = frontmatter.FRONT_MATTER.search(content)
+        if match is None:
+            return '', content
+        return match.group(1), content[match.end():]
+
+    def load_qmd(self):
+        """paper.qmdを読み直し、必要な処理（'render'、'expand'）の集合を返す"""
+        actions = set()
+        front_matter, body = self.read_qmd()
+        body_hash = text_hash(body)
+        if body_hash != self.body:
+            self.body = body_hash
+            self.chapters = cache.chapter_files(self.qmd_file)
+            actions.add('render')
+        digest = frontmatter.front_matter_hash(front_matter)
+        if digest == self.front_matter:
+            return actions
+        data, parser = frontmatter.parse_front_matter(front_matter)
+        yaml_vars = frontmatter.to_variables(data)
+        try:
+            # naist-vars.lua（次のquarto render）も同じ値を使うように保存する
+            frontmatter.write_vars_file(os.path.join(self.project_root, frontmatter.VARS_FILE),
+                                        digest, parser, yaml_vars)
+        except OSError as e:
+            self.log(f"  Warning: Failed to write {frontmatter.VARS_FILE}: {e}")
+        changed_keys = {key for key in set(data) | set(self.front_matter_data)
+                        if data.get(key) != self.front_matter_data.get(key)}
+        expandable = set(PLACEHOLDER.findall(self.header)) | set(DERIVED_VARS)
+        if self.front_matter is not None:
+            if changed_keys <= expandable:
+                self.log(f"  Front matter changed: {', '.join(sorted(changed_keys)) or 'formatting only'}")
+            else:
+                # header.texで展開しない値（format:、bibliography:など）はQuartoの出力に影響する
+                actions.add('render')
+        self.front_matter = digest
+        self.front_matter_data = data
+        self.context.yaml_vars = yaml_vars
+        actions.add('expand')
+        return actions
+
+    def load_header(self):
+        header_file = os.path.join(self.project_root, HEADER_FILE)
+        try:
+            with open(header_file, 'r', encoding='utf-8') as f:
+                self.header = f.read()
+        except OSError:
+            self.header = ''
+
+    def accept_tex(self):
+        """Quartoが生成したTeXを展開前のTeXとして保持する"""
+        if not readiness.tex_complete(self.tex_file):
+            self.log(f"✗ {self.tex_file} is missing or incomplete")
+            return False
+        with open(self.tex_file, 'r', encoding='utf-8') as f:
+            content = f.read()
+        self.set_source(content)
+        return True
+
+    def set_source(self, content):
+        template = extract_template(content, self.header)
+        if template is None:
+            self.log(f"  ⚠ header.tex was not found in {self.tex_file}. Header edits will trigger quarto render.")
+            template = content
+        self.template = template
+        self.save_state(source=content)
+
+    def state_file(self, name):
+        return os.path.join(self.project_root, STATE_DIR, name)
+
+    def save_state(self, source=None):
+        """展開前のTeXと、最後に書き込んだTeXのハッシュを保存する"""
+        os.makedirs(self.state_file(''), exist_ok=True)
+        files = {'written.sha256': self.written or ''}
+        if source is not None:
+            files['source.tex'] = source
+        for name, content in files.items():
+            tmp_file = self.state_file(name) + '.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                f.write(content)
+            os.replace(tmp_file, self.state_file(name))
+
+    def load_state(self):
+        """TeXファイルが前回のwatchの出力のままの場合、保存した展開前のTeXを読み込んでTrueを返す"""
+        try:
+            with open(self.state_file('written.sha256'), 'r', encoding='utf-8') as f:
+                written = f.read().strip()
+            source_mtime = os.path.getmtime(self.state_file('source.tex'))
+            with open(self.tex_file, 'r', encoding='utf-8') as f:
+                current = text_hash(f.read())
+        except OSError:
+            return False
+        if current != written:
+            return False
+        # 保存した後にpaper.qmdや章が編集された場合はquarto renderが必要
+        if any(os.path.getmtime(path) > source_mtime for path in [self.qmd_file] + self.chapters
+               if os.path.exists(path)):
+            return False
+        with open(self.state_file('source.tex'), 'r', encoding='utf-8') as f:
+            self.set_source(f.read())
+        self.written = written
+        return True
+
+    def is_processed(self):
+        """TeXファイルが後処理済み（Quartoが生成したままではない）場合True"""
+        if self.build_cache is None:
+            return False
+        tex_hash = self.build_cache.file_hash(self.tex_file)
+        return tex_hash is not None and tex_hash == self.build_cache.output_hash('postprocess', 'paper.tex')
+
+    def render(self):
+        """quarto renderでTeXを生成し直す（post-render.shはNAIST_WATCH=1で何もしない）
+
+        PDFはbuildで生成するため、QuartoにはTeXファイルだけを生成させる（naist-latex）。
+        """
+        self.log("Running quarto render...")
+        command = ['quarto', 'render', os.path.basename(self.qmd_file), '--to', 'naist-latex']
+        env = dict(os.environ, NAIST_WATCH='1')
+        with trace.subprocess_span('watch:render', command) as record:
+            try:
+                result = subprocess.run(command, cwd=self.project_root, env=env,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+            except FileNotFoundError:
+                self.log("✗ quarto not found. Install Quarto or render once before starting watch.")
+                return False
+            record['exit_code'] = result.returncode
+        if result.returncode != 0:
+            self.log(f"✗ quarto render failed (exit code {result.returncode})")
+            for line in result.stderr.splitlines()[-10:]:
+                self.log(f"    {line}")
+            return False
+        return self.accept_tex()
+
+    def expand(self):
+        """保持している展開前のTeXを展開し、内容が変わった場合のみ書き込んでTrueを返す"""
+        if self.template is None:
+            return False
+        with trace.span('watch:expand') as record:
+            content = self.template.replace(HEADER_SLOT, self.header)
+            file_hash = self.build_cache.file_hash if self.build_cache is not None else figures.file_sha256
+            content = pipeline.transform(content, self.context, file_hash)
+            digest = text_hash(content)
+            record['changed'] = digest != self.written
+            if digest == self.written:
+                self.log("  Expanded TeX is unchanged. Skipping xelatex.")
+                return False
+            streaming.write_if_changed(self.tex_file, content)
+            self.written = digest
+            self.save_state()
+            record['bytes_written'] = len(content.encode('utf-8'))
+        preamble.expand_aux_files(self.context.output_dir)
+        return True
+
+    def build(self):
+        """xelatex（必要な場合はbiber）でPDFを生成し、プロジェクトルートにコピーする"""
+        output_dir = self.context.output_dir
+        if not latex.build_pdf(self.tex_file, stream=self.context.stream):
+            return False
+        preamble.expand_aux_files(output_dir)
+        pdf = os.path.join(output_dir, 'paper.pdf')
+        if os.path.exists(pdf) and os.path.abspath(output_dir) != os.path.abspath(self.project_root):
+            streaming.copy_if_changed(pdf, os.path.join(self.project_root, 'paper.pdf'))
+        if self.build_cache is not None and os.path.exists(pdf):
+            self.build_cache.record('latex', self.build_cache.stage_inputs('latex', self.tex_file), output_dir)
+        return True
+
+    def update(self, changed):
+        """変更されたファイルのグループに応じて必要な処理だけを行う"""
+        start = time.perf_counter()
+        actions = set()
+        if 'qmd' in changed:
+            actions |= self.load_qmd()
+        if 'chapters' in changed:
+            actions.add('render')
+        if 'expand' in changed:
+            header = self.header
+            self.load_header()
+            if self.header != header and HEADER_SLOT not in (self.template or ''):
+                actions.add('render')
+            actions.add('expand')
+        if 'latex' in changed:
+            actions.add('build')
+        if 'render' in actions and not self.render():
+            return
+        expanded = 'expand' in actions or 'render' in actions
+        if expanded and self.expand():
+            self.log(f"✓ Re-expanded {self.tex_file} in {(time.perf_counter() - start) * 1000:.0f} ms")
+            actions.add('build')
+        if 'build' in actions and self.build():
+            self.log(f"✓ PDF updated in {time.perf_counter() - start:.2f}s")
+
+    def start(self):
+        """フロントマター、header.tex、展開前のTeXを読み込み、最初のビルドを行う"""
+        self.load_header()
+        self.load_qmd()
+        self.poll()
+        if self.load_state():
+            self.log(f"✓ Loaded the Quarto output for {self.tex_file} saved in {STATE_DIR}")
+        elif os.path.exists(self.tex_file) and not self.is_processed() and self.accept_tex():
+            self.log(f"✓ Loaded {self.tex_file} generated by Quarto")
+        elif not self.render():
+            return False
+        if self.expand() or not os.path.exists(os.path.join(self.context.output_dir, 'paper.pdf')):
+            self.build()
+        return True
+
+    def run(self):
+        if not self.start():
+            return False
+        self.log("Watching paper.qmd, chapters, templates and references (Ctrl+C to stop)...")
+        try:
+            while True:
+                time.sleep(self.interval)
+                changed = self.poll()
+                if changed:
+                    self.update(changed)
+        except KeyboardInterrupt:
+            self.log("Stopped watching")
+        return True
+
+
+def watch(tex_file, project_root, interval=POLL_INTERVAL):
+    """ファイルの変更を監視し続ける（Ctrl+Cで終了）"""
+    output_dir = os.path.dirname(tex_file) or '.'
+    if os.path.abspath(output_dir) != os.path.abspath(project_root):
+        # post-render.shと同じく、_outputなどからtemplate/を参照できるようにする
+        os.environ['TEXINPUTS'] = f".:{project_root}:{os.path.join(project_root, 'template')}:"
+    return Watcher(tex_file, project_root, interval=interval).run()
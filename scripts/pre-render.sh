@@ -0,0 +1,27 @@
+#!/bin/bash
+# レンダリング前にpaper.qmdのフロントマターを解析するスクリプト
+# 解析結果を.naist-cache/vars.jsonに保存し、naist-vars.lua（header.texと本文の展開）と
+# post-render.sh（TeXファイルの後処理）が同じ変数を使うようにする
+# paper_html.qmd・paper_word.qmdをレンダリングする場合は.naist-cache/vars-<文書名>.jsonに保存する
+
+SCRIPT_DIR="$(cd "$(dirname "$0")" && pwd)"
+PROJECT_ROOT="$(dirname "$SCRIPT_DIR")"
+cd "$PROJECT_ROOT" || exit 1
+
+# 後処理用のPythonパッケージ（scripts/naistbuild）を読み込めるようにする
+export PYTHONPATH="$SCRIPT_DIR${PYTHONPATH:+:$PYTHONPATH}"
+
+# レンダリングする文書（QuartoがQUARTO_PROJECT_INPUT_FILESに改行区切りで渡す）
+QMD_FILES=()
+while IFS= read -r input_file; do
+    case "$input_file" in
+        *.qmd) QMD_FILES+=("$input_file") ;;
+    esac
+done <<< "${QUARTO_PROJECT_INPUT_FILES:-}"
+if [ ${#QMD_FILES[@]} -eq 0 ]; then
+    QMD_FILES=(paper.qmd)
+fi
+# フロントマターが前回と同じ場合は解析せずに保存済みの値を使う
+# 失敗してもレンダリングは続ける（naist-vars.luaはPandocのメタデータから変数を求める）
+python3 -m naistbuild vars "${QMD_FILES[@]}" || echo "Warning: Failed to write .naist-cache/vars.json"
+exit 0
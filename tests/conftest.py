@@ -0,0 +1,27 @@
+"""
+scripts/naistbuildのテスト
+
+プロジェクトルートで python3 -m pytest tests を実行する（PYTHONPATH=scriptsは不要）。
+"""
+import os
+import sys
+
+import pytest
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'scripts'))
+
+
+@pytest.fixture
+def fake_command(tmp_path, monkeypatch):
+    """PATHの先頭に置く偽のコマンド（TeX Live、Ghostscriptなど）をPythonで作成する関数を返す"""
+    bin_dir = tmp_path / 'fake-bin'
+    bin_dir.mkdir()
+    monkeypatch.setenv('PATH', f'{bin_dir}{os.pathsep}{os.environ["PATH"]}')
+
+    def install(name, source):
+        path = bin_dir / name
+        path.write_text(f'#!{sys.executable}\n{source}', encoding='utf-8')
+        path.chmod(0o755)
+        return path
+    return install
@@ -0,0 +1,53 @@
+from naistbuild import bibliography
+
+BIB = r'''@string{jpa = "Japanese Psychological Association"}
+
+@comment{ exported by Zotero }
+
+@article{Smith2020,
+  title = {A {Study} of \{braces\} and {nested {groups}}},
+  journal = jpa,
+}
+
+@Book(Doe2019,
+  title = "Parenthesised entry",
+  crossref = {Series2018},
+)
+
+@book{Series2018, title = {The Series}}
+
+@misc{Unused, note = {not cited}}
+'''
+
+
+def test_parse_bib_entries():
+    entries = bibliography.parse_bib(BIB)
+    assert [(kind, key) for kind, key, _ in entries] == [
+        ('string', None), ('comment', None), ('article', 'Smith2020'), ('book', 'Doe2019'),
+        ('book', 'Series2018'), ('misc', 'Unused'),
+    ]
+    assert entries[2][2].endswith('{nested {groups}}},\n  journal = jpa,\n}')
+    assert entries[3][2].startswith('@Book(Doe2019,') and entries[3][2].endswith(')')
+
+
+def test_parse_bib_unclosed_entry():
+    assert bibliography.parse_bib('@article{Broken, title = {x}\n') is None
+
+
+def test_select_entries_follows_crossref_and_keeps_strings():
+    entries = bibliography.parse_bib(BIB)
+    selected = bibliography.select_entries(entries, ['smith2020', 'Doe2019'])
+    assert [raw.split('\n', 1)[0] for raw in selected] == [
+        '@string{jpa = "Japanese Psychological Association"}',
+        '@article{Smith2020,',
+        '@Book(Doe2019,',
+        '@book{Series2018, title = {The Series}}',
+    ]
+
+
+def test_backslash_does_not_escape_braces():
+    # BibTeXは\}も閉じ括弧として数える（Windowsのパスなど）
+    text = '@misc{Win, note = {C:\\}}\n\n@misc{Next, note = {n}}\n'
+    entries = bibliography.parse_bib(text)
+    assert [key for _, key, _ in entries] == ['Win', 'Next']
+    assert entries[0][2] == '@misc{Win, note = {C:\\}}'
@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+from naistbuild import builddir, cache, figures
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    monkeypatch.setattr(builddir, 'PROJECT_ROOT', str(tmp_path))
+    (tmp_path / 'paper.tex').write_text('\\documentclass{article}\n', encoding='utf-8')
+    return tmp_path
+
+
+def test_names_depend_on_the_build_dir(project, monkeypatch):
+    monkeypatch.delenv('NAIST_BUILD_DIR', raising=False)
+    assert builddir.build_dir() is None
+    assert builddir.name() is None
+    assert builddir.published_name('paper.pdf') == 'paper.pdf'
+
+    monkeypatch.setenv('NAIST_BUILD_DIR', '1')
+    assert builddir.build_dir() == os.path.join(str(project), '.naist-build', 'paper')
+    assert builddir.published_name('paper.pdf') == 'paper.pdf'
+
+    monkeypatch.setenv('NAIST_BUILD_DIR', '.naist-build/draft/')
+    assert builddir.name() == 'draft'
+    assert builddir.published_name('paper.pdf') == 'paper-draft.pdf'
+    assert builddir.published_name('paper-incremental.pdf') == 'paper-incremental-draft.pdf'
+
+
+def test_stage_copies_the_source_and_detaches_published_pdfs(project):
+    directory = str(project / '.naist-build' / 'draft')
+    staged = builddir.stage(str(project / 'paper.tex'), directory)
+    assert staged == os.path.join(directory, 'paper.tex')
+    # 後処理はコピーに対して行う
+    with open(staged, 'a', encoding='utf-8') as f:
+        f.write('% expanded\n')
+    assert (project / 'paper.tex').read_text(encoding='utf-8') == '\\documentclass{article}\n'
+
+    pdf_file = os.path.join(directory, 'paper.pdf')
+    with open(pdf_file, 'w') as f:
+        f.write('%PDF draft\n')
+    assert builddir.publish(pdf_file, str(project / 'paper-draft.pdf'))
+    assert os.path.samefile(pdf_file, project / 'paper-draft.pdf')
+    assert not builddir.publish(pdf_file, str(project / 'paper-draft.pdf'))
+
+    # 次のビルドのxelatexが公開したPDFを書き換えないように、ハードリンクを切り離す
+    builddir.stage(str(project / 'paper.tex'), directory)
+    assert not os.path.exists(pdf_file)
+    assert (project / 'paper-draft.pdf').read_text() == '%PDF draft\n'
+    # Quartoが生成した内容に戻してから後処理する
+    assert (project / '.naist-build' / 'draft' / 'paper.tex').read_text(encoding='utf-8') == '\\documentclass{article}\n'
+
+
+def test_build_cache_records_are_kept_per_build_dir(project, monkeypatch):
+    outputs = {}
+    for name in ['draft', 'final']:
+        monkeypatch.setenv('NAIST_BUILD_DIR', f'.naist-build/{name}')
+        directory = project / '.naist-build' / name
+        tex_file = builddir.stage(str(project / 'paper.tex'), str(directory))
+        (directory / 'paper.pdf').write_text(f'%PDF {name}\n')
+        build_cache = cache.BuildCache(str(project))
+        build_cache.record('latex', build_cache.stage_inputs('latex', tex_file), str(directory))
+        outputs[name] = build_cache.manifest_file
+
+    assert outputs['draft'] != outputs['final']
+    monkeypatch.setenv('NAIST_BUILD_DIR', '.naist-build/draft')
+    build_cache = cache.BuildCache(str(project))
+    (project / '.naist-build' / 'draft' / 'paper.pdf').unlink()
+    build_cache.restore('latex', str(project / '.naist-build' / 'draft'))
+    assert (project / '.naist-build' / 'draft' / 'paper.pdf').read_text() == '%PDF draft\n'
+
+    build_cache.clear()
+    assert not (project / cache.CACHE_DIR / cache.BUILD_DIR_RECORDS).exists()
+
+
+def test_figures_are_found_from_the_project_root(project):
+    (project / 'figures').mkdir()
+    (project / 'figures' / 'fig1.png').write_bytes(b'png')
+    directory = project / '.naist-build' / 'draft'
+    directory.mkdir(parents=True)
+    expected = os.path.join('..', '..', 'figures', 'fig1.png')
+    assert figures.resolve('figures/fig1', str(directory), str(project)) == expected
+    assert figures.resolve('figures/fig1.png', str(directory)) is None
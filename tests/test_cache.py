@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+from naistbuild import cache
+
+
+@pytest.fixture
+def project(tmp_path):
+    (tmp_path / 'paper.qmd').write_text('---\ntitle: T\n---\n\n{{< include 01_intro.qmd >}}\n', encoding='utf-8')
+    (tmp_path / '01_intro.qmd').write_text('# Intro\n', encoding='utf-8')
+    (tmp_path / 'template').mkdir()
+    (tmp_path / 'template' / 'before-body.tex').write_text('% before body\n', encoding='utf-8')
+    (tmp_path / 'paper.tex').write_text('\\documentclass{article}\n', encoding='utf-8')
+    return tmp_path
+
+
+def test_record_and_restore(project):
+    build_cache = cache.BuildCache(str(project))
+    inputs = build_cache.stage_inputs('postprocess', str(project / 'paper.tex'))
+    assert {'tex', 'front-matter', '01_intro.qmd', 'template/before-body.tex'} <= set(inputs)
+    assert not build_cache.is_fresh('postprocess', inputs)
+    build_cache.record('postprocess', inputs, str(project))
+
+    # マニフェストを読み直しても同じ入力なら再利用できる
+    build_cache = cache.BuildCache(str(project))
+    assert build_cache.is_fresh('postprocess', build_cache.stage_inputs('postprocess', str(project / 'paper.tex')))
+    output_dir = project / 'out'
+    output_dir.mkdir()
+    assert build_cache.restore('postprocess', str(output_dir)) == ['paper.tex']
+    assert (output_dir / 'paper.tex').read_text(encoding='utf-8') == '\\documentclass{article}\n'
+
+
+def test_changed_inputs_are_not_fresh(project):
+    build_cache = cache.BuildCache(str(project))
+    build_cache.record('postprocess', build_cache.stage_inputs('postprocess', str(project / 'paper.tex')), str(project))
+    (project / '01_intro.qmd').write_text('# Introduction\n', encoding='utf-8')
+    assert not build_cache.is_fresh('postprocess', build_cache.stage_inputs('postprocess', str(project / 'paper.tex')))
+    (project / '01_intro.qmd').write_text('# Intro\n', encoding='utf-8')
+    (project / 'paper.qmd').write_text('---\ntitle: U\n---\n\n{{< include 01_intro.qmd >}}\n', encoding='utf-8')
+    assert not build_cache.is_fresh('postprocess', build_cache.stage_inputs('postprocess', str(project / 'paper.tex')))
+
+
+def test_damaged_cached_output_is_not_fresh(project):
+    build_cache = cache.BuildCache(str(project))
+    inputs = build_cache.stage_inputs('postprocess', str(project / 'paper.tex'))
+    build_cache.record('postprocess', inputs, str(project))
+    (project / cache.CACHE_DIR / 'postprocess' / 'paper.tex').write_text('truncated', encoding='utf-8')
+    assert not build_cache.is_fresh('postprocess', inputs)
+
+
+def test_clear_keeps_other_cache_files(project):
+    build_cache = cache.BuildCache(str(project))
+    build_cache.record('postprocess', build_cache.stage_inputs('postprocess', str(project / 'paper.tex')), str(project))
+    knitr_dir = project / cache.CACHE_DIR / 'knitr' / 'paper'
+    knitr_dir.mkdir(parents=True)
+    (knitr_dir / 'chunk.rds').write_bytes(b'rds')
+    build_cache.clear()
+    assert not os.path.exists(build_cache.manifest_file)
+    assert not (project / cache.CACHE_DIR / 'postprocess').exists()
+    assert (knitr_dir / 'chunk.rds').exists()
+    assert build_cache.manifest['stages'] == {}
@@ -0,0 +1,96 @@
+import io
+import json
+import re
+
+import pytest
+
+from naistbuild import chapters
+
+# 偽のxelatex: \includeonlyで指定された章の.auxと、本体の.aux・.pdfを書く
+XELATEX = r'''import hashlib, re, sys
+tex = sys.argv[-1]
+job = tex[:-4]
+with open(tex, encoding='utf-8') as f:
+    body = f.read()
+match = re.search(r'\\includeonly\{([^}]*)\}', body)
+included = match.group(1).split(',') if match and match.group(1) else []
+with open('calls.log', 'a') as f:
+    f.write(' '.join(included) + '\n')
+for unit in included:
+    with open(unit + '.tex', encoding='utf-8') as f:
+        digest = hashlib.sha256(f.read().encode('utf-8')).hexdigest()
+    with open(unit + '.aux', 'w', encoding='utf-8') as f:
+        f.write(digest)
+for ext, text in [('.aux', 'main'), ('.log', 'This is XeTeX\n'), ('.pdf', '%PDF\n')]:
+    with open(job + ext, 'w', encoding='utf-8') as f:
+        f.write(text)
+'''
+
+PAPER = '''\\documentclass{article}
+\\begin{document}
+\\tableofcontents
+\\section{はじめに}\\label{sec-intro}
+Intro.
+\\section{Method}\\label{sec-method}
+Method.
+\\appendix
+\\section{Extra}
+Extra.
+\\end{document}
+'''
+
+
+def test_split_units():
+    head, body, tail = chapters.split_units(PAPER)
+    assert head.endswith('\\begin{document}')
+    assert tail == '\\end{document}\n'
+    assert [part[:2] for part in body] == [
+        ('main', '\n\\tableofcontents\n'), ('unit', 'sec-intro'), ('unit', 'sec-method'),
+        ('main', '\\appendix\n'), ('unit', 'section04'),
+    ]
+    assert chapters.split_units('\\begin{document}\nno sections\n\\end{document}\n') is None
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch, fake_command):
+    fake_command('xelatex', XELATEX)
+    monkeypatch.setenv('NAIST_FORMAT', '0')
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'paper.tex').write_text(PAPER, encoding='utf-8')
+    return tmp_path
+
+
+def build(project):
+    """インクリメンタルコンパイルを行い、(成功したか, 各xelatexでコンパイルした章)を返す"""
+    calls_file = project / 'calls.log'
+    if calls_file.exists():
+        calls_file.unlink()
+    ok = chapters.build_incremental('paper.tex', stream=io.StringIO())
+    calls = calls_file.read_text(encoding='utf-8').splitlines() if calls_file.exists() else []
+    return ok, [re.sub(chapters.UNIT_DIR + '/', '', call).split() for call in calls]
+
+
+def test_only_changed_chapters_are_compiled(project):
+    ok, calls = build(project)
+    assert ok
+    assert calls[0] == ['sec-intro', 'sec-method', 'section04']
+    state_file = project / chapters.UNIT_DIR / chapters.STATE_FILE
+    assert set(json.loads(state_file.read_text(encoding='utf-8'))['units']) == {'sec-intro', 'sec-method', 'section04'}
+    assert not (project / chapters.UNIT_DIR / (chapters.STATE_FILE + '.tmp')).exists()
+
+    assert build(project) == (True, [])
+
+    (project / 'paper.tex').write_text(PAPER.replace('Method.', 'Better method.'), encoding='utf-8')
+    ok, calls = build(project)
+    assert ok
+    assert calls[0] == ['sec-method']
+
+
+def test_reordered_chapters_compile_everything(project):
+    build(project)
+    reordered = PAPER.replace('\\section{はじめに}\\label{sec-intro}\nIntro.\n', '').replace(
+        '\\appendix', '\\section{はじめに}\\label{sec-intro}\nIntro.\n\\appendix')
+    (project / 'paper.tex').write_text(reordered, encoding='utf-8')
+    ok, calls = build(project)
+    assert ok
+    assert calls[0] == ['sec-method', 'sec-intro', 'section04']
@@ -0,0 +1,116 @@
+import os
+
+import pytest
+
+from naistbuild import compact
+
+# 偽のgs・qpdf: 元のPDFの先頭だけを書き出す（FAKE_COMPACT=growの場合は大きくし、failの場合は失敗する）
+TOOL = r'''import os, sys
+with open(os.environ['FAKE_CALLS'], 'a') as f:
+    f.write(os.path.basename(sys.argv[0]) + '\n')
+mode = os.environ.get('FAKE_COMPACT', 'shrink')
+if mode == 'fail':
+    sys.exit(1)
+if sys.argv[0].endswith('gs'):
+    source, dest = sys.argv[-1], sys.argv[-2][len('-sOutputFile='):]
+else:
+    source, dest = sys.argv[-2], sys.argv[-1]
+with open(source, 'rb') as f:
+    body = f.read()
+body = body + b'x' * 100 if mode == 'grow' else body[:len(body) // 2]
+with open(dest, 'wb') as f:
+    f.write(b'%PDF-1.5\n' + body + b'\n%%EOF\n')
+'''
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch, fake_command):
+    fake_command('gs', TOOL)
+    fake_command('qpdf', TOOL)
+    monkeypatch.setenv('FAKE_CALLS', str(tmp_path / 'calls.log'))
+    monkeypatch.setattr(compact, 'PROJECT_ROOT', str(tmp_path))
+    pdf_file = tmp_path / 'paper.pdf'
+    pdf_file.write_bytes(b'%PDF-1.5\n' + b'0123456789' * 1000 + b'\n%%EOF\n')
+    return tmp_path
+
+
+def run(project, dpi=300):
+    """PDFを書き直し、(成功したか, 実行したツールのリスト, ログ)を返す"""
+    calls_file = project / 'calls.log'
+    if calls_file.exists():
+        calls_file.unlink()
+    messages = []
+    ok = compact.PdfCompactor(str(project / 'paper.pdf'), dpi=dpi, log=messages.append).compact()
+    calls = calls_file.read_text().split() if calls_file.exists() else []
+    return ok, calls, '\n'.join(messages)
+
+
+def test_compacted_pdf_is_not_compacted_again(project):
+    original = (project / 'paper.pdf').read_bytes()
+    ok, calls, _ = run(project)
+    assert ok
+    assert calls == ['gs', 'qpdf']
+    assert len((project / 'paper.pdf').read_bytes()) < len(original)
+
+    # 書き直したPDFは記録の出力のハッシュと一致する
+    ok, calls, log = run(project)
+    assert ok
+    assert calls == []
+    assert 'paper.pdf is already compacted' in log
+
+    # 元のPDFが再び生成された場合は保存した結果を使う
+    (project / 'paper.pdf').write_bytes(original)
+    ok, calls, log = run(project)
+    assert ok
+    assert calls == []
+    assert 'Reused compacted paper.pdf' in log
+    assert len((project / 'paper.pdf').read_bytes()) < len(original)
+
+
+def test_not_smaller_keeps_the_original(project, monkeypatch):
+    monkeypatch.setenv('FAKE_COMPACT', 'grow')
+    pdf_file = project / 'paper.pdf'
+    original = pdf_file.read_bytes()
+    os.utime(pdf_file, ns=(1, 1))
+    ok, calls, log = run(project)
+    assert ok
+    assert calls == ['gs', 'qpdf']
+    assert 'Kept the original' in log
+    # 元のPDFは書き直さず、結果も保存しない
+    assert pdf_file.read_bytes() == original
+    assert pdf_file.stat().st_mtime_ns == 1
+    cache_dir = project / compact.COMPACT_DIR
+    assert [path.suffix for path in cache_dir.iterdir()] == ['.json']
+
+    ok, calls, log = run(project)
+    assert ok
+    assert calls == []
+    assert 'paper.pdf is already compacted' in log
+
+
+def test_changed_settings_compact_again(project):
+    run(project)
+    ok, calls, _ = run(project, dpi=150)
+    assert ok
+    assert calls == ['gs', 'qpdf']
+
+
+def test_tool_failure_keeps_the_pdf(project, monkeypatch):
+    monkeypatch.setenv('FAKE_COMPACT', 'fail')
+    original = (project / 'paper.pdf').read_bytes()
+    ok, calls, log = run(project)
+    assert not ok
+    assert calls == ['gs']
+    assert 'gs failed (exit code 1)' in log
+    assert (project / 'paper.pdf').read_bytes() == original
+    assert list((project / compact.COMPACT_DIR).iterdir()) == []
+
+
+def test_prune_keeps_recent_records(project, monkeypatch):
+    monkeypatch.setattr(compact, 'COMPACT_CACHE_SIZE', 2)
+    for dpi in [100, 200, 300]:
+        (project / 'paper.pdf').write_bytes(b'%PDF-1.5\n' + str(dpi).encode() * 1000 + b'\n%%EOF\n')
+        run(project, dpi=dpi)
+    cache_dir = project / compact.COMPACT_DIR
+    assert len(list(cache_dir.glob('*.json'))) == 2
+    assert len(list(cache_dir.glob('*.pdf'))) == 2
@@ -0,0 +1,77 @@
+import io
+
+import pytest
+
+from naistbuild import figures
+
+Image = pytest.importorskip('PIL.Image')
+
+ICC_PROFILE = b'test icc profile'
+
+
+def save_image(path, size, dpi=None, **options):
+    image = Image.new('RGB', size, 'white')
+    # 縮小で容量が減るように模様を付ける
+    for x in range(0, size[0], 7):
+        image.putpixel((x, x % size[1]), (x % 256, 0, 0))
+    if dpi is not None:
+        options['dpi'] = (dpi, dpi)
+    image.save(path, **options)
+
+
+def test_display_inches():
+    text_width = figures.TEXT_WIDTH_INCHES
+    assert figures.display_inches('width=0.5\\linewidth') == pytest.approx(text_width / 2)
+    assert figures.display_inches('width=2in', natural=5.0) == pytest.approx(2.0)
+    # widthがない場合は本来の幅（本文の幅まで）
+    assert figures.display_inches(None, natural=2.0) == pytest.approx(2.0)
+    assert figures.display_inches('keepaspectratio', natural=20.0) == pytest.approx(text_width)
+    assert figures.display_inches('scale=0.5', natural=3.0) == pytest.approx(1.5)
+    assert figures.display_inches(None) is None
+    assert figures.display_inches('height=3cm', natural=2.0) is None
+
+
+@pytest.mark.parametrize('name', ['fig.png', 'fig.jpg'])
+def test_convert_keeps_physical_size_and_icc_profile(tmp_path, name):
+    source = str(tmp_path / name)
+    dest = str(tmp_path / ('small-' + name))
+    save_image(source, (4000, 2000), dpi=600, icc_profile=ICC_PROFILE)
+    assert figures.convert(source, dest, 1890)
+    with Image.open(dest) as image:
+        assert image.width == pytest.approx(1890, abs=5)
+        xdpi, ydpi = image.info['dpi']
+        assert image.width / xdpi == pytest.approx(4000 / 600, rel=1e-3)
+        assert image.height / ydpi == pytest.approx(2000 / 600, rel=1e-3)
+        assert image.info['icc_profile'] == ICC_PROFILE
+
+
+def test_convert_without_resizing_keeps_dpi(tmp_path):
+    source = str(tmp_path / 'fig.png')
+    dest = str(tmp_path / 'small.png')
+    # 圧縮していないPNGは、縮小しなくても最適化で小さくなる
+    save_image(source, (600, 300), dpi=150, icc_profile=ICC_PROFILE, compress_level=0)
+    assert figures.convert(source, dest, 1000)
+    with Image.open(dest) as image:
+        assert image.size == (600, 300)
+        assert image.info['dpi'] == pytest.approx((150, 150), abs=0.1)
+        assert image.info['icc_profile'] == ICC_PROFILE
+
+
+def test_figures_without_width_use_natural_size(tmp_path, monkeypatch):
+    monkeypatch.setenv('NAIST_FIGURE_DPI', '300')
+    save_image(str(tmp_path / 'dense.png'), (1200, 600), dpi=600)
+    save_image(str(tmp_path / 'nodpi.png'), (4000, 2000))
+    content = '\\includegraphics{dense.png}\n\\includegraphics[keepaspectratio]{nodpi.png}\n'
+    plan = figures.FigurePlan(str(tmp_path), str(tmp_path))
+    plan.scan(content)
+    # 600dpiで2インチの画像は2インチ×300dpi、解像度の情報がない画像は縮小しない
+    assert list(plan.targets) == [('dense.png', 600)]
+    plan.prepare(log=lambda message: None, jobs=1)
+    result = plan.apply(content)
+    assert result.startswith('\\includegraphics{.naist-cache/figures/')
+    assert result.endswith('\n\\includegraphics[keepaspectratio]{nodpi.png}\n')
+    prepared = plan.targets[('dense.png', 600)]
+    with open(prepared, 'rb') as f:
+        image = Image.open(io.BytesIO(f.read()))
+    assert image.width == 600
+    assert image.width / image.info['dpi'][0] == pytest.approx(2.0, rel=1e-3)
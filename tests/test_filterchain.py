@@ -0,0 +1,106 @@
+"""
+_extensions/naist/naist-filterchain.luaのテスト（pandocがない場合は省略する）
+
+Pandocの-Lでフィルターを順に実行した結果と、ランナーで順に実行した結果、
+NAIST_LUA_FUSE=1でまとめて実行した結果が同じになることを確かめる。
+"""
+import json
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from conftest import PROJECT_ROOT
+
+FILTERCHAIN = os.path.join(PROJECT_ROOT, '_extensions', 'naist', 'naist-filterchain.lua')
+
+DOCUMENT = '''---
+title: t
+---
+
+hello *world*
+
+::: note
+second para END
+:::
+'''
+
+FILTERS = {
+    # returnしないフィルター（定義された関数を集める）
+    'upper.lua': 'function Str(s) s.text = s.text:upper(); return s end\n',
+    'number.lua': '''local n = 0
+return { Para = function(p) n = n + 1; p.content:insert(pandoc.Str('#' .. n)); return p end }
+''',
+    # フィルターのリスト
+    'list.lua': '''return {{ Meta = function(m) m.seen = true; return m end },
+        { Pandoc = function(d) d.blocks:insert(pandoc.Para({ pandoc.Str('end') })); return d end }}
+''',
+    'helper.lua': "return { x = 'helped' }\n",
+    'require.lua': '''local helper = require('helper')
+return { Pandoc = function(d) d.blocks:insert(pandoc.Para({ pandoc.Str(helper.x) })); return d end }
+''',
+    'rename.lua': "return { Str = function(s) if s.text == 'END' then s.text = 'fin' end; return s end }\n",
+    'div.lua': "return { Div = function(div) return div.content end }\n",
+    'topdown.lua': '''return { traverse = 'topdown',
+         Para = function(p) p.content:insert(1, pandoc.Str('>')); return p end }
+''',
+}
+
+
+def run_pandoc(tmp_path, filters, env=None):
+    command = ['pandoc', 'doc.md', '-s', '-t', 'native']
+    for name in filters:
+        command += ['-L', name]
+    result = subprocess.run(command, cwd=tmp_path, env=env, capture_output=True, text=True, check=True)
+    return result.stdout
+
+
+def run_chain(tmp_path, files, fuse):
+    with open(tmp_path / 'chain.lua', 'w', encoding='utf-8') as f:
+        f.write(f'local chain = dofile({json.dumps(FILTERCHAIN)})\n'
+                f'return chain.chain("test", {json.dumps(str(tmp_path))}, {{ {", ".join(map(json.dumps, files))} }})\n')
+    trace_file = tmp_path / 'trace.jsonl'
+    if trace_file.exists():
+        trace_file.unlink()
+    env = dict(os.environ, NAIST_TRACE='1', NAIST_TRACE_FILE=str(trace_file), NAIST_LUA_FUSE='1' if fuse else '0')
+    output = run_pandoc(tmp_path, ['chain.lua'], env)
+    with open(trace_file, 'r', encoding='utf-8') as f:
+        steps = [json.loads(line)['name'].split(':', 2)[2] for line in f]
+    return output, steps
+
+
+@pytest.fixture
+def project(tmp_path):
+    if shutil.which('pandoc') is None:
+        pytest.skip('pandoc not found')
+    (tmp_path / 'doc.md').write_text(DOCUMENT, encoding='utf-8')
+    for name, source in FILTERS.items():
+        (tmp_path / name).write_text(source, encoding='utf-8')
+    return tmp_path
+
+
+def test_chain_matches_pandoc_sequential_filters(project):
+    files = ['upper.lua', 'number.lua', 'list.lua', 'require.lua', 'rename.lua']
+    expected = run_pandoc(project, files)
+    output, steps = run_chain(project, files, fuse=False)
+    assert output == expected
+    assert steps == ['upper.lua', 'number.lua', 'list.lua#1', 'list.lua#2', 'require.lua', 'rename.lua']
+
+
+def test_fusion_preserves_output(project):
+    files = ['upper.lua', 'number.lua', 'list.lua', 'require.lua', 'rename.lua']
+    expected = run_pandoc(project, files)
+    output, steps = run_chain(project, files, fuse=True)
+    assert output == expected
+    # Str→Para→Meta→Pandoc→Pandocは1回の走査にまとめ、Pandocの後のStrはまとめない
+    assert steps == ['upper.lua+number.lua+list.lua#1+list.lua#2+require.lua', 'rename.lua']
+
+
+def test_filters_that_cannot_be_fused(project):
+    # ブロック要素の後のインライン要素、topdownの走査はまとめない
+    files = ['div.lua', 'rename.lua', 'topdown.lua', 'number.lua']
+    expected = run_pandoc(project, files)
+    output, steps = run_chain(project, files, fuse=True)
+    assert output == expected
+    assert steps == ['div.lua', 'rename.lua', 'topdown.lua', 'number.lua']
@@ -0,0 +1,57 @@
+import json
+import os
+
+import pytest
+
+from naistbuild import frontmatter
+
+FRONT_MATTER = '''title: "A \\"quoted\\" title"
+supervisor: 'Prof. O''Brien'
+# comment
+abstract: |
+  First line with $\\\\pi$.
+
+  Second line.
+crossref:
+  fig-prefix: Figure
+format:
+  naist-pdf:
+    number-depth: 2
+bibliography: references/bibliography-en.bib'''
+
+
+def test_simple_parser_matches_yaml():
+    yaml = pytest.importorskip('yaml')
+    expected = frontmatter.to_variables(yaml.safe_load(FRONT_MATTER))
+    assert frontmatter.to_variables(frontmatter._parse_simple(FRONT_MATTER)) == expected
+    assert expected == {
+        'title': 'A "quoted" title',
+        'supervisor': "Prof. O'Brien",
+        'abstract': 'First line with $\\pi$.\nSecond line.',
+        'number-depth': '2',
+    }
+
+
+def test_vars_file_for():
+    assert frontmatter.vars_file_for('paper.qmd') == frontmatter.VARS_FILE
+    assert frontmatter.vars_file_for('docs/paper_html.qmd') == os.path.join('.naist-cache', 'vars-paper_html.json')
+
+
+def test_load_yaml_vars_reuses_vars_file(tmp_path, monkeypatch):
+    qmd_file = tmp_path / 'paper.qmd'
+    qmd_file.write_text(f'---\n{FRONT_MATTER}\n---\n\n# Body\n', encoding='utf-8')
+    yaml_vars = frontmatter.load_yaml_vars(str(qmd_file))
+    vars_file = tmp_path / frontmatter.VARS_FILE
+    with open(vars_file, 'r', encoding='utf-8') as f:
+        assert json.load(f)['vars'] == yaml_vars
+
+    # フロントマターが同じ場合は解析しない
+    monkeypatch.setattr(frontmatter, 'parse_front_matter', lambda front_matter: pytest.fail('parsed again'))
+    assert frontmatter.load_yaml_vars(str(qmd_file)) == yaml_vars
+    # 本文の変更では解析し直さない
+    qmd_file.write_text(f'---\n{FRONT_MATTER}\n---\n\n# Changed body\n', encoding='utf-8')
+    assert frontmatter.load_yaml_vars(str(qmd_file)) == yaml_vars
+    monkeypatch.undo()
+
+    qmd_file.write_text(f'---\n{FRONT_MATTER.replace("Second", "Third")}\n---\n', encoding='utf-8')
+    assert frontmatter.load_yaml_vars(str(qmd_file))['abstract'] == 'First line with $\\pi$.\nThird line.'
@@ -0,0 +1,124 @@
+import io
+
+import pytest
+
+from naistbuild import bibliography, latex
+
+# 偽のxelatex: 本文の\citeから.bcfを書き、.auxには本文と.bblのハッシュを書く
+XELATEX = r'''import hashlib, os, re, sys
+tex = sys.argv[-1]
+job = tex[:-4]
+with open('calls.log', 'a') as f:
+    f.write('xelatex\n')
+with open(tex, encoding='utf-8') as f:
+    body = f.read()
+bbl = open(job + '.bbl', encoding='utf-8').read() if os.path.exists(job + '.bbl') else ''
+with open(job + '.aux', 'w', encoding='utf-8') as f:
+    f.write(hashlib.sha256((body + bbl).encode('utf-8')).hexdigest())
+keys = re.findall(r'\\cite\{([^}]*)\}', body)
+with open(job + '.bcf', 'w', encoding='utf-8') as f:
+    f.write('<bcf:controlfile>\n'
+            '<bcf:datasource type="file" datatype="bibtex">references/refs.bib</bcf:datasource>\n'
+            + ''.join(f'<bcf:citekey order="{i}">{key}</bcf:citekey>\n' for i, key in enumerate(keys))
+            + '</bcf:controlfile>\n')
+for ext, text in [('.log', 'This is XeTeX\n'), ('.pdf', '%PDF\n')]:
+    with open(job + ext, 'w', encoding='utf-8') as f:
+        f.write(text)
+'''
+
+# 偽のbiber: .bcfのデータソースの内容をそのまま.bblに書く
+BIBER = r'''import re, sys
+with open('calls.log', 'a') as f:
+    f.write('biber\n')
+args = sys.argv[1:]
+bcf = args[-1] if args[-1].endswith('.bcf') else args[-1] + '.bcf'
+output = args[args.index('--output-file') + 1] if '--output-file' in args else bcf[:-4] + '.bbl'
+with open(bcf, encoding='utf-8') as f:
+    source = re.search(r'<bcf:datasource[^>]*>([^<]*)<', f.read()).group(1)
+with open(source, encoding='utf-8') as f:
+    bib = f.read()
+with open(output, 'w', encoding='utf-8') as f:
+    f.write(bib)
+'''
+
+BIB = '''@article{Smith2020,
+  title = {First title},
+}
+
+@misc{Unused, note = {not cited}}
+'''
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch, fake_command):
+    fake_command('xelatex', XELATEX)
+    fake_command('biber', BIBER)
+    monkeypatch.setenv('NAIST_FORMAT', '0')
+    monkeypatch.setenv('NAIST_CACHE', '1')
+    monkeypatch.setattr(bibliography, 'PROJECT_ROOT', str(tmp_path))
+    (tmp_path / 'references').mkdir()
+    (tmp_path / 'references' / 'refs.bib').write_text(BIB, encoding='utf-8')
+    (tmp_path / 'paper.tex').write_text('\\cite{Smith2020}\n', encoding='utf-8')
+    return tmp_path
+
+
+def build(project):
+    """PDFを生成し、(成功したか, 実行したコマンドのリスト, ログ)を返す"""
+    calls_file = project / 'calls.log'
+    if calls_file.exists():
+        calls_file.unlink()
+    stream = io.StringIO()
+    ok = latex.build_pdf(str(project / 'paper.tex'), stream=stream)
+    return ok, calls_file.read_text().split(), stream.getvalue()
+
+
+def test_converges_and_reuses_cached_bbl(project):
+    ok, calls, _ = build(project)
+    assert ok
+    # .bblを作った後に.auxが変わるため、xelatexは.auxが収束するまで繰り返す
+    assert calls == ['xelatex', 'biber', 'xelatex', 'xelatex']
+
+    ok, calls, log = build(project)
+    assert ok
+    assert calls == ['xelatex']
+    assert 'Reused cached paper.bbl' in log
+
+
+def test_edited_bib_entry_reruns_biber(project):
+    build(project)
+    (project / 'references' / 'refs.bib').write_text(BIB.replace('First title', 'Second title'), encoding='utf-8')
+    ok, calls, _ = build(project)
+    assert ok
+    assert calls == ['xelatex', 'biber', 'xelatex', 'xelatex']
+    assert 'Second title' in (project / 'paper.bbl').read_text(encoding='utf-8')
+
+
+def test_uncited_entry_edit_reuses_cached_bbl(project):
+    # 引用していない項目の編集ではキャッシュのキーが変わらないため、biberを実行しない
+    build(project)
+    (project / 'references' / 'refs.bib').write_text(BIB.replace('not cited', 'still not cited'), encoding='utf-8')
+    ok, calls, log = build(project)
+    assert ok
+    assert calls == ['xelatex']
+    assert 'Reused cached paper.bbl (1 of 2 entries)' in log
+
+
+def test_reverted_entry_restores_cached_bbl(project):
+    build(project)
+    (project / 'references' / 'refs.bib').write_text(BIB.replace('First title', 'Second title'), encoding='utf-8')
+    build(project)
+    (project / 'references' / 'refs.bib').write_text(BIB, encoding='utf-8')
+    ok, calls, _ = build(project)
+    assert ok
+    # 以前の内容の.bblをキャッシュから戻し、.auxが変わるため再実行する
+    assert 'biber' not in calls
+    assert 'First title' in (project / 'paper.bbl').read_text(encoding='utf-8')
+
+
+def test_new_citation_reruns_biber(project):
+    build(project)
+    (project / 'paper.tex').write_text('\\cite{Smith2020}\n\\cite{Unused}\n', encoding='utf-8')
+    ok, calls, _ = build(project)
+    assert ok
+    assert 'biber' in calls
+    assert 'not cited' in (project / 'paper.bbl').read_text(encoding='utf-8')
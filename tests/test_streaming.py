@@ -0,0 +1,59 @@
+import io
+
+from naistbuild import fixups, pipeline, streaming
+
+TEXT = ''.join([
+    'line 1\n',
+    '\n',
+    '\n',
+    '\\printbibliography\n',
+    'line 2\n',
+    '\n',
+    '\\printbibliography[heading=none]\n',
+    'line 3\n',
+    '\n',
+    '\\printbibliography\n',
+    '\n',
+    'last line\n',
+])
+
+
+def remove_auto_bibliography(text):
+    context = pipeline.PostRenderContext('paper.tex', '.', stream=io.StringIO())
+    return fixups.remove_auto_bibliography(text, context)
+
+
+def test_chunks_reassemble_the_input():
+    for chunk_size in range(1, len(TEXT) + 2):
+        chunks = list(streaming.iter_chunks(io.StringIO(TEXT), chunk_size=chunk_size))
+        assert ''.join(chunks) == TEXT
+
+
+def test_first_line_is_prepended():
+    chunks = list(streaming.iter_chunks(io.StringIO('b\nc\n'), first='a\n', chunk_size=1))
+    assert ''.join(chunks) == 'a\nb\nc\n'
+
+
+def test_carry_keeps_line_context_across_boundaries():
+    # チャンクの境目に関係なく、前の空行を見る修正がファイル全体の場合と同じ結果になる
+    expected = remove_auto_bibliography(TEXT)
+    for chunk_size in range(1, len(TEXT) + 2):
+        chunks = streaming.iter_chunks(io.StringIO(TEXT), chunk_size=chunk_size)
+        assert ''.join(remove_auto_bibliography(chunk) for chunk in chunks) == expected
+
+
+def test_carried_blank_lines_are_bounded():
+    text = 'a\n' + '\n' * (streaming.MAX_CARRY * 3) + 'b\n'
+    chunks = list(streaming.iter_chunks(io.StringIO(text), chunk_size=1))
+    assert ''.join(chunks) == text
+    assert max(chunk.count('\n') for chunk in chunks) <= streaming.MAX_CARRY
+
+
+def test_write_if_changed_keeps_mtime(tmp_path):
+    path = str(tmp_path / 'paper.toc')
+    assert streaming.write_if_changed(path, 'a\n')
+    mtime = (tmp_path / 'paper.toc').stat().st_mtime_ns
+    assert not streaming.write_if_changed(path, 'a\n')
+    assert (tmp_path / 'paper.toc').stat().st_mtime_ns == mtime
+    assert streaming.write_if_changed(path, 'b\n')
+    assert not (tmp_path / 'paper.toc.tmp').exists()
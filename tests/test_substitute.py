@@ -0,0 +1,66 @@
+from naistbuild import substitute
+
+
+def test_variables_literals_and_patterns_in_one_pass():
+    table = substitute.SlotTable()
+    table.variable('title', 'T')
+    table.literal('?listfigure?', 'Figures', label='lof')
+    table.pattern(r'\\def\\temp(\w)\{[^}]*\}', lambda m: f'\\def\\temp{m.group(1)}{{x}}', label='def')
+    result = table.substitute('$title$ ?listfigure? \\def\\tempA{old} $unknown$')
+    assert result == 'T Figures \\def\\tempA{x} $unknown$'
+    assert table.count('title') == 1
+    assert table.count('lof') == 1
+    assert table.count('def') == 1
+
+
+def test_replacement_is_not_rescanned():
+    table = substitute.SlotTable()
+    table.variable('a', '$b$')
+    table.variable('b', 'B')
+    assert table.substitute('$a$ $b$') == '$b$ B'
+
+
+def test_longer_literal_wins_at_the_same_position():
+    table = substitute.SlotTable()
+    table.literal('?list?', 'short')
+    table.literal('?list?figure', 'long')
+    assert table.substitute('?list?figure ?list?') == 'long short'
+
+
+def test_missing_handler():
+    table = substitute.SlotTable()
+    table.missing = lambda name, match: '' if name.startswith('member') else None
+    assert table.substitute('[$member-3$][$p$]') == '[][$p$]'
+    assert table.count('member-3') == 1
+
+
+def test_command_with_nested_arguments():
+    table = substitute.SlotTable()
+    table.command('cmembers', 2, lambda command, text: '\\cmembers{%s}{}' % command.args[0], label='cm')
+    result = table.substitute('\\cmembers{A {\\bf B}}\n  {C {D}} $x$')
+    assert result == '\\cmembers{A {\\bf B}}{} $x$'
+    assert table.count('cm') == 1
+
+
+def test_fallback_when_command_slot_is_unusable():
+    # コメント中のコマンドや引数が足りないコマンドは、同じ位置で他のスロット（_fallback）を試す
+    table = substitute.SlotTable()
+    table.command('foo', 1, lambda command, text: 'C')
+    table.literal('\\foo', 'L')
+    table.variable('x', 'X')
+    assert table.substitute('\\foo{a} % \\foo{b}\n\\foo $x$') == 'C % L{b}\nL X'
+
+
+def test_fallback_without_other_slots_advances_one_character():
+    table = substitute.SlotTable()
+    table.command('foo', 1, lambda command, text: None)
+    table.variable('x', 'X')
+    assert table.substitute('\\foo{a}\\foo $x$ \\foobar{b}') == '\\foo{a}\\foo X \\foobar{b}'
+
+
+def test_commands_after_an_unclosed_argument():
+    table = substitute.SlotTable()
+    table.command('foo', 1, lambda command, text: 'C')
+    table.variable('x', 'X')
+    text = '\\foo{a} \\foo{b ' + '\\foo{c} $x$ ' * 3
+    assert table.substitute(text) == 'C \\foo{b ' + '\\foo{c} X ' * 3
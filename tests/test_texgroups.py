@@ -0,0 +1,72 @@
+from naistbuild import texgroups
+
+
+def test_group_end_nested_and_escaped_braces():
+    text = r'\x{a {b} \{ c \} {d {e}}} rest'
+    start = text.index('{')
+    assert text[texgroups.group_end(text, start):] == ' rest'
+
+
+def test_group_end_ignores_braces_in_comments():
+    text = '{a % } not a closer\n b}'
+    assert texgroups.group_end(text, 0) == len(text)
+
+
+def test_group_end_unclosed():
+    assert texgroups.group_end('{a {b}', 0) is None
+
+
+def test_in_comment():
+    text = 'a \\% b % c\nd'
+    assert not texgroups.in_comment(text, text.index('b'))
+    assert texgroups.in_comment(text, text.index('c'))
+    assert not texgroups.in_comment(text, text.index('d'))
+
+
+def test_parse_arguments_across_whitespace():
+    text = '\\cmembers{A}\n  {B {C}} tail'
+    command = texgroups.parse_arguments(text, 0, len('\\cmembers'), 2)
+    assert command.args == ['A', 'B {C}']
+    assert text[command.end:] == ' tail'
+    assert texgroups.parse_arguments(text, 0, len('\\cmembers'), 3) is None
+
+
+def test_find_commands_skips_comments_and_longer_names():
+    text = '\\hypersetup{a}\n% \\hypersetup{b}\n\\hypersetupx{c}\n\\hypersetup{d{e}}\n'
+    assert [command.args for command in texgroups.find_commands(text, 'hypersetup')] == [['a'], ['d{e}']]
+
+
+def test_rewrite_commands():
+    text = '\\hypersetup{pdfauthor={X}}\n\\hypersetup{colorlinks}\n'
+    result, count = texgroups.rewrite_commands(
+        text, 'hypersetup', 1, lambda command: '' if 'pdfauthor' in command.args[0] else None)
+    assert (result, count) == ('\n\\hypersetup{colorlinks}\n', 1)
+
+
+def test_scan_is_linear_on_deep_nesting():
+    text = '{' * 50000 + '}' * 50000
+    assert texgroups.group_end(text, 0) == len(text)
+
+
+def test_unclosed_argument_is_scanned_once(monkeypatch):
+    # 閉じていない引数の後ろのコマンドごとにファイルの最後まで走査し直さない
+    text = '\\hypersetup{a}\n\\hypersetup{unclosed\n' + '\\hypersetup{x}\n' * 20000
+    scanned = []
+    original = texgroups.group_end
+
+    def counting_group_end(text, start):
+        scanned.append(start)
+        return original(text, start)
+
+    monkeypatch.setattr(texgroups, 'group_end', counting_group_end)
+    assert [command.args for command in texgroups.find_commands(text, 'hypersetup')] == [['a']]
+    assert len(scanned) == 2
+
+
+def test_scanner_skips_groups_after_an_unclosed_group():
+    text = '{a} {b {c}'
+    scanner = texgroups.GroupScanner(text)
+    assert scanner.group_end(0) == 3
+    assert scanner.group_end(4) is None
+    assert scanner.unclosed == 4
+    assert scanner.group_end(text.index('{c')) is None